@@ -0,0 +1,171 @@
+# python 3.6.8
+import os
+import json
+import hashlib
+import shutil
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_ENTRY_EXT = '.uasm'
+CACHE_STATS_FILE = 'stats.json'
+
+class CompileCache:
+  """
+  Content-addressed cache of generated Udon Assembly
+
+  {cache_dir}/{key[:2]}/{key}.uasm
+  key = sha256 of (preprocessed source, compiler version, extern database fingerprint, ...)
+  The mtime of an entry is its last use, and the least recently used entries
+  are evicted when the cache grows over max_bytes.
+  """
+  cache_dir: str
+  max_bytes: int
+
+  def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES) -> None:
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+
+  @staticmethod
+  def make_key(*parts: str) -> str:
+    key_hash = hashlib.sha256()
+    for part in parts:
+      part_bytes = part.encode('utf-8')
+      # length prefix: ('ab', 'c') and ('a', 'bc') are different keys
+      key_hash.update(f'{len(part_bytes)}:'.encode('utf-8'))
+      key_hash.update(part_bytes)
+    return key_hash.hexdigest()
+
+  def entry_path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, key[:2], f'{key}{CACHE_ENTRY_EXT}')
+
+  def get(self, key: str) -> Optional[str]:
+    path = self.entry_path(key)
+    try:
+      f = open(path, encoding='utf-8', newline='')
+      asm = f.read()
+      f.close()
+    except OSError:
+      return None
+    # LRU: mark as recently used
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return asm
+
+  def get_file(self, key: str, output_path: str) -> bool:
+    """Copy the entry to output_path. False if there is no entry."""
+    path = self.entry_path(key)
+    try:
+      shutil.copyfile(path, output_path)
+    except OSError:
+      return False
+    # LRU: mark as recently used
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return True
+
+  def put_file(self, key: str, output_path: str) -> None:
+    """Store a generated output file as it is"""
+    path = self.entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.copyfile(output_path, tmp_path)
+    os.replace(tmp_path, path)
+
+  def put(self, key: str, asm: str) -> None:
+    path = self.entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first, so that readers never see a half-written entry.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    f = open(tmp_path, 'w', encoding='utf-8', newline='')
+    f.write(asm)
+    f.close()
+    os.replace(tmp_path, path)
+
+  def entries(self) -> List[Tuple[str, int, float]]:
+    """(path, size, last used time) of all entries"""
+    ret_entries: List[Tuple[str, int, float]] = []
+    if not os.path.isdir(self.cache_dir):
+      return ret_entries
+    for sub_dir in os.listdir(self.cache_dir):
+      sub_dir_path = os.path.join(self.cache_dir, sub_dir)
+      if not os.path.isdir(sub_dir_path):
+        continue
+      for file_name in os.listdir(sub_dir_path):
+        if not file_name.endswith(CACHE_ENTRY_EXT):
+          continue
+        path = os.path.join(sub_dir_path, file_name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        ret_entries.append((path, stat.st_size, stat.st_mtime))
+    return ret_entries
+
+  def evict(self) -> int:
+    """Remove least recently used entries until the cache fits in max_bytes. Returns the removed count."""
+    cache_entries = sorted(self.entries(), key=lambda entry: entry[2])
+    total_bytes = sum(size for _, size, _ in cache_entries)
+    n_removed = 0
+    for path, size, _ in cache_entries:
+      if total_bytes <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total_bytes -= size
+      n_removed += 1
+    return n_removed
+
+  def clear(self) -> int:
+    """Remove all entries and statistics. Returns the removed count."""
+    n_removed = 0
+    for path, _, _ in self.entries():
+      try:
+        os.remove(path)
+        n_removed += 1
+      except OSError:
+        pass
+      try:
+        os.rmdir(os.path.dirname(path))
+      except OSError:
+        pass
+    stats_path = os.path.join(self.cache_dir, CACHE_STATS_FILE)
+    if os.path.exists(stats_path):
+      os.remove(stats_path)
+    return n_removed
+
+  def load_stats(self) -> Dict[str, int]:
+    """Accumulated hit/miss counts"""
+    stats = {'hits': 0, 'misses': 0}
+    try:
+      f = open(os.path.join(self.cache_dir, CACHE_STATS_FILE), encoding='utf-8')
+      stats.update(json.load(f))
+      f.close()
+    except (OSError, ValueError):
+      pass
+    return stats
+
+  def record_stats(self, hits: int, misses: int) -> None:
+    stats = self.load_stats()
+    stats['hits'] += hits
+    stats['misses'] += misses
+    os.makedirs(self.cache_dir, exist_ok=True)
+    f = open(os.path.join(self.cache_dir, CACHE_STATS_FILE), 'w', encoding='utf-8')
+    json.dump(stats, f)
+    f.close()
+
+  def stats_str(self) -> str:
+    stats = self.load_stats()
+    cache_entries = self.entries()
+    total_bytes = sum(size for _, size, _ in cache_entries)
+    n_lookups = stats['hits'] + stats['misses']
+    hit_rate = 100.0 * stats['hits'] / n_lookups if n_lookups > 0 else 0.0
+    return (f'cache: {self.cache_dir}\n'
+            f'  entries: {len(cache_entries)} ({total_bytes} / {self.max_bytes} bytes)\n'
+            f'  hits: {stats["hits"]}, misses: {stats["misses"]} ({hit_rate:.1f}% hit)')
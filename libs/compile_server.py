@@ -0,0 +1,152 @@
+# python 3.6.8
+import sys
+import os
+import json
+import hmac
+import secrets
+import socket
+import socketserver
+import tempfile
+import threading
+from typing import *
+from typing import TextIO # not included in "from typing import *"
+from typing_extensions import Literal # 3.8: typing.Literal
+
+# Compile server transport
+#
+# The server keeps the compiler (extern table, udon_types, event_table) loaded
+# and answers one JSON object per line, over a local TCP socket or stdin/stdout.
+#   request : {"id": 1, "command": "compile", "source": "def _start(): ..."}
+#             {"id": 2, "command": "compile", "input": "C:/a.py", "output": "C:/a.uasm"}
+#             {"command": "ping"} / {"command": "shutdown"}
+#   response: {"id": 1, "ok": true, "asm": "...", "elapsed_ms": 3.2}
+#             {"id": 2, "ok": false, "error": "5:8 Name: ...", "elapsed_ms": 1.0}
+# TCP requests also carry {"token": "..."}. The server writes a random token to token_path(port)
+# (readable only by the user), so that other programs (ex: a web page posting to localhost)
+# cannot make the server read or write files.
+# This module only uses the standard library, so that the client starts quickly.
+
+DEFAULT_SERVER_PORT = 28620
+RequestHandler = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+def parse_request(line: str) -> Dict[str, Any]:
+  """Raises ValueError if the line is not a JSON object"""
+  request = json.loads(line)
+  if type(request) is not dict:
+    raise ValueError('a request must be a JSON object')
+  return cast(Dict[str, Any], request)
+
+def response_line(response: Dict[str, Any]) -> str:
+  return json.dumps(response) + '\n'
+
+def handle_parsed_request(request: Dict[str, Any], handle_request: RequestHandler) -> str:
+  """One request -> one response line"""
+  try:
+    response = handle_request(request)
+  except Exception as e:
+    response = {'ok': False, 'error': str(e)}
+  if 'id' in request:
+    response['id'] = request['id']
+  return response_line(response)
+
+def handle_line(line: str, handle_request: RequestHandler) -> str:
+  """One request line -> one response line"""
+  try:
+    request = parse_request(line)
+  except ValueError as e:
+    return response_line({'ok': False, 'error': f'Invalid request: {e}'})
+  return handle_parsed_request(request, handle_request)
+
+def is_shutdown_request(line: str) -> bool:
+  try:
+    request = json.loads(line)
+  except ValueError:
+    return False
+  return type(request) is dict and request.get('command') == 'shutdown'
+
+def token_path(port: int) -> str:
+  """The access token of the TCP server on the port"""
+  return os.path.join(tempfile.gettempdir(), f'udonpie_compile_server_{port}.token')
+
+def write_token(port: int) -> str:
+  """Write a new access token that only the user can read"""
+  token = secrets.token_hex(16)
+  path = token_path(port)
+  if os.path.exists(path):
+    os.remove(path)
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  with os.fdopen(fd, 'w') as token_file:
+    token_file.write(token)
+  return token
+
+def read_token(port: int) -> str:
+  """Raises OSError if the server is not running"""
+  with open(token_path(port)) as token_file:
+    return token_file.read().strip()
+
+def serve_stdio(handle_request: RequestHandler, stdin: TextIO = sys.stdin, stdout: TextIO = sys.stdout) -> None:
+  """Serve requests from stdin until EOF or a shutdown request"""
+  for line in stdin:
+    if line.strip() == '':
+      continue
+    if is_shutdown_request(line):
+      stdout.write(json.dumps({'ok': True}) + '\n')
+      stdout.flush()
+      return
+    stdout.write(handle_line(line, handle_request))
+    stdout.flush()
+
+def serve_tcp(handle_request: RequestHandler, port: int = DEFAULT_SERVER_PORT) -> None:
+  """Serve requests on 127.0.0.1:port until a shutdown request"""
+  # Requests are compiled one at a time.
+  compile_lock = threading.Lock()
+
+  def handle_request_locked(request: Dict[str, Any]) -> Dict[str, Any]:
+    with compile_lock:
+      return handle_request(request)
+
+  class LineHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+      for line_bytes in self.rfile:
+        if line_bytes.strip() == b'':
+          continue
+        try:
+          request = parse_request(line_bytes.decode('utf-8'))
+        except ValueError as e:
+          # Not a client of this server (ex: the body of an HTTP request): close the connection.
+          self.wfile.write(response_line({'ok': False, 'error': f'Invalid request: {e}'}).encode('utf-8'))
+          return
+        if not hmac.compare_digest(str(request.get('token', '')), token):
+          self.wfile.write(response_line({'ok': False, 'error': 'Invalid token.'}).encode('utf-8'))
+          return
+        if request.get('command') == 'shutdown':
+          self.wfile.write(response_line({'ok': True}).encode('utf-8'))
+          # shutdown() waits for serve_forever(), so call it from another thread.
+          threading.Thread(target=server.shutdown).start()
+          return
+        self.wfile.write(handle_parsed_request(request, handle_request_locked).encode('utf-8'))
+
+  class LineServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+  server = LineServer(('127.0.0.1', port), LineHandler)
+  token = write_token(port)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(token_path(port))
+
+def send_request(request: Dict[str, Any], port: int = DEFAULT_SERVER_PORT, timeout: Optional[float] = None) -> Dict[str, Any]:
+  """Send one request to the TCP server. Raises OSError if the server is not running."""
+  request = dict(request, token=read_token(port))
+  with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+    sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    response_bytes = b''
+    while not response_bytes.endswith(b'\n'):
+      chunk = sock.recv(65536)
+      if chunk == b'':
+        break
+      response_bytes += chunk
+  return json.loads(response_bytes.decode('utf-8'))
@@ -0,0 +1,277 @@
+# python 3.6.8
+import re
+import math
+import struct
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+
+# .NET semantics of the primitive types used by Udon (System.Int32 / UInt32 / Single / Boolean / String)
+#
+# Python ints are unbounded and Python floats are doubles, so the results are
+# wrapped / rounded here in the same way as the C# operators.
+
+INT32_MIN = -0x80000000
+INT32_MAX = 0x7FFFFFFF
+
+class DotNetException(Exception):
+  """Exception thrown by a .NET operation (e.g. System.DivideByZeroException)"""
+  pass
+
+def int32(value: int) -> int:
+  """wrap to System.Int32 (unchecked)"""
+  value &= 0xFFFFFFFF
+  return value - 0x100000000 if value > INT32_MAX else value
+
+def uint32(value: int) -> int:
+  """wrap to System.UInt32 (unchecked)"""
+  return value & 0xFFFFFFFF
+
+def single(value: float) -> float:
+  """round to System.Single"""
+  try:
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+  except OverflowError:
+    return math.copysign(math.inf, value)
+
+def int32_div(a: int, b: int) -> int:
+  """C# a / b (truncated toward zero)"""
+  if b == 0:
+    raise DotNetException('System.DivideByZeroException: Attempted to divide by zero.')
+  if a == INT32_MIN and b == -1:
+    raise DotNetException('System.OverflowException: Arithmetic operation resulted in an overflow.')
+  q = abs(a) // abs(b)
+  return int32(q if (a < 0) == (b < 0) else -q)
+
+def int32_rem(a: int, b: int) -> int:
+  """C# a % b (the sign of the dividend)"""
+  if b == 0:
+    raise DotNetException('System.DivideByZeroException: Attempted to divide by zero.')
+  # int.MinValue % -1 also throws (the remainder is computed by the division instruction).
+  if a == INT32_MIN and b == -1:
+    raise DotNetException('System.OverflowException: Arithmetic operation resulted in an overflow.')
+  r = abs(a) % abs(b)
+  return int32(-r if a < 0 else r)
+
+def int32_shl(a: int, b: int) -> int:
+  # The shift count is masked to 5 bits.
+  return int32(a << (b & 31))
+
+def int32_shr(a: int, b: int) -> int:
+  # Arithmetic shift
+  return int32(a >> (b & 31))
+
+def single_div(a: float, b: float) -> float:
+  if b == 0.0:
+    if a == 0.0 or math.isnan(a):
+      return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1.0, b)
+  return single(a / b)
+
+def single_rem(a: float, b: float) -> float:
+  if b == 0.0 or math.isinf(a) or math.isnan(a) or math.isnan(b):
+    return math.nan
+  return single(math.fmod(a, b))
+
+def to_int32(value: Any) -> int:
+  """System.Convert.ToInt32"""
+  if type(value) is bool:
+    return 1 if value else 0
+  if type(value) is float:
+    if math.isnan(value) or value >= 2147483647.5 or value < -2147483648.5:
+      raise DotNetException('System.OverflowException: Value was either too large or too small for an Int32.')
+    # Convert.ToInt32(Single) rounds half to even. (Python round() does the same.)
+    return round(value)
+  if type(value) is str:
+    return parse_int32(value)
+  if value is None:
+    return 0
+  return int32(int(value))
+
+def to_single(value: Any) -> float:
+  """System.Convert.ToSingle"""
+  if type(value) is bool:
+    return 1.0 if value else 0.0
+  if type(value) is str:
+    return parse_single(value)
+  if value is None:
+    return 0.0
+  return single(float(value))
+
+def to_boolean(value: Any) -> bool:
+  """System.Convert.ToBoolean"""
+  if type(value) is str:
+    return parse_boolean(value)
+  if value is None:
+    return False
+  return value != 0
+
+# Int32.Parse / Single.Parse formats (NumberStyles.Integer / Float | AllowThousands, invariant culture)
+# Python's int() / float() also accept '1_000', 'inf', 'nan', ..., which .NET rejects.
+PARSE_WHITESPACE = ' \t\n\v\f\r'
+INT32_FORMAT = re.compile(r'[ \t\n\v\f\r]*[+-]?[0-9]+[ \t\n\v\f\r]*')
+SINGLE_FORMAT = re.compile(r'[ \t\n\v\f\r]*[+-]?([0-9][0-9,]*(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?[ \t\n\v\f\r]*')
+SINGLE_SYMBOLS = {'Infinity': math.inf, '-Infinity': -math.inf, 'NaN': math.nan}
+
+def parse_int32(s: str) -> int:
+  if INT32_FORMAT.fullmatch(s) is None:
+    raise DotNetException(f'System.FormatException: Input string was not in a correct format. ({s!r})')
+  value = int(s.strip(PARSE_WHITESPACE))
+  if value < INT32_MIN or INT32_MAX < value:
+    raise DotNetException('System.OverflowException: Value was either too large or too small for an Int32.')
+  return value
+
+def parse_single(s: str) -> float:
+  symbol = s.strip(PARSE_WHITESPACE)
+  if symbol in SINGLE_SYMBOLS:
+    return SINGLE_SYMBOLS[symbol]
+  if SINGLE_FORMAT.fullmatch(s) is None:
+    raise DotNetException(f'System.FormatException: Input string was not in a correct format. ({s!r})')
+  return single(float(symbol.replace(',', '')))
+
+def parse_boolean(s: str) -> bool:
+  """System.Boolean.Parse ("true" / "false", case insensitive)"""
+  lower_s = s.strip().lower()
+  if lower_s == 'true':
+    return True
+  if lower_s == 'false':
+    return False
+  raise DotNetException(f'System.FormatException: String was not recognized as a valid Boolean. ({s!r})')
+
+def single_to_string(value: float) -> str:
+  """System.Single.ToString() (general format, 7 significant digits)"""
+  if math.isnan(value):
+    return 'NaN'
+  if math.isinf(value):
+    return 'Infinity' if value > 0 else '-Infinity'
+  s = format(value, '.7g')
+  if 'e' in s:
+    # 1e+07 -> 1E+07
+    mantissa, exponent = s.split('e')
+    s = f'{mantissa}E{exponent[0]}{exponent[1:].zfill(2)}'
+  return s
+
+def single_literal(value: float) -> Optional[str]:
+  """
+  Shortest decimal literal that is parsed to the same System.Single
+  (None: Infinity / NaN cannot be written as a literal)
+  """
+  if math.isnan(value) or math.isinf(value):
+    return None
+  for precision in range(1, 10):
+    s = f'{value:.{precision}g}'
+    if single(float(s)) == value:
+      break
+  if 'e' not in s and '.' not in s:
+    s += '.0'
+  return s
+
+def to_string(value: Any) -> str:
+  """System.Convert.ToString / Object.ToString"""
+  if value is None:
+    return ''
+  if type(value) is bool:
+    return 'True' if value else 'False'
+  if type(value) is float:
+    return single_to_string(value)
+  return str(value)
+
+def concat(a: Any, b: Any) -> str:
+  """System.String.Concat(Object, Object) (null is an empty string)"""
+  return to_string(a) + to_string(b)
+
+# Externs without side effects: extern string -> (input arg count, function)
+# They are used by the Udon VM emulator and by the constant folding of the compiler.
+pure_extern_dict: Dict[str, Tuple[int, Callable[..., Any]]] = {}
+# Pure externs that can throw an exception (e.g. division by zero).
+# They are not removed even if the result is not used.
+throwing_externs: Set[str] = set()
+
+def add_pure_extern(extern_str: str, n_in: int, func: Callable[..., Any], can_throw: bool = False) -> None:
+  pure_extern_dict[extern_str] = (n_in, func)
+  if can_throw:
+    throwing_externs.add(extern_str)
+
+def register_pure_externs() -> None:
+  int32_binops: Dict[str, Callable[[int, int], Any]] = {
+    'Addition': lambda a, b: int32(a + b),
+    'Subtraction': lambda a, b: int32(a - b),
+    'Multiplication': lambda a, b: int32(a * b),
+    'Division': int32_div,
+    'Remainder': int32_rem,
+    'LogicalAnd': lambda a, b: a & b,
+    'LogicalOr': lambda a, b: a | b,
+    'LogicalXor': lambda a, b: a ^ b,
+    'LeftShift': int32_shl,
+    'RightShift': int32_shr,
+  }
+  for op_name, int32_op in int32_binops.items():
+    add_pure_extern(f'SystemInt32.__op_{op_name}__SystemInt32_SystemInt32__SystemInt32', 2, int32_op,
+                    can_throw=op_name in ('Division', 'Remainder'))
+  single_binops: Dict[str, Callable[[float, float], Any]] = {
+    'Addition': lambda a, b: single(a + b),
+    'Subtraction': lambda a, b: single(a - b),
+    'Multiplication': lambda a, b: single(a * b),
+    'Division': single_div,
+    'Remainder': single_rem,
+  }
+  for op_name, single_op in single_binops.items():
+    add_pure_extern(f'SystemSingle.__op_{op_name}__SystemSingle_SystemSingle__SystemSingle', 2, single_op)
+  compare_ops: Dict[str, Callable[[Any, Any], bool]] = {
+    'Equality': lambda a, b: a == b,
+    'Inequality': lambda a, b: a != b,
+    'LessThan': lambda a, b: a < b,
+    'LessThanOrEqual': lambda a, b: a <= b,
+    'GreaterThan': lambda a, b: a > b,
+    'GreaterThanOrEqual': lambda a, b: a >= b,
+  }
+  for type_name in ('SystemInt32', 'SystemSingle'):
+    for op_name, compare_op in compare_ops.items():
+      add_pure_extern(f'{type_name}.__op_{op_name}__{type_name}_{type_name}__SystemBoolean', 2, compare_op)
+  add_pure_extern('SystemInt32.__op_UnaryMinus__SystemInt32__SystemInt32', 1, lambda a: int32(-a))
+  add_pure_extern('SystemSingle.__op_UnaryMinus__SystemSingle__SystemSingle', 1, lambda a: -a)
+
+  bool_binops: Dict[str, Callable[[bool, bool], bool]] = {
+    'ConditionalAnd': lambda a, b: a and b,
+    'ConditionalOr': lambda a, b: a or b,
+    'ConditionalXor': lambda a, b: a != b,
+    'LogicalAnd': lambda a, b: a and b,
+    'LogicalOr': lambda a, b: a or b,
+    'LogicalXor': lambda a, b: a != b,
+    'Equality': lambda a, b: a == b,
+    'Inequality': lambda a, b: a != b,
+  }
+  for op_name, bool_op in bool_binops.items():
+    add_pure_extern(f'SystemBoolean.__op_{op_name}__SystemBoolean_SystemBoolean__SystemBoolean', 2, bool_op)
+  add_pure_extern('SystemBoolean.__op_UnaryNegation__SystemBoolean__SystemBoolean', 1, lambda a: not a)
+
+  # String
+  add_pure_extern('SystemString.__op_Addition__SystemString_SystemString__SystemString', 2, concat)
+  add_pure_extern('SystemString.__op_Equality__SystemString_SystemString__SystemBoolean', 2, lambda a, b: a == b)
+  add_pure_extern('SystemString.__op_Inequality__SystemString_SystemString__SystemBoolean', 2, lambda a, b: a != b)
+  for arg_type in ('SystemObject', 'SystemString'):
+    for n_args in (2, 3, 4):
+      add_pure_extern(f'SystemString.__Concat__{"_".join([arg_type] * n_args)}__SystemString', n_args,
+                      lambda *args: ''.join(to_string(arg) for arg in args))
+  add_pure_extern('SystemString.__Concat__SystemObject__SystemString', 1, to_string)
+
+  # Convert / Parse / ToString
+  convert_funcs: Dict[str, Callable[[Any], Any]] = {
+    'Int32': to_int32,
+    'Single': to_single,
+    'Boolean': to_boolean,
+    'String': to_string,
+  }
+  for to_type, convert in convert_funcs.items():
+    for from_type in ('SystemInt32', 'SystemSingle', 'SystemBoolean', 'SystemString', 'SystemObject'):
+      # Parsing a string and Single -> Int32 (overflow) can throw.
+      can_throw = to_type != 'String' and (from_type in ('SystemString', 'SystemObject')
+                                           or (to_type, from_type) == ('Int32', 'SystemSingle'))
+      add_pure_extern(f'SystemConvert.__To{to_type}__{from_type}__System{to_type}', 1, convert, can_throw)
+  add_pure_extern('SystemInt32.__Parse__SystemString__SystemInt32', 1, parse_int32, can_throw=True)
+  add_pure_extern('SystemSingle.__Parse__SystemString__SystemSingle', 1, parse_single, can_throw=True)
+  add_pure_extern('SystemBoolean.__Parse__SystemString__SystemBoolean', 1, parse_boolean, can_throw=True)
+  for type_name in ('SystemInt32', 'SystemSingle', 'SystemBoolean', 'SystemObject'):
+    # null.ToString() throws NullReferenceException.
+    add_pure_extern(f'{type_name}.__ToString__SystemString', 1, to_string, can_throw=type_name == 'SystemObject')
+
+register_pure_externs()
@@ -0,0 +1,122 @@
+# python 3.6.8
+import sys
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+from .my_type import *
+from .tables import *
+from .dotnet_ops import *
+
+# Effect of each Udon extern (the entries of udon_funcs_data.py), used by the optimizations
+#   'pure':  no side effect, and the result depends only on the argument values
+#            (operators and methods of value types, Mathf, Convert, ...)
+#            It can still throw (ex: String.Substring), see extern_can_throw.
+#   'read':  no side effect, but the result depends on the state of objects
+#            (property getters of reference types, array Get, GetComponent, ...)
+#            It can change when a 'write' extern or a user-defined function runs.
+#   'write': may change the state of objects or return a new object every time
+#            (setters, array Set, constructors of reference types, Random, unknown externs)
+ExternEffect = Literal['pure', 'read', 'write']
+
+# Modules whose values cannot be changed through another variable
+# (value types, strings and static functions of them)
+value_modules: Set[str] = {
+  'SystemBoolean', 'SystemByte', 'SystemSByte', 'SystemChar',
+  'SystemInt16', 'SystemUInt16', 'SystemInt32', 'SystemUInt32', 'SystemInt64', 'SystemUInt64',
+  'SystemSingle', 'SystemDouble', 'SystemDecimal', 'SystemString',
+  'SystemConvert', 'SystemMath', 'UnityEngineMathf',
+  'UnityEngineVector2', 'UnityEngineVector3', 'UnityEngineVector4',
+  'UnityEngineVector2Int', 'UnityEngineVector3Int', 'UnityEngineQuaternion',
+  'UnityEngineColor', 'UnityEngineColor32', 'UnityEngineMatrix4x4',
+  'UnityEngineRect', 'UnityEngineBounds', 'UnityEngineRay', 'UnityEnginePlane',
+}
+
+# Explicit effects (a module or a whole extern string), checked before the rules
+extern_effect_overrides: Dict[str, ExternEffect] = {
+  # The state of the random generator changes.
+  'UnityEngineRandom': 'write',
+  # The clock moves during an event.
+  'UnityEngineTime.__get_realtimeSinceStartup__SystemSingle': 'write',
+  'SystemDateTime.__get_Now__SystemDateTime': 'write',
+  'SystemDateTime.__get_UtcNow__SystemDateTime': 'write',
+  'SystemDiagnosticsStopwatch': 'write',
+  'VRCInstantiate': 'write',
+}
+
+def split_extern_str(extern_str: str) -> Tuple[str, str, List[str], str]:
+  """
+  SystemInt32.__op_Addition__SystemInt32_SystemInt32__SystemInt32
+  -> ('SystemInt32', 'op_Addition', ['SystemInt32', 'SystemInt32'], 'SystemInt32')
+  """
+  module_name, _, signature = extern_str.partition('.')
+  parts = signature.split('__')
+  # ['', method, (args), ret]
+  if len(parts) < 3:
+    return (module_name, signature, [], '')
+  method_name = parts[1]
+  arg_types = parts[2].split('_') if len(parts) >= 4 else []
+  return (module_name, method_name, arg_types, parts[-1])
+
+extern_effect_cache: Dict[str, ExternEffect] = {}
+
+def extern_can_throw(extern_str: str) -> bool:
+  """
+  False only for the externs known not to throw: the operators and conversions of
+  dotnet_ops (pure_extern_dict) except throwing_externs (Int32 division, Parse, ...).
+  Other externs can throw even if they are 'pure'
+  (String.Substring: ArgumentOutOfRangeException, a null String: NullReferenceException).
+  """
+  return extern_str not in pure_extern_dict or extern_str in throwing_externs
+
+def get_extern_effect(extern_str: str) -> ExternEffect:
+  if extern_str not in extern_effect_cache:
+    extern_effect_cache[extern_str] = classify_extern(extern_str)
+  return extern_effect_cache[extern_str]
+
+def classify_extern(extern_str: str) -> ExternEffect:
+  if extern_str in extern_effect_overrides:
+    return extern_effect_overrides[extern_str]
+  module_name, method_name, arg_types, ret_type = split_extern_str(extern_str)
+  if module_name in extern_effect_overrides:
+    return extern_effect_overrides[module_name]
+  if extern_str in pure_extern_dict:
+    # An Object argument (or instance) is converted by its ToString() / IConvertible,
+    # which depends on the state of the object. (ex: String.Concat(Object, Object))
+    if module_name == 'SystemObject' or 'SystemObject' in arg_types:
+      return 'read'
+    return 'pure'
+  # out / ref arguments are written
+  if any(arg_type.endswith('Ref') for arg_type in arg_types):
+    return 'write'
+  if module_name in value_modules:
+    # Void methods and setters of a value type change the instance (ex: Vector3.Normalize()).
+    if ret_type == 'SystemVoid' or method_name.startswith('set_'):
+      return 'write'
+    # The contents of an array argument can change. (ex: String.ctor(CharArray))
+    if any(arg_type.endswith('Array') for arg_type in arg_types):
+      return 'read'
+    return 'pure'
+  if ret_type == 'SystemVoid' or ret_type.endswith('Array'):
+    # (A getter of an array returns a new copy every time. ex: Renderer.get_materials)
+    return 'write'
+  if module_name.endswith('Array') and method_name in ('Get', 'GetValue', 'get_Length', 'GetLength'):
+    return 'read'
+  if method_name.startswith('get_') or method_name in ('GetComponent', 'GetComponentInChildren', 'GetComponentInParent'):
+    return 'read'
+  return 'write'
+
+if __name__ == '__main__':
+  # Print the number of the externs of each effect
+  # python -m libs.extern_effects [--list pure|read|write|nothrow]
+  effect_counts: Dict[str, int] = {'pure': 0, 'read': 0, 'write': 0, 'nothrow': 0}
+  list_effect = sys.argv[2] if len(sys.argv) >= 3 and sys.argv[1] == '--list' else None
+  for _method_key, (_ret_type, extern_str) in get_udon_method_table().iter_methods():
+    # The effect, and 'nothrow' for the externs known not to throw
+    categories: List[str] = [get_extern_effect(extern_str)]
+    if not extern_can_throw(extern_str):
+      categories.append('nothrow')
+    for category in categories:
+      effect_counts[category] += 1
+    if list_effect in categories:
+      print(extern_str)
+  for category, count in effect_counts.items():
+    print(f'{category}: {count}', file=sys.stderr)
@@ -0,0 +1,332 @@
+# python 3.6.8
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+from .my_type import *
+from .tables import *
+
+# UdonPie intermediate representation
+#
+# UdonCompiler translates the AST into three-address instructions on heap variables
+# (The type of each variable is in VarTable.), grouped into basic blocks.
+# Optimization passes work on the IR, and UdonAssembly.lower_module() translates it
+# into Udon instructions.
+#
+#   IRModule
+#     IRFunction (an event or a user-defined function, in source order)
+#       BasicBlock (in layout order, blocks[0] is the entry)
+#         insts: IRCopy / IRExtern / IRCall
+#         term : IRJump / IRBranch / IRReturn
+
+BlockId = int
+
+class IRCopy(NamedTuple):
+  """dst = src"""
+  dst: VarName
+  src: VarName
+
+class IRExtern(NamedTuple):
+  """dst = extern(args...) (dst is None for a void extern)"""
+  extern_str: ExternStr
+  args: Tuple[VarName, ...]
+  dst: Optional[VarName]
+
+class IRCall(NamedTuple):
+  """
+  dst = user-defined function(args...)
+  saved_vars: variables saved on the stack during the call
+  """
+  func_id: LabelName
+  args: Tuple[VarName, ...]
+  dst: Optional[VarName]
+  saved_vars: Tuple[VarName, ...]
+
+IRInst = Union[IRCopy, IRExtern, IRCall]
+
+class IRJump(NamedTuple):
+  target: BlockId
+
+class IRBranch(NamedTuple):
+  """if cond goto then_target else goto else_target"""
+  cond: VarName
+  then_target: BlockId
+  else_target: BlockId
+
+class IRReturn(NamedTuple):
+  """Return from a function (value is None for Void), or the end of an event"""
+  value: Optional[VarName]
+
+IRTerm = Union[IRJump, IRBranch, IRReturn]
+
+def inst_read_vars(inst: Union[IRInst, IRTerm]) -> List[VarName]:
+  """Variables read by an instruction or a terminator"""
+  if type(inst) is IRCopy:
+    return [cast(IRCopy, inst).src]
+  if type(inst) is IRExtern:
+    return list(cast(IRExtern, inst).args)
+  if type(inst) is IRCall:
+    call_inst = cast(IRCall, inst)
+    return list(call_inst.args) + list(call_inst.saved_vars)
+  if type(inst) is IRBranch:
+    return [cast(IRBranch, inst).cond]
+  if type(inst) is IRReturn:
+    value = cast(IRReturn, inst).value
+    return [] if value is None else [value]
+  return []
+
+def rename_inst_vars(inst: Union[IRInst, IRTerm], var_map: Dict[VarName, VarName]) -> Union[IRInst, IRTerm]:
+  """Instruction (or terminator) with the variables replaced by var_map"""
+  def rename(var_name: Optional[VarName]) -> Optional[VarName]:
+    return None if var_name is None else var_map.get(var_name, var_name)
+  def rename_all(var_names: Tuple[VarName, ...]) -> Tuple[VarName, ...]:
+    return tuple(var_map.get(var_name, var_name) for var_name in var_names)
+  if type(inst) is IRCopy:
+    copy_inst = cast(IRCopy, inst)
+    return IRCopy(var_map.get(copy_inst.dst, copy_inst.dst), var_map.get(copy_inst.src, copy_inst.src))
+  if type(inst) is IRExtern:
+    extern_inst = cast(IRExtern, inst)
+    return IRExtern(extern_inst.extern_str, rename_all(extern_inst.args), rename(extern_inst.dst))
+  if type(inst) is IRCall:
+    call_inst = cast(IRCall, inst)
+    return IRCall(call_inst.func_id, rename_all(call_inst.args), rename(call_inst.dst), rename_all(call_inst.saved_vars))
+  if type(inst) is IRBranch:
+    branch = cast(IRBranch, inst)
+    return IRBranch(var_map.get(branch.cond, branch.cond), branch.then_target, branch.else_target)
+  if type(inst) is IRReturn:
+    return IRReturn(rename(cast(IRReturn, inst).value))
+  return inst
+
+
+class BasicBlock:
+  block_id: BlockId
+  insts: List[IRInst]
+  # None while the block is being built
+  term: Optional[IRTerm]
+
+  def __init__(self, block_id: BlockId) -> None:
+    self.block_id = block_id
+    self.insts = []
+    self.term = None
+
+  def successors(self) -> List[BlockId]:
+    if type(self.term) is IRJump:
+      return [cast(IRJump, self.term).target]
+    if type(self.term) is IRBranch:
+      branch = cast(IRBranch, self.term)
+      return [branch.then_target, branch.else_target]
+    return []
+
+class IRFunction:
+  # event name, or the function id (label) of a user-defined function
+  name: str
+  is_event: bool
+  # arguments (popped from the stack at the entry of a user-defined function)
+  params: List[VarName]
+  # variables saved around the calls in this function
+  env_vars: List[VarName]
+  # @inline: True, @noinline: False, None: decided by the inliner
+  inline_hint: Optional[bool]
+  # Static frame (a non-recursive function, see use_static_frames):
+  # the callers copy the arguments to the parameters and read the return value from
+  # static_ret_value_var, and only the return address is passed on the stack.
+  static_frame: bool
+  blocks: List[BasicBlock]
+  block_dict: Dict[BlockId, BasicBlock]
+
+  def __init__(self, name: str, is_event: bool, params: List[VarName], env_vars: List[VarName],
+               inline_hint: Optional[bool] = None) -> None:
+    self.name = name
+    self.is_event = is_event
+    self.params = params
+    self.env_vars = env_vars
+    self.inline_hint = inline_hint
+    self.static_frame = False
+    self.blocks = []
+    self.block_dict = {}
+
+  def entry(self) -> BasicBlock:
+    return self.blocks[0]
+
+  def set_blocks(self, blocks: List[BasicBlock]) -> None:
+    """Replace the layout (e.g. after removing blocks)"""
+    self.blocks = blocks
+    self.block_dict = {block.block_id: block for block in blocks}
+
+  def predecessors(self) -> Dict[BlockId, List[BlockId]]:
+    preds: Dict[BlockId, List[BlockId]] = {block.block_id: [] for block in self.blocks}
+    for block in self.blocks:
+      for succ_id in block.successors():
+        preds[succ_id].append(block.block_id)
+    return preds
+
+  def reachable_blocks(self) -> Set[BlockId]:
+    reached: Set[BlockId] = set()
+    stack = [self.entry().block_id]
+    while len(stack) > 0:
+      block_id = stack.pop()
+      if block_id in reached:
+        continue
+      reached.add(block_id)
+      stack.extend(self.block_dict[block_id].successors())
+    return reached
+
+  def calls(self) -> Iterator[IRCall]:
+    for block in self.blocks:
+      for inst in block.insts:
+        if type(inst) is IRCall:
+          yield cast(IRCall, inst)
+
+def static_ret_addr_var(func_id: str) -> VarName:
+  """Return address of a static-frame function"""
+  return VarName(f'{func_id}__ret_addr')
+
+def static_ret_value_var(func_id: str) -> VarName:
+  """Return value of a static-frame function"""
+  return VarName(f'{func_id}__ret')
+
+class IRModule:
+  functions: List[IRFunction]
+
+  def __init__(self) -> None:
+    self.functions = []
+
+  def function_dict(self) -> Dict[str, IRFunction]:
+    return {function.name: function for function in self.functions}
+
+  def used_vars(self) -> Set[VarName]:
+    """Variables read or written in the module"""
+    var_names: Set[VarName] = set()
+    for function in self.functions:
+      var_names.update(function.params)
+      for block in function.blocks:
+        for inst in block.insts:
+          var_names.update(inst_read_vars(inst))
+          if inst.dst is not None:
+            var_names.add(inst.dst)
+        var_names.update(inst_read_vars(cast(IRTerm, block.term)))
+    return var_names
+
+  def new_block_id(self) -> BlockId:
+    """Unused block id (Block ids are labels, so they are unique in the module.)"""
+    return max([block.block_id for function in self.functions for block in function.blocks], default=-1) + 1
+
+
+class IRBuilder:
+  """
+  Appends instructions to the current block.
+  A block is placed in the layout when it becomes the current block,
+  so the layout follows the source code.
+  """
+  module: IRModule
+  function: Optional[IRFunction]
+  # Statements outside functions are never run (Udon runs only events),
+  # so they are built into a function that is not in the module.
+  toplevel: IRFunction
+  block: Optional[BasicBlock]
+  block_counter: int
+
+  def __init__(self) -> None:
+    self.module = IRModule()
+    self.function = None
+    self.toplevel = IRFunction('__toplevel', True, [], [])
+    self.block = None
+    self.block_counter = 0
+
+  def begin_function(self, name: str, is_event: bool, params: List[VarName], env_vars: List[VarName],
+                     inline_hint: Optional[bool] = None) -> None:
+    self.function = IRFunction(name, is_event, params, env_vars, inline_hint)
+    self.module.functions.append(self.function)
+    self.set_block(self.new_block())
+
+  def end_function(self) -> None:
+    """The end of the function body returns (or ends the event)"""
+    self.ret(None)
+    self.function = None
+    self.block = None
+
+  def new_block(self) -> BlockId:
+    block_id = self.block_counter
+    self.block_counter += 1
+    return block_id
+
+  def set_block(self, block_id: BlockId) -> BasicBlock:
+    function = self.function if self.function is not None else self.toplevel
+    if block_id not in function.block_dict:
+      function.block_dict[block_id] = BasicBlock(block_id)
+      function.blocks.append(function.block_dict[block_id])
+    block = function.block_dict[block_id]
+    self.block = block
+    return block
+
+  def current_block(self) -> BasicBlock:
+    block = self.block if self.block is not None else self.set_block(self.new_block())
+    # Code after return / break / continue goes to a new (unreachable) block.
+    if block.term is not None:
+      block = self.set_block(self.new_block())
+    return block
+
+  def add_inst(self, inst: IRInst) -> None:
+    self.current_block().insts.append(inst)
+
+  def set_term(self, term: IRTerm) -> None:
+    self.current_block().term = term
+
+  def copy(self, dst: VarName, src: VarName) -> None:
+    self.add_inst(IRCopy(dst, src))
+
+  def extern(self, extern_str: ExternStr, args: List[VarName], dst: Optional[VarName] = None) -> None:
+    self.add_inst(IRExtern(extern_str, tuple(args), dst))
+
+  def call(self, func_id: LabelName, args: List[VarName], dst: Optional[VarName]) -> None:
+    env_vars = self.function.env_vars if self.function is not None else []
+    self.add_inst(IRCall(func_id, tuple(args), dst, tuple(env_vars)))
+
+  def jump(self, target: BlockId) -> None:
+    self.set_term(IRJump(target))
+
+  def branch(self, cond: VarName, then_target: BlockId, else_target: BlockId) -> None:
+    self.set_term(IRBranch(cond, then_target, else_target))
+
+  def ret(self, value: Optional[VarName]) -> None:
+    self.set_term(IRReturn(value))
+
+
+def format_inst(inst: Union[IRInst, IRTerm], var_table: Optional[VarTable] = None) -> str:
+  def var_str(var_name: VarName) -> str:
+    if var_table is not None and var_table.exist_var(var_name):
+      return f'{var_name}:{var_table.get_var_type(var_name)}'
+    return var_name
+  if type(inst) is IRCopy:
+    copy_inst = cast(IRCopy, inst)
+    return f'{var_str(copy_inst.dst)} = {var_str(copy_inst.src)}'
+  if type(inst) is IRExtern:
+    extern_inst = cast(IRExtern, inst)
+    call_str = f'extern {extern_inst.extern_str}({", ".join(extern_inst.args)})'
+    return call_str if extern_inst.dst is None else f'{var_str(extern_inst.dst)} = {call_str}'
+  if type(inst) is IRCall:
+    call_inst = cast(IRCall, inst)
+    call_str = f'call {call_inst.func_id}({", ".join(call_inst.args)}) save [{", ".join(call_inst.saved_vars)}]'
+    return call_str if call_inst.dst is None else f'{var_str(call_inst.dst)} = {call_str}'
+  if type(inst) is IRJump:
+    return f'jump B{cast(IRJump, inst).target}'
+  if type(inst) is IRBranch:
+    branch = cast(IRBranch, inst)
+    return f'branch {branch.cond} ? B{branch.then_target} : B{branch.else_target}'
+  if type(inst) is IRReturn:
+    value = cast(IRReturn, inst).value
+    return 'return' if value is None else f'return {value}'
+  raise Exception(f'format_inst: Unknown instruction {inst}.')
+
+def format_ir(module: IRModule, var_table: Optional[VarTable] = None) -> str:
+  """IR as text (for --dump-ir)"""
+  lines: List[str] = []
+  for function in module.functions:
+    kind = 'event' if function.is_event else 'static func' if function.static_frame else 'func'
+    lines.append(f'{kind} {function.name}({", ".join(function.params)}):')
+    for block in function.blocks:
+      lines.append(f'  B{block.block_id}:')
+      for inst in block.insts:
+        lines.append(f'    {format_inst(inst, var_table)}')
+      if block.term is not None:
+        lines.append(f'    {format_inst(block.term, var_table)}')
+    lines.append('')
+  return '\n'.join(lines)
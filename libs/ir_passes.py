@@ -0,0 +1,816 @@
+# python 3.6.8
+from typing import *
+from .my_type import *
+from .tables import *
+from .ir import *
+from .dotnet_ops import *
+from .extern_effects import *
+
+# Optimization passes on the IR (see libs/ir.py)
+# The passes change the IRModule in place and return True if something changed.
+
+def is_temp_var(var_name: VarName) -> bool:
+  """Variables made by the compiler (__binop_0, __call_1, ...)"""
+  return var_name.startswith('__')
+
+def fold_branches(function: IRFunction, const_values: Dict[VarName, Any]) -> bool:
+  """A branch on a constant condition (or with the same targets) becomes a jump."""
+  changed = False
+  for block in function.blocks:
+    if type(block.term) is not IRBranch:
+      continue
+    branch = cast(IRBranch, block.term)
+    if branch.cond in const_values:
+      block.term = IRJump(branch.then_target if const_values[branch.cond] else branch.else_target)
+      changed = True
+    elif branch.then_target == branch.else_target:
+      block.term = IRJump(branch.then_target)
+      changed = True
+  return changed
+
+def thread_jumps(function: IRFunction) -> bool:
+  """
+  A jump to an empty block that only jumps goes directly to the final target.
+  In an event, a jump to an empty block that ends the event is replaced by the end of the event.
+  """
+  def final_target(block_id: BlockId) -> BlockId:
+    visited: Set[BlockId] = set()
+    # (An empty infinite loop stops at the block visited twice.)
+    while block_id not in visited:
+      visited.add(block_id)
+      block = function.block_dict[block_id]
+      if len(block.insts) > 0 or type(block.term) is not IRJump:
+        break
+      block_id = cast(IRJump, block.term).target
+    return block_id
+
+  changed = False
+  for block in function.blocks:
+    if type(block.term) is IRJump:
+      target = final_target(cast(IRJump, block.term).target)
+      target_block = function.block_dict[target]
+      if function.is_event and len(target_block.insts) == 0 and type(target_block.term) is IRReturn:
+        block.term = IRReturn(None)
+        changed = True
+      elif target != cast(IRJump, block.term).target:
+        block.term = IRJump(target)
+        changed = True
+    elif type(block.term) is IRBranch:
+      branch = cast(IRBranch, block.term)
+      then_target = final_target(branch.then_target)
+      else_target = final_target(branch.else_target)
+      if (then_target, else_target) != (branch.then_target, branch.else_target):
+        block.term = IRBranch(branch.cond, then_target, else_target)
+        changed = True
+  return changed
+
+def remove_unreachable_blocks(function: IRFunction) -> bool:
+  """Remove the blocks that cannot be reached from the entry (e.g. the code after return)"""
+  reached = function.reachable_blocks()
+  if len(reached) == len(function.blocks):
+    return False
+  function.set_blocks([block for block in function.blocks if block.block_id in reached])
+  return True
+
+def merge_blocks(function: IRFunction) -> bool:
+  """A block that is only reached by a jump from one block is merged into that block."""
+  preds = function.predecessors()
+  entry_id = function.entry().block_id
+  removed_ids: Set[BlockId] = set()
+  for block in function.blocks:
+    if block.block_id in removed_ids:
+      continue
+    while type(block.term) is IRJump:
+      target = cast(IRJump, block.term).target
+      if target == block.block_id or target == entry_id or len(preds[target]) != 1:
+        break
+      target_block = function.block_dict[target]
+      block.insts.extend(target_block.insts)
+      block.term = target_block.term
+      removed_ids.add(target)
+      for succ_id in block.successors():
+        preds[succ_id] = [block.block_id if pred_id == target else pred_id for pred_id in preds[succ_id]]
+  if len(removed_ids) == 0:
+    return False
+  function.set_blocks([block for block in function.blocks if block.block_id not in removed_ids])
+  return True
+
+def simplify_cfg(function: IRFunction, const_values: Dict[VarName, Any]) -> None:
+  changed = True
+  while changed:
+    changed = fold_branches(function, const_values)
+    changed = thread_jumps(function) or changed
+    changed = remove_unreachable_blocks(function) or changed
+    changed = merge_blocks(function) or changed
+
+def remove_unreachable_functions(module: IRModule) -> List[IRFunction]:
+  """Remove the user-defined functions that no event calls. Returns the removed functions."""
+  function_dict = module.function_dict()
+  reached: Set[str] = set()
+  stack = [function.name for function in module.functions if function.is_event]
+  while len(stack) > 0:
+    name = stack.pop()
+    if name in reached:
+      continue
+    reached.add(name)
+    stack.extend(call_inst.func_id for call_inst in function_dict[name].calls())
+  removed_functions = [function for function in module.functions if function.name not in reached]
+  module.functions = [function for function in module.functions if function.name in reached]
+  return removed_functions
+
+def is_dead_inst(inst: IRInst, read_vars: Set[VarName]) -> bool:
+  """A copy or a pure extern whose result is a temporary that is never read"""
+  if type(inst) is IRCopy:
+    copy_inst = cast(IRCopy, inst)
+    return is_temp_var(copy_inst.dst) and copy_inst.dst not in read_vars
+  if type(inst) is IRExtern:
+    extern_inst = cast(IRExtern, inst)
+    return (extern_inst.dst is not None and is_temp_var(extern_inst.dst) and extern_inst.dst not in read_vars
+            and extern_inst.extern_str in pure_extern_dict and extern_inst.extern_str not in throwing_externs)
+  return False
+
+def remove_dead_insts(module: IRModule) -> bool:
+  changed = False
+  while True:
+    read_vars: Set[VarName] = set()
+    for function in module.functions:
+      for block in function.blocks:
+        for inst in block.insts:
+          read_vars.update(inst_read_vars(inst))
+        read_vars.update(inst_read_vars(cast(IRTerm, block.term)))
+    removed = False
+    for function in module.functions:
+      for block in function.blocks:
+        live_insts = [inst for inst in block.insts if not is_dead_inst(inst, read_vars)]
+        if len(live_insts) != len(block.insts):
+          block.insts = live_insts
+          removed = True
+    if not removed:
+      return changed
+    changed = True
+
+def optimize_module(module: IRModule, const_values: Dict[VarName, Any], var_table: VarTable) -> List[IRFunction]:
+  """
+  Inline small functions, remove the code that can never run or whose result is never used,
+  move loop-invariant externs out of loops and reuse the results of the same externs.
+  Returns the removed functions.
+  """
+  for function in module.functions:
+    simplify_cfg(function, const_values)
+  if inline_functions(module):
+    for function in module.functions:
+      simplify_cfg(function, const_values)
+  removed_functions = remove_unreachable_functions(module)
+  replaced = hoist_loop_invariants(module, var_table)
+  for function in module.functions:
+    replaced = eliminate_common_subexprs(function) or replaced
+  if remove_dead_insts(module) or replaced:
+    # Blocks may have become empty.
+    for function in module.functions:
+      simplify_cfg(function, const_values)
+  return removed_functions
+
+######################
+# Temporary slot coalescing
+
+def compute_live_out(function: IRFunction, candidates: Set[VarName]) -> Dict[BlockId, Set[VarName]]:
+  """Liveness analysis: candidate variables live at the end of each block"""
+  use_sets: Dict[BlockId, Set[VarName]] = {}
+  def_sets: Dict[BlockId, Set[VarName]] = {}
+  for block in function.blocks:
+    uses: Set[VarName] = set(var_name for var_name in inst_read_vars(cast(IRTerm, block.term)) if var_name in candidates)
+    defs: Set[VarName] = set()
+    for inst in reversed(block.insts):
+      if inst.dst is not None and inst.dst in candidates:
+        uses.discard(inst.dst)
+        defs.add(inst.dst)
+      uses.update(var_name for var_name in inst_read_vars(inst) if var_name in candidates)
+    use_sets[block.block_id] = uses
+    def_sets[block.block_id] = defs
+  live_in: Dict[BlockId, Set[VarName]] = {block.block_id: set() for block in function.blocks}
+  live_out: Dict[BlockId, Set[VarName]] = {block.block_id: set() for block in function.blocks}
+  changed = True
+  while changed:
+    changed = False
+    for block in reversed(function.blocks):
+      out_set: Set[VarName] = set()
+      for succ_id in block.successors():
+        out_set |= live_in[succ_id]
+      in_set = use_sets[block.block_id] | (out_set - def_sets[block.block_id])
+      if out_set != live_out[block.block_id] or in_set != live_in[block.block_id]:
+        live_out[block.block_id] = out_set
+        live_in[block.block_id] = in_set
+        changed = True
+  return live_out
+
+def block_live_in(block: BasicBlock, live_out: Set[VarName], candidates: Set[VarName]) -> Set[VarName]:
+  """Candidate variables live at the start of a block"""
+  live = live_out | set(var_name for var_name in inst_read_vars(cast(IRTerm, block.term)) if var_name in candidates)
+  for inst in reversed(block.insts):
+    if inst.dst is not None:
+      live.discard(inst.dst)
+    live.update(var_name for var_name in inst_read_vars(inst) if var_name in candidates)
+  return live
+
+def coalesce_temps(module: IRModule, var_table: VarTable) -> None:
+  """
+  Temporary variables of the same type that are never live at the same time share one slot
+  (__tmp_{type}_{n}), like register allocation.
+  A temporary that is live across a call also interferes with all the temporaries of
+  the called functions (and their callees), because the callee writes its own slots.
+  """
+  temps: List[VarName] = []
+  temp_set: Set[VarName] = set()
+  for function in module.functions:
+    for block in function.blocks:
+      for inst in block.insts:
+        if inst.dst is not None and is_temp_var(inst.dst) and inst.dst not in temp_set:
+          temps.append(inst.dst)
+          temp_set.add(inst.dst)
+  interference: Dict[VarName, Set[VarName]] = {temp: set() for temp in temps}
+  def add_edge(var_a: VarName, var_b: VarName) -> None:
+    if var_a != var_b:
+      interference[var_a].add(var_b)
+      interference[var_b].add(var_a)
+
+  function_temps: Dict[str, Set[VarName]] = {}
+  # (temporaries live across the call, called function)
+  call_sites: List[Tuple[Set[VarName], LabelName]] = []
+  for function in module.functions:
+    live_out = compute_live_out(function, temp_set)
+    defined: Set[VarName] = set()
+    for block in function.blocks:
+      live = live_out[block.block_id] | set(
+        var_name for var_name in inst_read_vars(cast(IRTerm, block.term)) if var_name in temp_set)
+      for inst in reversed(block.insts):
+        if inst.dst is not None and inst.dst in temp_set:
+          defined.add(inst.dst)
+          # The result interferes with the variables live after the instruction.
+          # (The arguments are read before the result is written, so they can share the slot.)
+          for live_var in live:
+            add_edge(inst.dst, live_var)
+          live.discard(inst.dst)
+        if type(inst) is IRCall:
+          call_sites.append((set(live), cast(IRCall, inst).func_id))
+        live.update(var_name for var_name in inst_read_vars(inst) if var_name in temp_set)
+    function_temps[function.name] = defined
+
+  function_dict = module.function_dict()
+  callee_closures: Dict[str, Set[str]] = {}
+  def callee_closure(name: str) -> Set[str]:
+    if name not in callee_closures:
+      closure: Set[str] = set()
+      stack = [name]
+      while len(stack) > 0:
+        callee_name = stack.pop()
+        if callee_name in closure or callee_name not in function_dict:
+          continue
+        closure.add(callee_name)
+        stack.extend(call_inst.func_id for call_inst in function_dict[callee_name].calls())
+      callee_closures[name] = closure
+    return callee_closures[name]
+  for live, func_id in call_sites:
+    for callee_name in callee_closure(func_id):
+      for callee_temp in function_temps[callee_name]:
+        for live_var in live:
+          add_edge(live_var, callee_temp)
+
+  # Greedy coloring in the order of appearance
+  slot_map: Dict[VarName, VarName] = {}
+  for temp in temps:
+    type_name = var_table.get_var_type(temp)
+    used_slots = set(slot_map[neighbor] for neighbor in interference[temp] if neighbor in slot_map)
+    slot_index = 0
+    while VarName(f'__tmp_{type_name}_{slot_index}') in used_slots:
+      slot_index += 1
+    slot_map[temp] = VarName(f'__tmp_{type_name}_{slot_index}')
+
+  for function in module.functions:
+    for block in function.blocks:
+      block.insts = [cast(IRInst, rename_inst_vars(inst, slot_map)) for inst in block.insts]
+      block.term = cast(IRTerm, rename_inst_vars(cast(IRTerm, block.term), slot_map))
+  for temp, slot in slot_map.items():
+    if not var_table.exist_var(slot):
+      var_table.add_var(slot, var_table.get_var_type(temp), 'null')
+    var_table.remove_var(temp)
+
+######################
+# Common subexpression elimination
+
+# (extern, arguments, the variable that holds the result)
+AvailExpr = Tuple[ExternStr, Tuple[VarName, ...], VarName]
+
+def kill_var(avail: Set[AvailExpr], var_name: VarName) -> None:
+  """The expressions that use or are held by a written variable are no longer available."""
+  for expr in [expr for expr in avail if var_name == expr[2] or var_name in expr[1]]:
+    avail.discard(expr)
+
+def kill_reads(avail: Set[AvailExpr]) -> None:
+  """After a side effect, the results of 'read' externs (object state) are no longer available."""
+  for expr in [expr for expr in avail if get_extern_effect(expr[0]) == 'read']:
+    avail.discard(expr)
+
+def transfer_avail(avail: Set[AvailExpr], inst: IRInst) -> None:
+  if type(inst) is IRCopy:
+    kill_var(avail, cast(IRCopy, inst).dst)
+  elif type(inst) is IRExtern:
+    extern_inst = cast(IRExtern, inst)
+    effect = get_extern_effect(extern_inst.extern_str)
+    if effect == 'write':
+      kill_reads(avail)
+      # The arguments can be changed in place (ex: Vector3.Normalize())
+      for arg in extern_inst.args:
+        kill_var(avail, arg)
+    if extern_inst.dst is not None:
+      kill_var(avail, extern_inst.dst)
+      if effect != 'write' and extern_inst.dst not in extern_inst.args:
+        avail.add((extern_inst.extern_str, extern_inst.args, extern_inst.dst))
+  elif type(inst) is IRCall:
+    # A user-defined function can have any side effect and write any variable,
+    # except the temporaries of the caller.
+    kill_reads(avail)
+    for expr in [expr for expr in avail if not all(is_temp_var(var_name) for var_name in expr[1] + (expr[2],))]:
+      avail.discard(expr)
+    call_inst = cast(IRCall, inst)
+    if call_inst.dst is not None:
+      kill_var(avail, call_inst.dst)
+
+def eliminate_common_subexprs(function: IRFunction) -> bool:
+  """
+  An extern without side effects ('pure' / 'read') whose result is already held by a variable
+  on every path (available expressions analysis) is replaced by a copy of the variable.
+  """
+  all_exprs: Set[AvailExpr] = set()
+  for block in function.blocks:
+    for inst in block.insts:
+      if type(inst) is IRExtern:
+        extern_inst = cast(IRExtern, inst)
+        if extern_inst.dst is not None:
+          all_exprs.add((extern_inst.extern_str, extern_inst.args, extern_inst.dst))
+  entry_id = function.entry().block_id
+  preds = function.predecessors()
+  avail_in: Dict[BlockId, Set[AvailExpr]] = {}
+  avail_out: Dict[BlockId, Set[AvailExpr]] = {block.block_id: set(all_exprs) for block in function.blocks}
+  changed = True
+  while changed:
+    changed = False
+    for block in function.blocks:
+      avail: Set[AvailExpr] = set()
+      if block.block_id != entry_id:
+        pred_outs = [avail_out[pred_id] for pred_id in preds[block.block_id]]
+        avail = set.intersection(*pred_outs) if len(pred_outs) > 0 else set()
+      avail_in[block.block_id] = set(avail)
+      for inst in block.insts:
+        transfer_avail(avail, inst)
+      if avail != avail_out[block.block_id]:
+        avail_out[block.block_id] = avail
+        changed = True
+
+  replaced = False
+  for block in function.blocks:
+    avail = avail_in[block.block_id]
+    new_insts: List[IRInst] = []
+    for inst in block.insts:
+      if type(inst) is IRExtern:
+        extern_inst = cast(IRExtern, inst)
+        if extern_inst.dst is not None and get_extern_effect(extern_inst.extern_str) != 'write':
+          holders = [expr[2] for expr in avail if expr[0] == extern_inst.extern_str and expr[1] == extern_inst.args]
+          if len(holders) > 0:
+            replaced = True
+            holder = min(holders)
+            if holder == extern_inst.dst:
+              # The variable already holds the value.
+              continue
+            inst = IRCopy(extern_inst.dst, holder)
+      transfer_avail(avail, inst)
+      new_insts.append(inst)
+    block.insts = new_insts
+  return replaced
+
+######################
+# Loop-invariant code motion
+
+def compute_dominators(function: IRFunction) -> Dict[BlockId, Set[BlockId]]:
+  """Blocks that dominate each block (including itself)"""
+  entry_id = function.entry().block_id
+  all_ids = set(block.block_id for block in function.blocks)
+  preds = function.predecessors()
+  doms: Dict[BlockId, Set[BlockId]] = {block_id: set(all_ids) for block_id in all_ids}
+  doms[entry_id] = {entry_id}
+  changed = True
+  while changed:
+    changed = False
+    for block in function.blocks:
+      if block.block_id == entry_id:
+        continue
+      pred_doms = [doms[pred_id] for pred_id in preds[block.block_id]]
+      new_doms = (set.intersection(*pred_doms) if len(pred_doms) > 0 else set()) | {block.block_id}
+      if new_doms != doms[block.block_id]:
+        doms[block.block_id] = new_doms
+        changed = True
+  return doms
+
+def find_loops(function: IRFunction) -> List[Tuple[BlockId, Set[BlockId]]]:
+  """Natural loops (header, blocks), inner loops first"""
+  doms = compute_dominators(function)
+  preds = function.predecessors()
+  loops: Dict[BlockId, Set[BlockId]] = {}
+  for block in function.blocks:
+    for succ_id in block.successors():
+      if succ_id not in doms[block.block_id]:
+        continue
+      # Back edge block -> succ: the blocks that reach the block without passing the header
+      body = loops.setdefault(succ_id, {succ_id})
+      stack = [block.block_id]
+      while len(stack) > 0:
+        block_id = stack.pop()
+        if block_id in body:
+          continue
+        body.add(block_id)
+        stack.extend(preds[block_id])
+  return sorted(loops.items(), key=lambda loop: len(loop[1]))
+
+def get_preheader(function: IRFunction, header_id: BlockId, body: Set[BlockId], module: IRModule) -> BasicBlock:
+  """
+  The block that runs just before the loop.
+  A new block is inserted before the header unless the header has only one entry jump.
+  """
+  outside_preds = [pred_id for pred_id in function.predecessors()[header_id] if pred_id not in body]
+  if len(outside_preds) == 1:
+    pred_block = function.block_dict[outside_preds[0]]
+    if type(pred_block.term) is IRJump:
+      return pred_block
+  preheader = BasicBlock(module.new_block_id())
+  preheader.term = IRJump(header_id)
+  def redirect(target: BlockId) -> BlockId:
+    return preheader.block_id if target == header_id else target
+  for pred_id in outside_preds:
+    pred_block = function.block_dict[pred_id]
+    if type(pred_block.term) is IRJump:
+      pred_block.term = IRJump(preheader.block_id)
+    elif type(pred_block.term) is IRBranch:
+      branch = cast(IRBranch, pred_block.term)
+      pred_block.term = IRBranch(branch.cond, redirect(branch.then_target), redirect(branch.else_target))
+  blocks = list(function.blocks)
+  blocks.insert(blocks.index(function.block_dict[header_id]), preheader)
+  function.set_blocks(blocks)
+  return preheader
+
+def is_hoistable_extern(inst: IRInst) -> bool:
+  """
+  Pure externs known not to throw (The loop may run zero times,
+  and the state read by 'read' externs may change in the loop.)
+  """
+  if type(inst) is not IRExtern or inst.dst is None:
+    return False
+  extern_str = cast(IRExtern, inst).extern_str
+  return get_extern_effect(extern_str) == 'pure' and not extern_can_throw(extern_str)
+
+def hoist_loop(function: IRFunction, header_id: BlockId, body: Set[BlockId],
+               module: IRModule, var_table: VarTable, mod_sets: Dict[str, Set[VarName]]) -> bool:
+  loop_blocks = [block for block in function.blocks if block.block_id in body]
+  def_counts: Dict[VarName, int] = {}
+  # Variables written in the loop other than by the results:
+  # by the called functions (all variables except the parameters are global)
+  # and in place by 'write' externs (ex: Vector3.Normalize())
+  clobbered: Set[VarName] = set()
+  for block in loop_blocks:
+    for inst in block.insts:
+      if inst.dst is not None:
+        def_counts[inst.dst] = def_counts.get(inst.dst, 0) + 1
+      if type(inst) is IRCall:
+        clobbered |= mod_sets.get(cast(IRCall, inst).func_id, set())
+      elif type(inst) is IRExtern:
+        extern_inst = cast(IRExtern, inst)
+        if get_extern_effect(extern_inst.extern_str) == 'write':
+          clobbered.update(extern_inst.args)
+  # Variables live at the loop entry (the value from before the loop is used)
+  # or at the loop exits cannot simply be written before the loop.
+  live_out = compute_live_out(function, set(def_counts))
+  entry_live = block_live_in(function.block_dict[header_id], live_out[header_id], set(def_counts))
+  for block_id in body:
+    for succ_id in function.block_dict[block_id].successors():
+      if succ_id not in body:
+        entry_live |= block_live_in(function.block_dict[succ_id], live_out[succ_id], set(def_counts))
+
+  hoisted: List[IRInst] = []
+  changed = True
+  while changed:
+    changed = False
+    for block in loop_blocks:
+      new_insts: List[IRInst] = []
+      for inst in block.insts:
+        if is_hoistable_extern(inst) and all(
+            def_counts.get(arg, 0) == 0 and arg not in clobbered for arg in cast(IRExtern, inst).args):
+          dst = cast(VarName, inst.dst)
+          if is_temp_var(dst) and def_counts[dst] == 1 and dst not in clobbered and dst not in entry_live:
+            hoisted.append(inst)
+            def_counts[dst] = 0
+            changed = True
+            continue
+          # Otherwise the variable keeps its assignment in the loop, copied from a new temporary.
+          temp_index = 0
+          while var_table.exist_var(VarName(f'__licm_{temp_index}')):
+            temp_index += 1
+          temp = VarName(f'__licm_{temp_index}')
+          var_table.add_var(temp, var_table.get_var_type(dst), 'null')
+          extern_inst = cast(IRExtern, inst)
+          hoisted.append(IRExtern(extern_inst.extern_str, extern_inst.args, temp))
+          inst = IRCopy(dst, temp)
+          changed = True
+        new_insts.append(inst)
+      block.insts = new_insts
+  if len(hoisted) == 0:
+    return False
+  preheader = get_preheader(function, header_id, body, module)
+  preheader.insts.extend(hoisted)
+  return True
+
+def compute_mod_sets(module: IRModule) -> Dict[str, Set[VarName]]:
+  """
+  Mod analysis on the call graph: the variables a function and its callees can write
+  (results, parameters popped at the entry, and ret_addr popped at the return).
+  """
+  direct: Dict[str, Set[VarName]] = {}
+  for function in module.functions:
+    mod: Set[VarName] = set()
+    if not function.is_event and not function.static_frame:
+      mod.update(function.params)
+      mod.add(VarName('ret_addr'))
+    for block in function.blocks:
+      for inst in block.insts:
+        if inst.dst is not None:
+          mod.add(inst.dst)
+    direct[function.name] = mod
+  function_dict = module.function_dict()
+  mod_sets: Dict[str, Set[VarName]] = {name: set(mod) for name, mod in direct.items()}
+  changed = True
+  while changed:
+    changed = False
+    for function in module.functions:
+      for call_inst in function.calls():
+        if call_inst.func_id in function_dict and not mod_sets[call_inst.func_id] <= mod_sets[function.name]:
+          mod_sets[function.name] |= mod_sets[call_inst.func_id]
+          changed = True
+  return mod_sets
+
+def hoist_loop_invariants(module: IRModule, var_table: VarTable) -> bool:
+  """
+  Pure extern calls (known not to throw) whose arguments do not change in a loop are moved
+  to the block before the loop (the preheader), so they run only once.
+  """
+  hoisted = False
+  mod_sets = compute_mod_sets(module)
+  for function in module.functions:
+    # The CFG changes when a preheader is inserted, so the loops are found again.
+    done_headers: Set[BlockId] = set()
+    while True:
+      loops = [loop for loop in find_loops(function) if loop[0] not in done_headers]
+      if len(loops) == 0:
+        break
+      header_id, body = loops[0]
+      done_headers.add(header_id)
+      if hoist_loop(function, header_id, body, module, var_table, mod_sets):
+        hoisted = True
+  return hoisted
+
+######################
+# Inline expansion
+
+# A call is inlined if the code grows by at most INLINE_GROWTH_LIMIT Udon instructions
+# (A small function is often smaller than the call sequence.)
+INLINE_GROWTH_LIMIT = 16
+# Total growth of the code by the inlining without @inline (Udon instructions)
+INLINE_BUDGET = 256
+
+def inst_size(inst: Union[IRInst, IRTerm]) -> int:
+  """Number of Udon instructions after lowering (estimated)"""
+  if type(inst) is IRCopy:
+    return 3
+  if type(inst) is IRExtern:
+    extern_inst = cast(IRExtern, inst)
+    return len(extern_inst.args) + (0 if extern_inst.dst is None else 1) + 1
+  if type(inst) is IRCall:
+    # PUSH saved, return address, args; JUMP; POP value, saved
+    call_inst = cast(IRCall, inst)
+    return 2 + 3 * len(call_inst.saved_vars) + len(call_inst.args) + (0 if call_inst.dst is None else 2)
+  if type(inst) is IRBranch:
+    return 3
+  if type(inst) is IRReturn:
+    return 4 if cast(IRReturn, inst).value is not None else 3
+  return 1
+
+def function_body_size(function: IRFunction) -> int:
+  return sum(inst_size(inst) for block in function.blocks for inst in block.insts) + sum(
+    inst_size(cast(IRTerm, block.term)) for block in function.blocks)
+
+def find_recursive_functions(module: IRModule) -> Set[str]:
+  """Functions that can call themselves (directly or through other functions)"""
+  function_dict = module.function_dict()
+  recursive: Set[str] = set()
+  for function in module.functions:
+    reached: Set[str] = set()
+    stack = [call_inst.func_id for call_inst in function.calls()]
+    while len(stack) > 0:
+      name = stack.pop()
+      if name in reached or name not in function_dict:
+        continue
+      reached.add(name)
+      stack.extend(call_inst.func_id for call_inst in function_dict[name].calls())
+    if function.name in reached:
+      recursive.add(function.name)
+  return recursive
+
+def callee_first_order(module: IRModule) -> List[IRFunction]:
+  """Functions in the post-order of the call graph (callees before callers)"""
+  function_dict = module.function_dict()
+  order: List[IRFunction] = []
+  visited: Set[str] = set()
+  def visit(function: IRFunction) -> None:
+    visited.add(function.name)
+    for call_inst in function.calls():
+      if call_inst.func_id in function_dict and call_inst.func_id not in visited:
+        visit(function_dict[call_inst.func_id])
+    order.append(function)
+  for function in module.functions:
+    if function.name not in visited:
+      visit(function)
+  return order
+
+def inline_call(module: IRModule, caller: IRFunction, block: BasicBlock, inst_index: int, callee: IRFunction) -> None:
+  """
+  Replace the call at block.insts[inst_index] with a copy of the callee's blocks:
+  the arguments are copied to the parameters, and each return copies the value to
+  the result variable and jumps to the rest of the block.
+  """
+  call_inst = cast(IRCall, block.insts[inst_index])
+  first_id = module.new_block_id()
+  id_map = {callee_block.block_id: first_id + i for i, callee_block in enumerate(callee.blocks)}
+  cont_block = BasicBlock(first_id + len(callee.blocks))
+  cont_block.insts = block.insts[inst_index + 1:]
+  cont_block.term = block.term
+  block.insts = block.insts[:inst_index] + [
+    IRCopy(param, arg) for param, arg in zip(callee.params, call_inst.args)]
+  block.term = IRJump(id_map[callee.entry().block_id])
+
+  new_blocks: List[BasicBlock] = []
+  for callee_block in callee.blocks:
+    new_block = BasicBlock(id_map[callee_block.block_id])
+    for inst in callee_block.insts:
+      if type(inst) is IRCall:
+        # The variables of the caller are saved too.
+        inner_call = cast(IRCall, inst)
+        inst = inner_call._replace(saved_vars=tuple(
+          dict.fromkeys(inner_call.saved_vars + tuple(caller.env_vars))))
+      new_block.insts.append(inst)
+    term = cast(IRTerm, callee_block.term)
+    if type(term) is IRJump:
+      new_block.term = IRJump(id_map[cast(IRJump, term).target])
+    elif type(term) is IRBranch:
+      branch = cast(IRBranch, term)
+      new_block.term = IRBranch(branch.cond, id_map[branch.then_target], id_map[branch.else_target])
+    else:
+      value = cast(IRReturn, term).value
+      if call_inst.dst is not None and value is not None:
+        new_block.insts.append(IRCopy(call_inst.dst, value))
+      new_block.term = IRJump(cont_block.block_id)
+    new_blocks.append(new_block)
+
+  blocks = list(caller.blocks)
+  block_index = blocks.index(block) + 1
+  caller.set_blocks(blocks[:block_index] + new_blocks + [cont_block] + blocks[block_index:])
+
+def inline_functions(module: IRModule, budget: int = INLINE_BUDGET) -> bool:
+  """
+  Inline expansion of user-defined functions.
+  @inline functions are always inlined and @noinline functions never.
+  Otherwise a call is inlined if the code grows by at most INLINE_GROWTH_LIMIT
+  (a function called only once is removed after inlining, so it counts as shrinking),
+  within the budget for the whole module. Recursive functions are not inlined
+  (UdonCompiler.check_inline_recursion() rejects @inline on them).
+  """
+  function_dict = module.function_dict()
+  recursive = find_recursive_functions(module)
+  call_counts: Dict[str, int] = {}
+  for function in module.functions:
+    for call_inst in function.calls():
+      call_counts[call_inst.func_id] = call_counts.get(call_inst.func_id, 0) + 1
+  inlined = False
+  # Callees are expanded first, so that the size of a callee includes its inlined calls.
+  for caller in callee_first_order(module):
+    block_index = 0
+    while block_index < len(caller.blocks):
+      block = caller.blocks[block_index]
+      block_index += 1
+      for inst_index, inst in enumerate(block.insts):
+        if type(inst) is not IRCall or cast(IRCall, inst).func_id not in function_dict:
+          continue
+        callee = function_dict[cast(IRCall, inst).func_id]
+        if callee.inline_hint is False or callee.name in recursive or callee is caller:
+          continue
+        if callee.inline_hint is not True:
+          # The call sequence, the parameter pops and the return are replaced with copies.
+          growth = (function_body_size(callee) + 3 * len(callee.params)
+                    + (3 if inst.dst is not None else 0) - inst_size(inst))
+          if call_counts[callee.name] == 1:
+            growth -= function_body_size(callee) + 2 * len(callee.params)
+          if growth > INLINE_GROWTH_LIMIT or growth > budget:
+            continue
+          budget -= max(growth, 0)
+        inline_call(module, caller, block, inst_index, callee)
+        call_counts[callee.name] -= 1
+        for inner_call in callee.calls():
+          call_counts[inner_call.func_id] = call_counts.get(inner_call.func_id, 0) + 1
+        inlined = True
+        # The rest of the block is in the next block (inlined blocks come first).
+        break
+  return inlined
+
+######################
+# Static-frame calling convention
+
+def use_static_frames(module: IRModule, var_table: VarTable) -> None:
+  """
+  A function that is not recursive (by the call graph) has at most one activation at a time,
+  so its parameters and return value can live in fixed variables:
+    caller: param = arg ...; call f(); dst = f__ret
+    callee: f__ret = value; return
+  The stack is used only for the return address (popped to f__ret_addr at the entry).
+  The variables of the caller are not saved, because the callee (and its callees)
+  can never run the caller again and write its parameters.
+  """
+  recursive = find_recursive_functions(module)
+  static_functions: Dict[str, IRFunction] = {}
+  for function in module.functions:
+    if not function.is_event and function.name not in recursive:
+      function.static_frame = True
+      static_functions[function.name] = function
+      var_table.add_var(static_ret_addr_var(function.name), UdonTypeName('UInt32'), 'null')
+
+  # The type of the return value is taken from a returned value or a call result.
+  def add_ret_value_var(func_id: str, value: VarName) -> VarName:
+    ret_value = static_ret_value_var(func_id)
+    if not var_table.exist_var(ret_value):
+      var_table.add_var(ret_value, var_table.get_var_type(value), 'null')
+    return ret_value
+
+  for function in module.functions:
+    for block in function.blocks:
+      new_insts: List[IRInst] = []
+      for inst in block.insts:
+        if type(inst) is IRCall and cast(IRCall, inst).func_id in static_functions:
+          call_inst = cast(IRCall, inst)
+          callee = static_functions[call_inst.func_id]
+          new_insts.extend(IRCopy(param, arg) for param, arg in zip(callee.params, call_inst.args))
+          new_insts.append(IRCall(call_inst.func_id, (), None, ()))
+          if call_inst.dst is not None:
+            new_insts.append(IRCopy(call_inst.dst, add_ret_value_var(call_inst.func_id, call_inst.dst)))
+        else:
+          new_insts.append(inst)
+      block.insts = new_insts
+      if function.static_frame and type(block.term) is IRReturn:
+        value = cast(IRReturn, block.term).value
+        if value is not None:
+          block.insts.append(IRCopy(add_ret_value_var(function.name, value), value))
+          block.term = IRReturn(None)
+
+######################
+# Save / restore elision
+
+def elide_call_saves(module: IRModule) -> None:
+  """
+  A call with the stack convention saves only the variables of the caller that
+  the callee can write (mod set) and that are read after the call (liveness).
+  The result variable of the call is never restored, because the restore would
+  overwrite the result.
+  ret_addr is a candidate only in a function that returns through it; an event ends
+  with JUMP 0xFFFFFFFC and a static-frame function has its own return address.
+  """
+  mod_sets = compute_mod_sets(module)
+  for function in module.functions:
+    candidates = set(function.env_vars)
+    if not function.is_event and not function.static_frame:
+      candidates.add(VarName('ret_addr'))
+    # The saved variables themselves must not count as reads.
+    for block in function.blocks:
+      block.insts = [
+        cast(IRCall, inst)._replace(saved_vars=()) if type(inst) is IRCall else inst for inst in block.insts]
+    live_out = compute_live_out(function, candidates)
+    for block in function.blocks:
+      live = live_out[block.block_id] | set(
+        var_name for var_name in inst_read_vars(cast(IRTerm, block.term)) if var_name in candidates)
+      new_insts: List[IRInst] = []
+      for inst in reversed(block.insts):
+        if type(inst) is IRCall and cast(IRCall, inst).func_id in mod_sets:
+          call_inst = cast(IRCall, inst)
+          clobbered = live & mod_sets[call_inst.func_id]
+          clobbered.discard(cast(VarName, call_inst.dst))
+          # ret_addr first, then in the order of env_vars (as pushed)
+          saved_vars = [VarName('ret_addr')] if VarName('ret_addr') in clobbered else []
+          saved_vars.extend(var_name for var_name in function.env_vars if var_name in clobbered)
+          inst = call_inst._replace(saved_vars=tuple(saved_vars))
+        if inst.dst is not None:
+          live.discard(inst.dst)
+        live.update(var_name for var_name in inst_read_vars(inst) if var_name in candidates)
+        new_insts.append(inst)
+      block.insts = list(reversed(new_insts))
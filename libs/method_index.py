@@ -0,0 +1,189 @@
+# python 3.6.8
+import sys
+import os
+import mmap
+import struct
+import zlib
+import hashlib
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+from .my_type import *
+
+# Precompiled Udon extern signature index (udon_funcs_data.idx)
+#
+# udon_funcs_data.py is a 2.7MB dict literal. eval() of it costs seconds and
+# hundreds of MB of objects, so the build step converts it into a binary file
+# that is memory-mapped and looked up without materialising the entries.
+#
+# File layout (little endian):
+#   header  : magic, version, record count, slot count,
+#             slots offset, records offset, source size, source fingerprint (sha1)
+#   slots   : n_slots * (u32 hash, u32 record offset), open addressing
+#   records : sorted by key, u16 key length, u16 value length, key, value
+#
+# key   = "{method_kind}\t{module_type}\t{method_name}\t{arg_type},{arg_type}..."
+# value = "{ret_type}\t{extern_str}"
+
+MethodKey = Tuple[UdonMethodKind, UdonTypeName, UdonMethodName, Tuple[UdonTypeName, ...]]
+MethodValue = Tuple[UdonTypeName, ExternStr]
+
+INDEX_MAGIC = b'UDONIDX1'
+INDEX_VERSION = 1
+HEADER_FORMAT = '<8sIIIIIQ20s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SLOT_FORMAT = '<II'
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+RECORD_HEAD_FORMAT = '<HH'
+RECORD_HEAD_SIZE = struct.calcsize(RECORD_HEAD_FORMAT)
+EMPTY_SLOT = 0xFFFFFFFF
+
+
+def encode_key(key: MethodKey) -> bytes:
+  method_kind, udon_module_type, method_name, arg_types = key
+  return f'{method_kind}\t{udon_module_type}\t{method_name}\t{",".join(arg_types)}'.encode('utf-8')
+
+def decode_key(key_bytes: bytes) -> MethodKey:
+  method_kind, udon_module_type, method_name, arg_types = key_bytes.decode('utf-8').split('\t')
+  return (
+    cast(UdonMethodKind, method_kind),
+    UdonTypeName(udon_module_type),
+    UdonMethodName(method_name),
+    tuple(UdonTypeName(arg_type) for arg_type in arg_types.split(',') if arg_type != ''))
+
+def encode_value(value: MethodValue) -> bytes:
+  ret_type, extern_str = value
+  return f'{ret_type}\t{extern_str}'.encode('utf-8')
+
+def decode_value(value_bytes: bytes) -> MethodValue:
+  ret_type, extern_str = value_bytes.decode('utf-8').split('\t')
+  return (UdonTypeName(ret_type), ExternStr(extern_str))
+
+def key_hash(key_bytes: bytes) -> int:
+  return zlib.crc32(key_bytes) & 0xFFFFFFFF
+
+def source_fingerprint(data_path: str) -> bytes:
+  with open(data_path, 'rb') as f:
+    return hashlib.sha1(f.read()).digest()
+
+
+def build_method_index(data_path: str, index_path: str) -> int:
+  """
+  Convert udon_funcs_data.py into the binary index. Returns the record count.
+  """
+  with open(data_path, encoding="utf-8") as f:
+    udon_method_dict = eval(f.read())
+  source_size = os.path.getsize(data_path)
+  fingerprint = source_fingerprint(data_path)
+
+  # Only (kind, module, method, (arg, ...)) -> (ret, extern) entries can be looked up.
+  # The 'Unknown' entries have a different shape and are skipped.
+  records: List[Tuple[bytes, bytes]] = sorted(
+    (encode_key(key), encode_value(value))
+    for key, value in udon_method_dict.items()
+    if len(key) == 4 and type(value) is tuple)
+
+  n_slots = 1
+  while n_slots < len(records) * 2:
+    n_slots *= 2
+  slots_offset = HEADER_SIZE
+  records_offset = slots_offset + n_slots * SLOT_SIZE
+
+  record_chunks: List[bytes] = []
+  slots: List[Tuple[int, int]] = [(0, EMPTY_SLOT)] * n_slots
+  record_pos = 0
+  for key_bytes, value_bytes in records:
+    h = key_hash(key_bytes)
+    slot = h & (n_slots - 1)
+    while slots[slot][1] != EMPTY_SLOT:
+      slot = (slot + 1) & (n_slots - 1)
+    slots[slot] = (h, record_pos)
+    record = struct.pack(RECORD_HEAD_FORMAT, len(key_bytes), len(value_bytes)) + key_bytes + value_bytes
+    record_chunks.append(record)
+    record_pos += len(record)
+
+  tmp_path = f'{index_path}.tmp'
+  with open(tmp_path, 'wb') as index_file:
+    index_file.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, len(records),
+                                 n_slots, slots_offset, records_offset, source_size, fingerprint))
+    index_file.write(b''.join(struct.pack(SLOT_FORMAT, h, pos) for h, pos in slots))
+    index_file.write(b''.join(record_chunks))
+  os.replace(tmp_path, index_path)
+  return len(records)
+
+
+class MethodIndex:
+  """
+  Read-only, memory-mapped view of udon_funcs_data.idx
+  """
+  count: int
+  n_slots: int
+  slots_offset: int
+  records_offset: int
+  source_size: int
+  fingerprint: bytes
+
+  def __init__(self, index_path: str) -> None:
+    with open(index_path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.count, self.n_slots, self.slots_offset, self.records_offset, \
+      self.source_size, self.fingerprint = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+      self.mm.close()
+      raise Exception(f'MethodIndex: {index_path} is not a method index (version {INDEX_VERSION}).')
+
+  @staticmethod
+  def is_fresh(index_path: str, data_path: str) -> bool:
+    """True if the index was built from the current source data (same size and sha1)"""
+    if not os.path.exists(index_path):
+      return False
+    if not os.path.exists(data_path):
+      return True
+    # The mtime is not enough: a copied or checked-out source can be older than a stale index.
+    with open(index_path, 'rb') as index_file:
+      header = index_file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+      return False
+    magic, version, _, _, _, _, source_size, fingerprint = struct.unpack(HEADER_FORMAT, header)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+      return False
+    return source_size == os.path.getsize(data_path) and fingerprint == source_fingerprint(data_path)
+
+  def lookup(self, key: MethodKey) -> Optional[MethodValue]:
+    key_bytes = encode_key(key)
+    h = key_hash(key_bytes)
+    mask = self.n_slots - 1
+    slot = h & mask
+    while True:
+      slot_hash, record_pos = struct.unpack_from(SLOT_FORMAT, self.mm, self.slots_offset + slot * SLOT_SIZE)
+      if record_pos == EMPTY_SLOT:
+        return None
+      if slot_hash == h:
+        record_key, value_bytes = self._read_record(record_pos)
+        if record_key == key_bytes:
+          return decode_value(value_bytes)
+      slot = (slot + 1) & mask
+
+  def items(self) -> Iterator[Tuple[MethodKey, MethodValue]]:
+    """Iterate over all entries in key order"""
+    pos = 0
+    for _ in range(self.count):
+      key_bytes, value_bytes = self._read_record(pos)
+      yield (decode_key(key_bytes), decode_value(value_bytes))
+      pos += RECORD_HEAD_SIZE + len(key_bytes) + len(value_bytes)
+
+  def _read_record(self, record_pos: int) -> Tuple[bytes, bytes]:
+    start = self.records_offset + record_pos
+    key_len, value_len = struct.unpack_from(RECORD_HEAD_FORMAT, self.mm, start)
+    key_start = start + RECORD_HEAD_SIZE
+    value_start = key_start + key_len
+    return (self.mm[key_start:value_start], self.mm[value_start:value_start + value_len])
+
+
+if __name__ == '__main__':
+  # Build step:
+  #   python -m libs.method_index [udon_funcs_data.py] [udon_funcs_data.idx]
+  base_dir = os.path.join(os.path.dirname(__file__), '..')
+  data_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, 'udon_funcs_data.py')
+  index_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base_dir, 'udon_funcs_data.idx')
+  count = build_method_index(data_path, index_path)
+  print(f'{index_path}: {count} entries')
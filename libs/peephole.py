@@ -0,0 +1,187 @@
+# python 3.6.8
+from typing import *
+from .my_type import *
+from .tables import *
+from .udon_assembly import *
+
+# Peephole optimization of the lowered instruction records (UdonAssembly.insts)
+#
+# Rules (each can be turned on / off):
+#   temp_copy: PUSH args..; PUSH __tmp; EXTERN f; PUSH __tmp; PUSH x; COPY
+#              -> PUSH args..; PUSH x; EXTERN f  (__tmp is used only there, the same type as x)
+#              (only if f returns a value: the last PUSH of a void extern is an argument,
+#               and never for a constant (__const_*, __true, __false))
+#   self_copy: PUSH a; PUSH a; COPY -> (removed)
+#   push_pop:  PUSH a; POP -> (removed)
+#   jump_next: JUMP next -> (removed), PUSH c; JUMP_IF_FALSE next -> (removed)
+#
+# A pattern never includes a jump target, except at its first instruction.
+
+PEEPHOLE_RULES: Tuple[str, ...] = ('temp_copy', 'self_copy', 'push_pop', 'jump_next')
+
+def extern_has_result(extern_operand: str) -> bool:
+  """
+  The last PUSH before the EXTERN is the result variable
+  ("SystemInt32.__op_Addition__SystemInt32_SystemInt32__SystemInt32").
+  For a void extern it is the last argument.
+  """
+  return not extern_operand.strip('"').endswith('__SystemVoid')
+
+def is_const_var_name(var_name: str) -> bool:
+  """Variables of constants (never written)"""
+  return var_name.startswith('__const') or var_name in ('__true', '__false')
+
+class PeepholeReport:
+  # rule -> the number of times it was applied
+  rule_counts: Dict[str, int]
+  removed_insts: int
+  removed_bytes: int
+  # code size before the peephole optimization
+  total_insts: int
+  total_bytes: int
+
+  def __init__(self) -> None:
+    self.rule_counts = {}
+    self.removed_insts = 0
+    self.removed_bytes = 0
+    self.total_insts = 0
+    self.total_bytes = 0
+
+  def __str__(self) -> str:
+    lines = [
+      f'peephole: {self.removed_insts} / {self.total_insts} instructions, '
+      f'{self.removed_bytes} / {self.total_bytes} bytes removed',
+    ]
+    for rule, count in self.rule_counts.items():
+      lines.append(f'  {rule}: {count}')
+    return '\n'.join(lines)
+
+class PeepholeOptimizer:
+  uasm: UdonAssembly
+  rules: Tuple[str, ...]
+  report: PeepholeReport
+  # indexes of the instructions at labels (jump targets)
+  label_indexes: Set[int]
+  # index of a JUMP / JUMP_IF_FALSE -> index of the target
+  jump_targets: Dict[int, int]
+  # variable -> the number of PUSH operands that refer to it
+  use_counts: Dict[str, int]
+  removed: Set[int]
+
+  def __init__(self, uasm: UdonAssembly, rules: Tuple[str, ...] = PEEPHOLE_RULES) -> None:
+    for rule in rules:
+      if rule not in PEEPHOLE_RULES:
+        raise Exception(f'peephole: Unknown rule {rule}. (rules: {", ".join(PEEPHOLE_RULES)})')
+    self.uasm = uasm
+    self.rules = rules
+    self.report = PeepholeReport()
+    self.label_indexes = set()
+    self.jump_targets = {}
+    self.use_counts = {}
+    self.removed = set()
+
+  def run(self) -> PeepholeReport:
+    """Apply the rules until nothing changes (Call before resolve_labels)"""
+    self.report.total_insts = len(self.uasm.insts)
+    self.report.total_bytes = sum(inst_size_dict[opcode] for opcode, _ in self.uasm.insts)
+    while self.run_once():
+      pass
+    return self.report
+
+  def count(self, rule: str, indexes: List[int]) -> None:
+    self.report.rule_counts[rule] = self.report.rule_counts.get(rule, 0) + 1
+    for index in indexes:
+      self.removed.add(index)
+      self.report.removed_insts += 1
+      self.report.removed_bytes += inst_size_dict[self.uasm.insts[index][0]]
+
+  def is_free(self, start: int, end: int) -> bool:
+    """No instruction in [start, end) is removed or a jump target (except start)"""
+    if end > len(self.uasm.insts):
+      return False
+    for index in range(start, end):
+      if index in self.removed or (index != start and index in self.label_indexes):
+        return False
+    return True
+
+  def run_once(self) -> bool:
+    insts = self.uasm.insts
+    self.label_indexes = set(self.uasm.label_dict.values())
+    self.jump_targets = {
+      inst_index: self.uasm.label_dict[label] for inst_index, label in self.uasm.code_fixups}
+    self.use_counts = {}
+    for opcode, operand in insts:
+      if opcode in ('PUSH', 'JUMP_INDIRECT'):
+        self.use_counts[operand] = self.use_counts.get(operand, 0) + 1
+    self.removed = set()
+    for i in range(len(insts)):
+      if i in self.removed:
+        continue
+      if 'temp_copy' in self.rules and self.match_temp_copy(i):
+        continue
+      if 'self_copy' in self.rules and self.is_free(i, i + 3) and self.is_copy(i, insts[i][1], insts[i][1]):
+        self.count('self_copy', [i, i + 1, i + 2])
+        continue
+      if ('push_pop' in self.rules and self.is_free(i, i + 2)
+          and insts[i][0] == 'PUSH' and insts[i + 1][0] == 'POP'):
+        self.count('push_pop', [i, i + 1])
+        continue
+      if 'jump_next' in self.rules:
+        self.match_jump_next(i)
+    if len(self.removed) == 0:
+      return False
+    self.remove_insts()
+    return True
+
+  def is_copy(self, i: int, src: str, dst: str) -> bool:
+    """PUSH src; PUSH dst; COPY at i"""
+    insts = self.uasm.insts
+    return (i + 2 < len(insts) and insts[i] == ('PUSH', src) and insts[i + 1] == ('PUSH', dst)
+            and insts[i + 2] == ('COPY', ''))
+
+  def match_temp_copy(self, i: int) -> bool:
+    insts = self.uasm.insts
+    if not (insts[i][0] == 'PUSH' and i + 1 < len(insts) and insts[i + 1][0] == 'EXTERN'
+            and extern_has_result(insts[i + 1][1])):
+      return False
+    temp_var = insts[i][1]
+    if not (temp_var.startswith('__') and not is_const_var_name(temp_var)
+            and self.use_counts.get(temp_var, 0) == 2 and self.is_free(i, i + 5)):
+      return False
+    if not (i + 4 < len(insts) and insts[i + 2] == ('PUSH', temp_var) and insts[i + 4] == ('COPY', '')
+            and insts[i + 3][0] == 'PUSH'):
+      return False
+    dst_var = insts[i + 3][1]
+    var_table = self.uasm.var_table
+    if not (var_table.exist_var(VarName(temp_var)) and var_table.exist_var(VarName(dst_var))
+            and var_table.get_var_type(VarName(temp_var)) == var_table.get_var_type(VarName(dst_var))):
+      return False
+    insts[i] = ('PUSH', dst_var)
+    self.count('temp_copy', [i + 2, i + 3, i + 4])
+    return True
+
+  def match_jump_next(self, i: int) -> None:
+    insts = self.uasm.insts
+    if insts[i][0] == 'JUMP' and self.jump_targets.get(i) == i + 1:
+      self.count('jump_next', [i])
+    elif (insts[i][0] == 'PUSH' and i + 1 < len(insts) and insts[i + 1][0] == 'JUMP_IF_FALSE'
+          and self.is_free(i, i + 2) and self.jump_targets.get(i + 1) == i + 2):
+      self.count('jump_next', [i, i + 1])
+
+  def remove_insts(self) -> None:
+    """Remove the instructions and move the labels to the next remaining instruction"""
+    uasm = self.uasm
+    index_map: List[int] = []
+    insts: List[UdonInst] = []
+    for index, inst in enumerate(uasm.insts):
+      index_map.append(len(insts))
+      if index not in self.removed:
+        insts.append(inst)
+    index_map.append(len(insts))
+    uasm.insts = insts
+    uasm.label_dict = {label: index_map[inst_index] for label, inst_index in uasm.label_dict.items()}
+    uasm.code_fixups = [
+      (index_map[inst_index], label) for inst_index, label in uasm.code_fixups if inst_index not in self.removed]
+
+def peephole_optimize(uasm: UdonAssembly, rules: Tuple[str, ...] = PEEPHOLE_RULES) -> PeepholeReport:
+  return PeepholeOptimizer(uasm, rules).run()
@@ -2,13 +2,18 @@
 import sys
 import os
 import ast
+import threading
+import hashlib
+import io
 # Commented out because Pyinstaller failed to run.
 # import astor # type: ignore
 import re
 import pprint as pp
 from typing import *
+from typing import TextIO # not included in "from typing import *"
 from typing_extensions import Literal # 3.8: typing.Literal
 from .my_type import *
+from .method_index import *
 from libs.udon_types import *
 
 
@@ -17,6 +22,20 @@ def resource_path(relative_path: str) -> str:
         return os.path.join(sys._MEIPASS, relative_path) # type: ignore
     return os.path.join(os.path.dirname(__file__), "..", relative_path)
 
+# Number of lines written to the output at once
+WRITE_CHUNK_LINES = 1024
+
+def write_lines(sink: TextIO, lines: Iterable[str]) -> None:
+  """Write lines to sink in chunks, without joining the whole text"""
+  chunk: List[str] = []
+  for line in lines:
+    chunk.append(line)
+    if len(chunk) >= WRITE_CHUNK_LINES:
+      sink.write(''.join(chunk))
+      chunk = []
+  if len(chunk) > 0:
+    sink.write(''.join(chunk))
+
 class VarTable:
   """
   Variable Table
@@ -67,22 +86,40 @@ class VarTable:
   
   def exist_var(self, var_name: VarName) -> bool:
     return var_name in self.var_dict
+
+  def remove_var(self, var_name: VarName) -> None:
+    if var_name not in self.var_dict:
+      raise Exception(f'remove_var: Variable {var_name} is not defined.')
+    del self.var_dict[var_name]
   
-  def make_data_seg(self) -> str:
-    """making .data segment str"""
-    data_str: str = '.data_start\n\n'
+  def check_global_vars(self) -> None:
     for var_name in self.global_var_names:
       if not self.exist_var(var_name):
         raise Exception(f'make_data_seg: Global variable {var_name} is not defined.')
-      data_str += f'    .export {var_name}\n'
+
+  def iter_data_seg(self) -> Iterator[str]:
+    """.data segment lines"""
+    self.check_global_vars()
+    yield '.data_start\n\n'
+    for var_name in self.global_var_names:
+      yield f'    .export {var_name}\n'
     for (var_name, (type_name, init_value)) in self.var_dict.items():
       # There is no class with the name VRCUdonUdonBehaviour, but UdonVM requires it to be named like that anyway.
       if type_name == "VRCUdonCommonInterfacesIUdonEventReceiver":
-        data_str += f'        {var_name}: %VRCUdonUdonBehaviour, {init_value}\n'
+        yield f'        {var_name}: %VRCUdonUdonBehaviour, {init_value}\n'
       else:
-        data_str += f'        {var_name}: %{udon_types[type_name]}, {init_value}\n'
-    data_str += f'\n.data_end\n\n'
-    return data_str
+        yield f'        {var_name}: %{udon_types[type_name]}, {init_value}\n'
+    yield f'\n.data_end\n\n'
+
+  def write_data_seg(self, sink: TextIO) -> None:
+    """streaming .data segment to sink"""
+    write_lines(sink, self.iter_data_seg())
+
+  def make_data_seg(self) -> str:
+    """making .data segment str"""
+    sink = io.StringIO()
+    self.write_data_seg(sink)
+    return sink.getvalue()
 
   def print_data_seg(self) -> None:
     print(self.make_data_seg())
@@ -126,22 +163,71 @@ class UdonMethodTable:
     # (ret_type, exturn_str)
     Tuple[UdonTypeName, ExternStr]
   ]
+  method_index: Optional[MethodIndex]
+  # sha1 of udon_funcs_data.py (hex)
+  fingerprint: str
 
   def __init__(self) -> None:
     self.udon_method_dict = {}
-    f = open(resource_path('udon_funcs_data.py'), encoding="utf-8")
-    self.udon_method_dict = eval(f.read())
+    self.method_index = None
+    # Use the precompiled index (python -m libs.method_index) if it is up to date.
+    # Otherwise fall back to evaluating udon_funcs_data.py.
+    index_path = resource_path('udon_funcs_data.idx')
+    data_path = resource_path('udon_funcs_data.py')
+    if MethodIndex.is_fresh(index_path, data_path):
+      self.method_index = MethodIndex(index_path)
+      self.fingerprint = self.method_index.fingerprint.hex()
+    else:
+      f = open(data_path, 'rb')
+      data = f.read()
+      f.close()
+      self.fingerprint = hashlib.sha1(data).hexdigest()
+      self.udon_method_dict = eval(data.decode('utf-8'))
 
   def get_ret_type_extern_str(
                   self, method_kind: UdonMethodKind, udon_module_type: UdonTypeName,
                   method_name: UdonMethodName,
                   arg_types: Tuple[UdonTypeName, ...]) -> Optional[Tuple[UdonTypeName, ExternStr]]:
     key = (method_kind, udon_module_type, method_name, arg_types)
+    if self.method_index is not None:
+      return self.method_index.lookup(key)
     if key in self.udon_method_dict:
       return self.udon_method_dict[key]
     else:
       return None
 
+  def iter_methods(self) -> Iterator[Tuple[
+                    Tuple[UdonMethodKind, UdonTypeName, UdonMethodName, Tuple[UdonTypeName, ...]],
+                    Tuple[UdonTypeName, ExternStr]]]:
+    """all (key, (ret_type, extern_str)) entries"""
+    if self.method_index is not None:
+      yield from self.method_index.items()
+      return
+    for key, value in self.udon_method_dict.items():
+      # skip the 'Unknown' entries
+      if len(key) == 4 and type(value) is tuple:
+        yield (key, value)
+
+
+# Process-wide, read-only signature table.
+# Every UdonCompiler / UdonAssembly shares it, so compiling N scripts in one process loads it once.
+shared_udon_method_table: Optional[UdonMethodTable] = None
+shared_udon_method_table_lock = threading.Lock()
+
+def get_udon_method_table() -> UdonMethodTable:
+  """Return the shared table, loading it on first use"""
+  global shared_udon_method_table
+  with shared_udon_method_table_lock:
+    if shared_udon_method_table is None:
+      shared_udon_method_table = UdonMethodTable()
+    return shared_udon_method_table
+
+def set_udon_method_table(udon_method_table: Optional[UdonMethodTable]) -> None:
+  """Inject a custom or cached table (None: load the default table again on next use)"""
+  global shared_udon_method_table
+  with shared_udon_method_table_lock:
+    shared_udon_method_table = udon_method_table
+
 
 if __name__ == '__main__':
   var_table = VarTable()
@@ -149,7 +235,7 @@ if __name__ == '__main__':
   var_table.add_var(VarName('bbb'), UdonTypeName('Int32'), '200')
   var_table.print_data_seg()
 
-  udon_method_table = UdonMethodTable()
+  udon_method_table = get_udon_method_table()
   # pp.pprint(udon_method_table.udon_method_dict)
   print(udon_method_table.get_ret_type_extern_str(
     'InstanceFunc',
@@ -1,76 +1,254 @@
 import sys
 import ast
+import io
 # Commented out because Pyinstaller failed to run.
 # import astor # type: ignore
 import re
 import pprint as pp
 from typing import *
+from typing import TextIO # not included in "from typing import *"
 from typing_extensions import Literal # 3.8: typing.Literal
 from .my_type import *
 from .tables import *
 from libs.udon_types import *
 from libs.event_data import *
+from libs.dotnet_ops import *
+from libs.ir import *
 
 # python 3.6.8
 
+# Udon instruction record: (opcode, operand)
+# The operand is '' for NOP / POP / COPY.
+# 'EVENT' is not an instruction but the label of an exported event.
+UdonInst = Tuple[str, str]
+
+# bytecode size of each instruction
+inst_size_dict: Dict[str, Addr] = {
+  'NOP': Addr(4),
+  'POP': Addr(4),
+  'COPY': Addr(4),
+  'PUSH': Addr(8),
+  'JUMP_IF_FALSE': Addr(8),
+  'JUMP': Addr(8),
+  'EXTERN': Addr(8),
+  'JUMP_INDIRECT': Addr(8),
+  'EVENT': Addr(0),
+}
+
+def render_inst(inst: UdonInst) -> str:
+  opcode, operand = inst
+  if opcode == 'EVENT':
+    return f'    {operand}:\n'
+  if operand == '':
+    return f'        {opcode}\n'
+  return f'        {opcode}, {operand}\n'
+
 class UdonAssembly:
-  asm: str
-  pc: Addr
+  # Instructions are kept as records and rendered to text only once at the end.
+  insts: List[UdonInst]
   id_counter: int
-  label_dict: Dict[LabelName, Addr]
+  # label -> index of the instruction at the label
+  label_dict: Dict[LabelName, int]
+  # Jump targets and return address constants are patched by resolve_labels().
+  # (index of the jump instruction, label)
+  code_fixups: List[Tuple[int, LabelName]]
+  # (UInt32 variable initialized with the address, label)
+  data_fixups: List[Tuple[VarName, LabelName]]
+  # address of each instruction (set by resolve_labels)
+  inst_addrs: List[Addr]
   event_names: List[EventName]
   export_vars: List[VarName]
+  # constant pool: (type, value) -> the variable shared by all uses of the constant
+  const_dict: Dict[Tuple[UdonTypeName, str], VarName]
+  # constant variable -> value (for constant folding)
+  const_values: Dict[VarName, Any]
+  # Boolean constants (__true / __false), initialized by add_bool_const_init()
+  bool_const_vars: Dict[bool, VarName]
+  # functions with the static-frame calling convention (set by lower_module)
+  static_frame_funcs: Set[LabelName]
   var_table: VarTable
   def_func_table: DefFuncTable
   udon_method_table: UdonMethodTable
-  env_vars: List[VarName]
 
-  def __init__(self, var_table: VarTable, def_func_table: DefFuncTable) -> None:
-    self.asm = ''
-    self.pc = Addr(0)
+  def __init__(self, var_table: VarTable, def_func_table: DefFuncTable,
+               udon_method_table: Optional[UdonMethodTable] = None) -> None:
+    self.insts = []
     self.ld_counter = 0
     self.label_dict = {}
+    self.code_fixups = []
+    self.data_fixups = []
+    self.inst_addrs = []
     self.event_names = []
     self.export_vars = []
+    self.const_dict = {}
+    self.const_values = {}
+    self.bool_const_vars = {}
+    self.static_frame_funcs = set()
     self.var_table = var_table
     self.def_func_table = def_func_table
-    self.udon_method_table = UdonMethodTable()
-    self.env_vars = []
+    self.udon_method_table = udon_method_table if udon_method_table is not None else get_udon_method_table()
 
   def add_inst_comment(self, comment: str) -> None:
-    # self.asm += f'        # {comment}\n'
+    # self.insts.append(('#', comment))
     return
 
-  def add_inst(self, bcode_size: Addr, inst: str) -> None:
-    self.asm += f'        {inst}\n'
-    self.pc = Addr(self.pc + bcode_size)
+  def add_inst(self, opcode: str, operand: str = '') -> None:
+    self.insts.append((opcode, operand))
 
-  def make_code_seg(self) -> str:
-    ret_code: str = f'.code_start\n\n'
+  def iter_code_seg(self) -> Iterator[str]:
+    """.code segment lines (after resolve_labels)"""
+    yield '.code_start\n\n'
     for event_name in self.event_names:
-      ret_code += f'    .export {event_name}\n'
-    ret_code += f'{self.asm}\n'
-    ret_code += f'.code_end\n'
-    return ret_code
+      yield f'    .export {event_name}\n'
+    for inst in self.insts:
+      yield render_inst(inst)
+    yield '\n.code_end\n\n'
+
+  def write_code_seg(self, sink: TextIO) -> None:
+    """streaming .code segment to sink"""
+    write_lines(sink, self.iter_code_seg())
+
+  def make_code_seg(self) -> str:
+    sink = io.StringIO()
+    self.write_code_seg(sink)
+    return sink.getvalue()
 
   def get_next_id(self, name: str) -> str:
     ret_id = f'__{name}_{self.ld_counter}'
     self.ld_counter += 1
     return ret_id
 
+  def get_const_var(self, type_name: UdonTypeName, value_str: str,
+                    init_value_str: Optional[str] = None, id_name: str = 'const') -> VarName:
+    """
+    Variable of a constant (type, value).
+    Each distinct constant has only one variable. (Constant variables are never written.)
+    """
+    key = (type_name, value_str)
+    if key not in self.const_dict:
+      const_var_name = VarName(self.get_next_id(id_name))
+      self.var_table.add_var(const_var_name, type_name, value_str if init_value_str is None else init_value_str)
+      self.const_dict[key] = const_var_name
+    return self.const_dict[key]
+
+  def get_bool_const_var(self, value: bool) -> VarName:
+    """__true / __false (set once by the init routine of add_bool_const_init)"""
+    if value not in self.bool_const_vars:
+      var_name = VarName('__true' if value else '__false')
+      self.var_table.add_var(var_name, UdonTypeName('Boolean'), 'null')
+      self.bool_const_vars[value] = var_name
+      self.const_values[var_name] = value
+    return self.bool_const_vars[value]
+
+  def get_value_const_var(self, type_name: UdonTypeName, value: Any) -> Optional[VarName]:
+    """
+    Variable of a constant value of Int32 / Single / String / Boolean.
+    None if the value cannot be written in the data segment.
+    """
+    value_str: Optional[str] = None
+    if type_name == 'Boolean':
+      return self.get_bool_const_var(value)
+    elif type_name == 'Int32' and INT32_MIN <= value <= INT32_MAX:
+      value_str = f'{value}'
+    elif type_name == 'Single':
+      value_str = single_literal(value)
+    elif type_name == 'String' and not any(c in value for c in '"\\\r\n'):
+      value_str = f'"{value}"'
+    if value_str is None:
+      return None
+    const_var_name = self.get_const_var(type_name, value_str)
+    self.const_values[const_var_name] = value
+    return const_var_name
+
+  def remove_unused_vars(self) -> None:
+    """
+    Remove the constant variables and the temporary variables (__*) that are no longer used
+    (e.g. the operands of folded expressions, the results of removed code)
+    """
+    used_var_names = set(operand for opcode, operand in self.insts if opcode in ('PUSH', 'JUMP_INDIRECT'))
+    for var_name in list(self.var_table.var_dict.keys()):
+      if (var_name.startswith('__') and var_name not in used_var_names
+          and var_name not in self.var_table.global_var_names):
+        self.var_table.remove_var(var_name)
+    for key, var_name in list(self.const_dict.items()):
+      if var_name not in used_var_names:
+        del self.const_dict[key]
+        self.const_values.pop(var_name, None)
+    for value, var_name in list(self.bool_const_vars.items()):
+      if var_name not in used_var_names:
+        del self.bool_const_vars[value]
+        self.const_values.pop(var_name, None)
+
+  def add_bool_const_init(self) -> None:
+    """
+    Boolean cannot be initialized in the data segment, so __true / __false are set
+    by an init routine at the end of the code. Each event head jumps through __bool_init_addr:
+        __bool_init_ret = (address of the event body)
+        JUMP_INDIRECT, __bool_init_addr
+    __bool_init_addr is the init routine at first, and the init routine
+    changes it to a plain return (JUMP_INDIRECT, __bool_init_ret).
+    (Call before resolve_labels)
+    """
+    if len(self.bool_const_vars) == 0:
+      return
+    init_label = LabelName(self.get_next_id('bool_init'))
+    init_return_label = LabelName(self.get_next_id('bool_init_return'))
+    init_addr_var = VarName('__bool_init_addr')
+    init_ret_var = VarName('__bool_init_ret')
+    return_addr_var = VarName(self.get_next_id('const_ret_addr'))
+    self.var_table.add_var(init_addr_var, UdonTypeName('UInt32'), 'null')
+    self.var_table.add_var(init_ret_var, UdonTypeName('UInt32'), 'null')
+    self.var_table.add_var(return_addr_var, UdonTypeName('UInt32'), 'null')
+    self.data_fixups.append((init_addr_var, init_label))
+    self.data_fixups.append((return_addr_var, init_return_label))
+
+    # Insert the guard after each event label.
+    # The labels and jumps refer to instruction indexes, so they are moved with the instructions.
+    old_insts = self.insts
+    self.insts = []
+    index_map: List[int] = []
+    body_labels: Dict[LabelName, int] = {}
+    for inst in old_insts:
+      index_map.append(len(self.insts))
+      self.insts.append(inst)
+      if inst[0] == 'EVENT':
+        body_label = LabelName(self.get_next_id('event_body'))
+        body_addr_var = VarName(self.get_next_id('const_ret_addr'))
+        self.var_table.add_var(body_addr_var, UdonTypeName('UInt32'), 'null')
+        self.data_fixups.append((body_addr_var, body_label))
+        self.push_var(body_addr_var)
+        self.push_var(init_ret_var)
+        self.copy()
+        self.jump_indirect(init_addr_var)
+        body_labels[body_label] = len(self.insts)
+    index_map.append(len(self.insts))
+    self.label_dict = {label: index_map[inst_index] for label, inst_index in self.label_dict.items()}
+    self.label_dict.update(body_labels)
+    self.code_fixups = [(index_map[inst_index], label) for inst_index, label in self.code_fixups]
+
+    # init routine
+    self.add_label_crrent_addr(init_label)
+    for value, var_name in self.bool_const_vars.items():
+      self.set_bool(var_name, value)
+    self.push_var(return_addr_var)
+    self.push_var(init_addr_var)
+    self.copy()
+    self.add_label_crrent_addr(init_return_label)
+    self.jump_indirect(init_ret_var)
+
   def add_label_crrent_addr(self, label: LabelName) -> None:
-    self.label_dict[label] = self.pc
+    self.label_dict[label] = len(self.insts)
 
   ######################
   # Udon Instructions And Wrapper
 
   def nop(self):
-    self.add_inst(4, 'NOP')
+    self.add_inst('NOP')
 
   def remove_top(self):
     'Udon POP is removing top'
     self.add_inst_comment('Remove Top')
-    self.add_inst(4, 'POP')
+    self.add_inst('POP')
   
   def pop_var(self, ret_value_name: VarName) -> None:
     'True POP'
@@ -88,10 +266,10 @@ class UdonAssembly:
       self.pop_var(var_name)
 
   def push(self, addr: Addr) -> None:
-    self.add_inst(Addr(8), f'PUSH, {addr:08x}')
+    self.add_inst('PUSH', f'{addr:08x}')
 
   def push_var(self, var_name: VarName) -> None:
-    self.add_inst(Addr(8), f'PUSH, {var_name}')
+    self.add_inst('PUSH', var_name)
 
   def push_vars(self, var_names: List[VarName]) -> None:
     self.add_inst_comment(f'Pushs {str(var_names)}')
@@ -99,37 +277,37 @@ class UdonAssembly:
       self.push_var(var_name)
 
   def copy(self) -> None:
-    self.add_inst(Addr(4), 'COPY')
+    self.add_inst('COPY')
     
   def push_str(self, _str: str) -> None:
-    self.add_inst(Addr(8), f'PUSH, "{_str}"')
+    self.add_inst('PUSH', f'"{_str}"')
 
   def jump(self, addr: Addr) -> None:
-    self.add_inst(Addr(8), f'JUMP, 0x{addr:08x}')
+    self.add_inst('JUMP', f'0x{addr:08x}')
 
   def jump_label(self, label: LabelName) -> None:
-    # ###{label}### is temporary label
-    self.add_inst(Addr(8), f'JUMP, ###{label}###')
+    self.code_fixups.append((len(self.insts), label))
+    self.add_inst('JUMP', '')
 
   def jump_if_false(self, addr: Addr) -> None:
-    self.add_inst(Addr(8), f'JUMP_IF_FALSE, 0x{addr:08x}')
+    self.add_inst('JUMP_IF_FALSE', f'0x{addr:08x}')
 
   def jump_if_false_label(self, label: LabelName) -> None:
-    # ###{label}### is temporary label
-    self.add_inst(Addr(8), f'JUMP_IF_FALSE, ###{label}###')
+    self.code_fixups.append((len(self.insts), label))
+    self.add_inst('JUMP_IF_FALSE', '')
 
   def jump_indirect(self, var_name: VarName) -> None:
-    self.add_inst(Addr(8), f'JUMP_INDIRECT, {var_name}')
+    self.add_inst('JUMP_INDIRECT', var_name)
 
   def jump_ret_addr(self) -> None:
-    self.add_inst(Addr(8), f'JUMP_INDIRECT, ret_addr')
+    self.add_inst('JUMP_INDIRECT', 'ret_addr')
 
   def extern(self, extern_str: ExternStr) -> None:
-    self.add_inst(Addr(8), f'EXTERN, "{extern_str}"')
+    self.add_inst('EXTERN', f'"{extern_str}"')
 
   def end(self) -> None:
     """event end"""
-    self.add_inst(Addr(8), f'JUMP, 0xFFFFFFFC')
+    self.add_inst('JUMP', '0xFFFFFFFC')
     return
 
   def call_extern(self, extern_str: ExternStr, arg_vars: List[VarName]) -> None:
@@ -144,97 +322,79 @@ class UdonAssembly:
     self.extern(extern_str)
 
   def assign(self, dist_var_name: VarName, src_var_name: VarName) -> None:
-    "Add variable, "
-    # If the variable name on the right side is UdonTypeName, 
-    # just set the type of the variable on the left.
-    src_var_type: UdonTypeName
-    if src_var_name in udon_types:
-        src_var_type = UdonTypeName(src_var_name)
-        self.var_table.add_var(dist_var_name, src_var_type, 'null')
-    else:
-      src_var_type = self.var_table.get_var_type(src_var_name)
-      # If the left variable is undefined, define the variable.
-      if not self.var_table.exist_var(dist_var_name):
-        self.add_inst_comment(f'Declare {dist_var_name}')
-        self.var_table.add_var(dist_var_name, src_var_type, 'null')
-      self.add_inst_comment(f'{str(dist_var_name)} = {str(src_var_name)}')
-      self.push_var(src_var_name)
-      self.push_var(dist_var_name)
-      self.copy()
+    self.add_inst_comment(f'{str(dist_var_name)} = {str(src_var_name)}')
+    self.push_var(src_var_name)
+    self.push_var(dist_var_name)
+    self.copy()
 
   def set_bool(self, var_name: VarName, bool_num: bool) -> None:
     self.push_str(f"{'true' if bool_num else 'false'}")
     self.push_var(var_name)
     self.extern(ExternStr('SystemBoolean.__Parse__SystemString__SystemBoolean'))
 
-  def set_uint32(self, var_name: VarName, num: int) -> None:
-    self.add_inst_comment(f'{str(var_name)} = {str(num)}')
-    const_var_name = VarName(self.get_next_id('const_uint32'))
-    self.var_table.add_var(const_var_name, UdonTypeName('UInt32'), f'{num}')
-    self.push_var(const_var_name)
-    self.push_var(var_name)
-    self.copy()
-
   def get_addr(self, label: LabelName) -> Addr:
-    """ get address from  temporary label"""
-    return self.label_dict[label]
-
-  def add_label(self, label: LabelName, addr: Addr) -> None:
-    self.label_dict[label] = addr
-  
-  # BAD METHOD
-  def replace_tmp_adrr(self, code: str) -> str:
-    replace_str: str = ''
-    for line in code.split('\n'):
-        match = re.match(r'.*###(.*)###.*', line)
-        if match is not None and match.group(1) is not None:
-            label_name = LabelName(match.group(1))
-            line_new = line.replace(f'###{label_name}###', f'0x{self.get_addr(label_name):08x}')
-            replace_str += f'{line_new}\n'
-        else:
-            replace_str += f'{line}\n'
-    return replace_str
+    """ get address from label (after resolve_labels)"""
+    return self.inst_addrs[self.label_dict[label]]
+
+  def resolve_labels(self) -> None:
+    """Back-patch all jump targets and return address constants in one pass"""
+    self.inst_addrs = []
+    addr = 0
+    for opcode, _ in self.insts:
+      self.inst_addrs.append(Addr(addr))
+      addr += inst_size_dict[opcode]
+    # A label can be at the end of the code.
+    self.inst_addrs.append(Addr(addr))
+
+    for inst_index, label in self.code_fixups:
+      opcode, _ = self.insts[inst_index]
+      self.insts[inst_index] = (opcode, f'0x{self.get_addr(label):08x}')
+    for var_name, label in self.data_fixups:
+      type_name, _ = self.var_table.var_dict[var_name]
+      self.var_table.var_dict[var_name] = (type_name, f'0x{self.get_addr(label):08x}')
   
-  def call_def_func(self, func_name: FuncName, arg_var_names: List[VarName]) -> Optional[VarName]:
-    self.add_inst_comment(f'Call DefFunc {str(func_name)}{str(arg_var_names)}')
-    arg_var_types: List[UdonTypeName] = [
-      self.var_table.get_var_type(arg_var_name) for arg_var_name in arg_var_names]
-    ret_type_name: UdonTypeName = self.def_func_table.get_ret_type(func_name, tuple(arg_var_types))
+  def call_def_func(self, func_id: LabelName, arg_var_names: List[VarName],
+                    ret_value: Optional[VarName], env_vars: List[VarName]) -> None:
+    """
+    env_vars: variables saved during the call (ret_addr and the variables of the caller
+              that the callee can overwrite, see elide_call_saves)
+    """
+    self.add_inst_comment(f'Call DefFunc {str(func_id)}{str(arg_var_names)}')
     ret_call_label = LabelName(self.get_next_id('ret_call_label'))
     const_ret_addr = VarName(self.get_next_id('const_ret_addr'))
-    ret_value = VarName(self.get_next_id('ret_value'))
-    # Save current return address
-    self.push_var(VarName('ret_addr'))
     # Save environment variables
-    self.push_vars(self.env_vars)
+    self.push_vars(env_vars)
     # Save return address in order to return
     self.var_table.add_var(
       VarName(const_ret_addr),
       UdonTypeName('UInt32'),
-      f'###{ret_call_label}###')
+      'null')
+    self.data_fixups.append((const_ret_addr, ret_call_label))
     # self.assign(VarName('ret_addr'), VarName(const_ret_addr))
     self.push_var(VarName(const_ret_addr))
     # Push arguments
     self.push_vars(arg_var_names)
     # goto func label
-    self.jump_label(LabelName(self.def_func_table.get_function_id(func_name, arg_var_types)))
+    self.jump_label(func_id)
     self.add_label_crrent_addr(ret_call_label)
 
-    if ret_type_name != UdonTypeName('Void'):
+    if ret_value is not None:
       # pop ret_var_name
-      self.var_table.add_var(ret_value, ret_type_name, 'null')
       self.pop_var(ret_value)
-      # restore environment
-      self.pop_vars(self.env_vars)
-      # restore current return address
-      self.pop_var(VarName('ret_addr'))
-      return ret_value
-    else:
-      # restore environment
-      self.pop_vars(self.env_vars)
-      # restore current return address
-      self.pop_var(VarName('ret_addr'))
-      return None
+    # restore environment
+    self.pop_vars(env_vars)
+
+  def call_static_func(self, func_id: LabelName) -> None:
+    """Call a static-frame function (the arguments and the return value are copied in the IR)"""
+    self.add_inst_comment(f'Call StaticFunc {str(func_id)}')
+    ret_call_label = LabelName(self.get_next_id('ret_call_label'))
+    const_ret_addr = VarName(self.get_next_id('const_ret_addr'))
+    self.var_table.add_var(const_ret_addr, UdonTypeName('UInt32'), 'null')
+    self.data_fixups.append((const_ret_addr, ret_call_label))
+    # Push the return address only
+    self.push_var(const_ret_addr)
+    self.jump_label(func_id)
+    self.add_label_crrent_addr(ret_call_label)
 
   def add_event(self, event_name: EventName,
                 def_arg_var_names: List[VarName], def_arg_types: List[UdonTypeName]) -> None:
@@ -258,7 +418,90 @@ class UdonAssembly:
     self.event_names.append(event_name)
 
   def event_head(self, event_name: EventName) -> None:
-    self.asm += f'    {event_name}:\n'
+    self.add_inst('EVENT', event_name)
+
+  ######################
+  # Lowering IR -> Udon Instructions
+
+  def block_label(self, block_id: BlockId) -> LabelName:
+    return LabelName(f'__block_{block_id}')
+
+  def lower_module(self, module: IRModule) -> None:
+    """Translate the IR into instruction records (Call before remove_unused_vars)"""
+    self.static_frame_funcs = set(LabelName(function.name) for function in module.functions if function.static_frame)
+    for function in module.functions:
+      self.lower_function(function)
+
+  def lower_function(self, function: IRFunction) -> None:
+    if function.is_event:
+      self.event_head(EventName(function.name))
+    elif function.static_frame:
+      self.add_label_crrent_addr(LabelName(function.name))
+      # Pop Return Address (The arguments are already in the parameters.)
+      self.pop_var(static_ret_addr_var(function.name))
+    else:
+      self.add_label_crrent_addr(LabelName(function.name))
+      # Pop Argument
+      self.pop_vars(function.params)
+    for i, block in enumerate(function.blocks):
+      # A jump to the next block is not needed.
+      next_block_id = function.blocks[i + 1].block_id if i + 1 < len(function.blocks) else None
+      self.add_label_crrent_addr(self.block_label(block.block_id))
+      for inst in block.insts:
+        self.lower_inst(inst, function)
+      if block.term is None:
+        raise Exception(f'lower_function: Block {block.block_id} of {function.name} has no terminator.')
+      self.lower_term(block.term, function, next_block_id)
+
+  def lower_inst(self, inst: IRInst, function: IRFunction) -> None:
+    if type(inst) is IRCopy:
+      copy_inst = cast(IRCopy, inst)
+      self.assign(copy_inst.dst, copy_inst.src)
+    elif type(inst) is IRExtern:
+      extern_inst = cast(IRExtern, inst)
+      arg_vars = list(extern_inst.args)
+      if extern_inst.dst is not None:
+        arg_vars.append(extern_inst.dst)
+      self.call_extern(extern_inst.extern_str, arg_vars)
+    elif type(inst) is IRCall:
+      call_inst = cast(IRCall, inst)
+      if call_inst.func_id in self.static_frame_funcs:
+        self.call_static_func(call_inst.func_id)
+      else:
+        self.call_def_func(call_inst.func_id, list(call_inst.args), call_inst.dst, list(call_inst.saved_vars))
+    else:
+      raise Exception(f'lower_inst: Unknown instruction {inst}.')
+
+  def lower_term(self, term: IRTerm, function: IRFunction, next_block_id: Optional[BlockId]) -> None:
+    if type(term) is IRJump:
+      target = cast(IRJump, term).target
+      if target != next_block_id:
+        self.jump_label(self.block_label(target))
+    elif type(term) is IRBranch:
+      branch = cast(IRBranch, term)
+      self.push_var(branch.cond)
+      # if (!cond) goto else
+      self.jump_if_false_label(self.block_label(branch.else_target))
+      if branch.then_target != next_block_id:
+        self.jump_label(self.block_label(branch.then_target))
+    elif type(term) is IRReturn:
+      value = cast(IRReturn, term).value
+      if function.is_event:
+        self.end()
+      elif function.static_frame:
+        # (The return value is already in {func}__ret.)
+        self.jump_indirect(static_ret_addr_var(function.name))
+      else:
+        # Pop Return Address
+        # (after the return value is evaluated, so that a call in the return expression
+        #  does not overwrite it)
+        self.pop_var(VarName('ret_addr'))
+        if value is not None:
+          # Push Retern value
+          self.push_var(value)
+        self.jump_ret_addr()
+    else:
+      raise Exception(f'lower_term: Unknown terminator {term}.')
 
 if __name__ == "__main__":
   pass
\ No newline at end of file
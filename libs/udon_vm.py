@@ -0,0 +1,502 @@
+# python 3.6.8
+import sys
+import re
+import time
+import random
+import argparse
+from typing import *
+from typing_extensions import Literal # 3.8: typing.Literal
+from .my_type import *
+from .dotnet_ops import *
+
+# Udon VM emulator
+#
+# Runs the Udon Assembly generated by UdonAssembly (.data / .code segments) in Python,
+# so that the output of the compiler can be tested and benchmarked without Unity.
+#   heap  : one value per variable of the .data segment (+ the literals of PUSH, "...")
+#   stack : heap addresses
+# EXTERN calls go to stand-in implementations (ExternImpl) looked up by the extern string.
+# Only the common System* externs are implemented. Other externs raise an error,
+# or return a default value in stub mode.
+
+# Address of the instruction after an event ("JUMP, 0xFFFFFFFC")
+HALT_ADDR = 0xFFFFFFFC
+DEFAULT_MAX_STEPS = 100000000
+
+# decoded opcodes
+OP_NOP = 0
+OP_PUSH = 1
+OP_POP = 2
+OP_JUMP_IF_FALSE = 4
+OP_JUMP = 5
+OP_EXTERN = 6
+OP_JUMP_INDIRECT = 8
+OP_COPY = 9
+
+opcode_dict: Dict[str, int] = {
+  'NOP': OP_NOP,
+  'PUSH': OP_PUSH,
+  'POP': OP_POP,
+  'JUMP_IF_FALSE': OP_JUMP_IF_FALSE,
+  'JUMP': OP_JUMP,
+  'EXTERN': OP_EXTERN,
+  'JUMP_INDIRECT': OP_JUMP_INDIRECT,
+  'COPY': OP_COPY,
+}
+
+# bytecode size of each instruction
+opcode_size_dict: Dict[int, int] = {
+  OP_NOP: 4,
+  OP_PUSH: 8,
+  OP_POP: 4,
+  OP_JUMP_IF_FALSE: 8,
+  OP_JUMP: 8,
+  OP_EXTERN: 8,
+  OP_JUMP_INDIRECT: 8,
+  OP_COPY: 4,
+}
+
+class UdonObject:
+  """Stand-in for a Unity / VRChat object (this, or the result of a stub extern)"""
+  type_name: str
+
+  def __init__(self, type_name: str) -> None:
+    self.type_name = type_name
+
+  def __repr__(self) -> str:
+    return f'<{self.type_name}>'
+
+def default_value(type_name: str) -> Any:
+  """default(T) of an Udon type name (ex: SystemInt32)"""
+  if type_name in ('SystemInt32', 'SystemUInt32', 'SystemInt16', 'SystemUInt16',
+                   'SystemInt64', 'SystemUInt64', 'SystemByte', 'SystemSByte'):
+    return 0
+  if type_name in ('SystemSingle', 'SystemDouble'):
+    return 0.0
+  if type_name == 'SystemBoolean':
+    return False
+  return None
+
+def parse_init_value(type_name: str, value_str: str) -> Any:
+  """initial value of a .data segment variable"""
+  if value_str == 'null':
+    return default_value(type_name)
+  if value_str == 'this':
+    return UdonObject(type_name)
+  if len(value_str) >= 2 and value_str[0] == '"' and value_str[-1] == '"':
+    return value_str[1:-1]
+  if value_str.lower().startswith('0x'):
+    return int(value_str, 16)
+  if type_name in ('SystemSingle', 'SystemDouble'):
+    return single(float(value_str))
+  if type_name == 'SystemBoolean':
+    return parse_boolean(value_str)
+  return int(value_str)
+
+
+# (opcode, operand)
+#  PUSH: heap address, JUMP / JUMP_IF_FALSE: instruction index, JUMP_INDIRECT: heap address,
+#  EXTERN: extern string
+VMInst = Tuple[int, Any]
+
+class UdonProgram:
+  """Parsed Udon Assembly"""
+  heap_names: List[str]
+  heap_types: List[str]
+  heap_init: List[Any]
+  var_addrs: Dict[VarName, int]
+  export_vars: List[VarName]
+  insts: List[VMInst]
+  # instruction index -> bytecode address
+  inst_addrs: List[int]
+  # bytecode address -> instruction index
+  addr_indexes: Dict[int, int]
+  code_size: int
+  event_addrs: Dict[EventName, int]
+  export_events: List[EventName]
+
+  def __init__(self, asm: str) -> None:
+    self.heap_names = []
+    self.heap_types = []
+    self.heap_init = []
+    self.var_addrs = {}
+    self.export_vars = []
+    self.insts = []
+    self.inst_addrs = []
+    self.addr_indexes = {}
+    self.code_size = 0
+    self.event_addrs = {}
+    self.export_events = []
+    self.parse(asm)
+
+  def add_heap(self, name: str, type_name: str, init_value: Any) -> int:
+    self.heap_names.append(name)
+    self.heap_types.append(type_name)
+    self.heap_init.append(init_value)
+    return len(self.heap_names) - 1
+
+  def parse(self, asm: str) -> None:
+    segment = None
+    # (instruction index, opcode, operand text, line number)
+    code_lines: List[Tuple[int, str, str, int]] = []
+    addr = 0
+    for line_no, raw_line in enumerate(asm.splitlines(), 1):
+      line = raw_line.strip()
+      if line == '' or line.startswith('#'):
+        continue
+      if line in ('.data_start', '.code_start'):
+        segment = line[1:5]
+        continue
+      if line in ('.data_end', '.code_end'):
+        segment = None
+        continue
+      if segment == 'data':
+        if line.startswith('.export '):
+          self.export_vars.append(VarName(line[len('.export '):].strip()))
+          continue
+        # name: %Type, value
+        m = re.match(r'([^:\s]+)\s*:\s*%([^,\s]+)\s*,\s*(.*)$', line)
+        if m is None:
+          raise Exception(f'UdonProgram: {line_no}: Invalid data line "{line}".')
+        var_name, type_name, value_str = m.group(1), m.group(2), m.group(3).strip()
+        if var_name in self.var_addrs:
+          raise Exception(f'UdonProgram: {line_no}: {var_name} is already defined.')
+        self.var_addrs[VarName(var_name)] = self.add_heap(var_name, type_name, parse_init_value(type_name, value_str))
+      elif segment == 'code':
+        if line.startswith('.export '):
+          self.export_events.append(EventName(line[len('.export '):].strip()))
+          continue
+        if line.endswith(':'):
+          self.event_addrs[EventName(line[:-1])] = addr
+          continue
+        opcode_str, _, operand_str = line.partition(',')
+        opcode_str = opcode_str.strip()
+        if opcode_str not in opcode_dict:
+          raise Exception(f'UdonProgram: {line_no}: Unknown instruction "{line}".')
+        opcode = opcode_dict[opcode_str]
+        code_lines.append((len(self.inst_addrs), opcode_str, operand_str.strip(), line_no))
+        self.addr_indexes[addr] = len(self.inst_addrs)
+        self.inst_addrs.append(addr)
+        addr += opcode_size_dict[opcode]
+    self.code_size = addr
+
+    # Operands are resolved after all addresses are known.
+    for _, opcode_str, operand_str, line_no in code_lines:
+      opcode = opcode_dict[opcode_str]
+      operand: Any = None
+      if opcode in (OP_PUSH, OP_JUMP_INDIRECT):
+        operand = self.parse_heap_operand(operand_str, line_no)
+      elif opcode in (OP_JUMP, OP_JUMP_IF_FALSE):
+        jump_addr = int(operand_str, 16) if operand_str.lower().startswith('0x') else int(operand_str)
+        # Jumps out of the code end the event.
+        operand = self.addr_indexes.get(jump_addr, -1)
+        if operand == -1 and jump_addr < self.code_size:
+          raise Exception(f'UdonProgram: {line_no}: {operand_str} is not the address of an instruction.')
+      elif opcode == OP_EXTERN:
+        operand = operand_str.strip('"')
+      self.insts.append((opcode, operand))
+
+  def parse_heap_operand(self, operand_str: str, line_no: int) -> int:
+    if operand_str in self.var_addrs:
+      return self.var_addrs[VarName(operand_str)]
+    # PUSH, "true": a string literal is given its own heap slot.
+    if len(operand_str) >= 2 and operand_str[0] == '"' and operand_str[-1] == '"':
+      return self.add_heap(operand_str, 'SystemString', operand_str[1:-1])
+    # PUSH, 0x00000001: raw heap address
+    try:
+      return int(operand_str, 16) if operand_str.lower().startswith('0x') else int(operand_str)
+    except ValueError:
+      raise Exception(f'UdonProgram: {line_no}: Variable {operand_str} is not defined.')
+
+
+class VMStats:
+  steps: int
+  extern_calls: int
+  stub_calls: int
+  elapsed_sec: float
+  opcode_counts: Dict[str, int]
+  extern_counts: Dict[str, int]
+
+  def __init__(self) -> None:
+    self.steps = 0
+    self.extern_calls = 0
+    self.stub_calls = 0
+    self.elapsed_sec = 0.0
+    self.opcode_counts = {}
+    self.extern_counts = {}
+
+  def __str__(self) -> str:
+    steps_per_sec = self.steps / self.elapsed_sec if self.elapsed_sec > 0 else 0.0
+    lines = [
+      f'steps: {self.steps} ({self.elapsed_sec * 1000:.1f} ms, {steps_per_sec:.0f} steps/s)',
+      f'extern calls: {self.extern_calls} (stub: {self.stub_calls})',
+    ]
+    for opcode_str, count in sorted(self.opcode_counts.items(), key=lambda item: -item[1]):
+      lines.append(f'  {opcode_str}: {count}')
+    for extern_str, count in sorted(self.extern_counts.items(), key=lambda item: -item[1]):
+      lines.append(f'  {extern_str}: {count}')
+    return '\n'.join(lines)
+
+
+# (input arg count, has output, function(vm, *input values) -> output value)
+ExternImpl = Tuple[int, bool, Callable[..., Any]]
+extern_dict: Dict[str, ExternImpl] = {}
+
+def register_extern(extern_str: str, n_in: int, has_out: bool, func: Callable[..., Any]) -> None:
+  """Add (or replace) the stand-in implementation of an extern for all VMs"""
+  extern_dict[extern_str] = (n_in, has_out, func)
+
+
+class UdonVM:
+  program: UdonProgram
+  heap: List[Any]
+  stack: List[int]
+  externs: Dict[str, ExternImpl]
+  stub_unknown: bool
+  max_steps: int
+  logs: List[str]
+  stats: VMStats
+  random: random.Random
+
+  def __init__(self, program: UdonProgram, externs: Optional[Dict[str, ExternImpl]] = None,
+               stub_unknown: bool = False, max_steps: int = DEFAULT_MAX_STEPS,
+               seed: int = 0, udon_method_table: Any = None) -> None:
+    self.program = program
+    self.externs = dict(extern_dict)
+    if externs is not None:
+      self.externs.update(externs)
+    self.stub_unknown = stub_unknown
+    self.max_steps = max_steps
+    self.random = random.Random(seed)
+    # UdonMethodTable: used to know the signatures of unknown externs in stub mode
+    self.udon_method_table = udon_method_table
+    self.stub_signatures: Optional[Dict[str, Tuple[int, str]]] = None
+    self.logs = []
+    self.stats = VMStats()
+    self.reset()
+
+  def reset(self) -> None:
+    """Initialize the heap (The logs and stats are kept.)"""
+    self.heap = list(self.program.heap_init)
+    self.stack = []
+
+  def get_var(self, var_name: str) -> Any:
+    return self.heap[self.program.var_addrs[VarName(var_name)]]
+
+  def set_var(self, var_name: str, value: Any) -> None:
+    self.heap[self.program.var_addrs[VarName(var_name)]] = value
+
+  def log(self, message: str) -> None:
+    self.logs.append(message)
+
+  def run_event(self, event_name: str, args: Optional[Dict[str, Any]] = None) -> None:
+    """Run an event (ex: _start). args: event argument variables (ex: {'onPlayerJoinedPlayer': ...})"""
+    if event_name not in self.program.event_addrs:
+      raise Exception(f'UdonVM: Event {event_name} is not defined.')
+    if args is not None:
+      for var_name, value in args.items():
+        self.set_var(var_name, value)
+    self.run(self.program.event_addrs[EventName(event_name)])
+
+  def run(self, start_addr: int) -> None:
+    program = self.program
+    insts = program.insts
+    addr_indexes = program.addr_indexes
+    heap = self.heap
+    stack = self.stack
+    externs = self.externs
+    stats = self.stats
+    opcode_counts = [0] * (max(opcode_size_dict) + 1)
+    extern_counts = stats.extern_counts
+    max_steps = self.max_steps
+    n_insts = len(insts)
+
+    pc = addr_indexes.get(start_addr, n_insts)
+    steps = 0
+    start_time = time.perf_counter()
+    try:
+      while 0 <= pc < n_insts:
+        opcode, operand = insts[pc]
+        steps += 1
+        opcode_counts[opcode] += 1
+        if steps > max_steps:
+          raise Exception(f'UdonVM: Exceeded the max step count {max_steps}.')
+        pc += 1
+        if opcode == OP_PUSH:
+          stack.append(operand)
+        elif opcode == OP_COPY:
+          dst = stack.pop()
+          src = stack.pop()
+          heap[dst] = heap[src]
+        elif opcode == OP_EXTERN:
+          n_in, has_out, func = externs[operand] if operand in externs else self.find_extern(operand)
+          if has_out:
+            out_addr = stack.pop()
+          if n_in > 0:
+            in_addrs = stack[-n_in:]
+            del stack[-n_in:]
+            ret = func(self, *[heap[in_addr] for in_addr in in_addrs])
+          else:
+            ret = func(self)
+          if has_out:
+            heap[out_addr] = ret
+          extern_counts[operand] = extern_counts.get(operand, 0) + 1
+        elif opcode == OP_JUMP:
+          pc = operand
+        elif opcode == OP_JUMP_IF_FALSE:
+          if not heap[stack.pop()]:
+            pc = operand
+        elif opcode == OP_JUMP_INDIRECT:
+          jump_addr = heap[operand]
+          pc = addr_indexes.get(jump_addr, -1)
+          if pc == -1 and jump_addr < program.code_size:
+            raise Exception(f'UdonVM: {program.heap_names[operand]} ({jump_addr:#010x}) is not the address of an instruction.')
+        elif opcode == OP_POP:
+          stack.pop()
+        # NOP: nothing
+    except IndexError:
+      if len(stack) == 0:
+        raise Exception(f'UdonVM: Stack underflow at {program.inst_addrs[pc - 1]:#010x}.')
+      raise
+    except DotNetException as e:
+      raise Exception(f'UdonVM: {e} (at {program.inst_addrs[pc - 1]:#010x})')
+    finally:
+      stats.elapsed_sec += time.perf_counter() - start_time
+      stats.steps += steps
+      for opcode_str, opcode in opcode_dict.items():
+        if opcode_counts[opcode] > 0:
+          stats.opcode_counts[opcode_str] = stats.opcode_counts.get(opcode_str, 0) + opcode_counts[opcode]
+      stats.extern_calls = sum(extern_counts.values())
+
+  def find_extern(self, extern_str: str) -> ExternImpl:
+    """Implementation of an extern that is not registered (arrays, or a stub)"""
+    extern_impl = array_extern(extern_str)
+    if extern_impl is None:
+      extern_impl = self.stub_extern(extern_str)
+    self.externs[extern_str] = extern_impl
+    return extern_impl
+
+  def stub_extern(self, extern_str: str) -> ExternImpl:
+    if not self.stub_unknown:
+      raise Exception(f'UdonVM: Extern {extern_str} is not implemented.')
+    if self.stub_signatures is None:
+      self.stub_signatures = make_stub_signatures(self.udon_method_table)
+    if extern_str not in self.stub_signatures:
+      raise Exception(f'UdonVM: The signature of extern {extern_str} is unknown.')
+    n_in, ret_type = self.stub_signatures[extern_str]
+
+    def stub(vm: UdonVM, *args: Any) -> Any:
+      vm.stats.stub_calls += 1
+      ret_value = default_value(ret_type)
+      return UdonObject(ret_type) if ret_value is None else ret_value
+    return (n_in, ret_type != 'SystemVoid', stub)
+
+
+def make_stub_signatures(udon_method_table: Any) -> Dict[str, Tuple[int, str]]:
+  """extern string -> (input arg count, Udon return type name)"""
+  from .udon_types import udon_types
+  from .tables import get_udon_method_table
+  if udon_method_table is None:
+    udon_method_table = get_udon_method_table()
+  signatures: Dict[str, Tuple[int, str]] = {}
+  for (method_kind, _, _, arg_types), (ret_type, extern_str) in udon_method_table.iter_methods():
+    # An instance method takes the instance first.
+    n_in = len(arg_types) + (1 if method_kind == 'InstanceFunc' else 0)
+    signatures[extern_str] = (n_in, 'SystemVoid' if ret_type == 'None' else udon_types.get(ret_type, ret_type))
+  return signatures
+
+def array_extern(extern_str: str) -> Optional[ExternImpl]:
+  """{Type}Array ctor / Get / Set / get_Length"""
+  m = re.match(r'(\w+)Array\.__(ctor|Get|Set|get_Length)__', extern_str)
+  if m is None:
+    return None
+  element_type, method_name = m.group(1), m.group(2)
+  if method_name == 'ctor' and extern_str.endswith('__SystemInt32__' + element_type + 'Array'):
+    return (1, True, lambda vm, length: [default_value(element_type)] * length)
+  if method_name == 'Get' and extern_str.endswith('__SystemInt32__' + element_type):
+    return (2, True, lambda vm, array, index: array[check_index(array, index)])
+  if method_name == 'Set' and extern_str.endswith('__SystemInt32_' + element_type + '__SystemVoid'):
+    return (3, False, lambda vm, array, index, value: array.__setitem__(check_index(array, index), value))
+  if method_name == 'get_Length':
+    return (1, True, lambda vm, array: len(array))
+  return None
+
+def check_index(array: Optional[List[Any]], index: int) -> int:
+  if array is None:
+    raise DotNetException('System.NullReferenceException: Object reference not set to an instance of an object.')
+  if index < 0 or len(array) <= index:
+    raise DotNetException('System.IndexOutOfRangeException: Index was outside the bounds of the array.')
+  return index
+
+def log_str(value: Any) -> str:
+  """Debug.Log(Object) message"""
+  return 'Null' if value is None else to_string(value)
+
+
+# Stand-in implementations of the common externs
+def register_default_externs() -> None:
+  # operators, Convert, Parse, ToString (dotnet_ops)
+  for extern_str, (n_in, op) in pure_extern_dict.items():
+    register_extern(extern_str, n_in, True, lambda vm, *args, op=op: op(*args))
+
+  # Debug.Log
+  for log_name in ('Log', 'LogWarning', 'LogError'):
+    register_extern(f'UnityEngineDebug.__{log_name}__SystemObject__SystemVoid', 1, False,
+                    lambda vm, message: vm.log(log_str(message)))
+    register_extern(f'UnityEngineDebug.__{log_name}__SystemObject_UnityEngineObject__SystemVoid', 2, False,
+                    lambda vm, message, context: vm.log(log_str(message)))
+
+  # instantiate() (built-in function): a new stand-in object
+  register_extern('VRCInstantiate.__Instantiate__UnityEngineGameObject__UnityEngineGameObject', 1, True,
+                  lambda vm, original: UdonObject('UnityEngineGameObject'))
+
+  # Random (seeded by the VM)
+  register_extern('UnityEngineRandom.__Range__SystemInt32_SystemInt32__SystemInt32', 2, True,
+                  lambda vm, min_value, max_value:
+                    vm.random.randrange(min_value, max_value) if min_value < max_value else min_value)
+  register_extern('UnityEngineRandom.__Range__SystemSingle_SystemSingle__SystemSingle', 2, True,
+                  lambda vm, min_value, max_value: single(vm.random.uniform(min_value, max_value)))
+
+register_default_externs()
+
+
+if __name__ == '__main__':
+  # python -m libs.udon_vm example.uasm [--event _start] [--repeat N] [--stub] [--stats]
+  arg_parser = argparse.ArgumentParser(description='Udon VM emulator', add_help=True)
+  arg_parser.add_argument('input', help='Udon Assembly code path (ex: .\\example.uasm)')
+  arg_parser.add_argument('--event', action='append',
+                          help='event to run (can be repeated, default: _start or the first event)')
+  arg_parser.add_argument('--repeat', type=int, default=1, help='run the events N times (benchmark)')
+  arg_parser.add_argument('--stub', action='store_true',
+                          help='unknown externs return a default value instead of an error')
+  arg_parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS, help='step limit of an event')
+  arg_parser.add_argument('--seed', type=int, default=0, help='seed of UnityEngine.Random')
+  arg_parser.add_argument('--stats', action='store_true', help='print the execution statistics')
+  args = arg_parser.parse_args()
+
+  f = open(args.input, encoding='utf-8')
+  program = UdonProgram(f.read())
+  f.close()
+  vm = UdonVM(program, stub_unknown=args.stub, max_steps=args.max_steps, seed=args.seed)
+  event_names: List[str] = args.event
+  if event_names is None:
+    event_names = ['_start'] if '_start' in program.event_addrs else program.export_events[:1]
+  exit_code = 0
+  try:
+    for repeat_i in range(args.repeat):
+      vm.reset()
+      for event_name in event_names:
+        vm.run_event(event_name)
+      # Print the logs of the first run only.
+      if repeat_i == 0:
+        for message in vm.logs:
+          print(message)
+        vm.logs = []
+  except Exception as e:
+    for message in vm.logs:
+      print(message)
+    print(e, file=sys.stderr)
+    exit_code = 1
+  if args.stats:
+    print(vm.stats, file=sys.stderr)
+  sys.exit(exit_code)
@@ -1,3 +1,4 @@
+python -m libs.method_index
 pyinstaller udon_compiler.spec
 copy /Y	 README.md dist\README.md
 xcopy /Y tools dist\
@@ -0,0 +1,360 @@
+# python 3.6.8
+# Regression tests of the compiler: compile small programs and run them on the Udon VM.
+# Run: python -m unittest discover tests
+import os
+import sys
+import unittest
+from textwrap import dedent
+from typing import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from udon_compiler import compile_source, CompileOptions
+from libs.udon_vm import UdonProgram, UdonVM
+
+def run_source(code: str, events: Sequence[str] = ('_start',),
+               options: CompileOptions = CompileOptions()) -> List[str]:
+  """Compile the code and run the events in order. Returns the logs."""
+  asm, _ = compile_source(dedent(code), options)
+  vm = UdonVM(UdonProgram(asm), stub_unknown=True)
+  for event_name in events:
+    vm.run_event(event_name)
+  return vm.logs
+
+class TestArithmetic(unittest.TestCase):
+  def test_folded_operators(self) -> None:
+    logs = run_source('''
+      def _start():
+          Debug.Log(Object(7 / -2))
+          Debug.Log(Object(2147483647 + 1))
+          Debug.Log(Object(1 << 33))
+      ''')
+    self.assertEqual(logs, ['-3', '-2147483648', '2'])
+
+  def test_int_min_div_minus_one(self) -> None:
+    # Must throw at run time, not be folded at compile time. (Int32 % is not in the Udon method table.)
+    for code in ['''
+      def _start():
+          Debug.Log(Object((-2147483647 - 1) / -1))
+      ''', '''
+      def _start():
+          a = -2147483647 - 1
+          b = -1
+          Debug.Log(Object(a / b))
+      ''']:
+      with self.subTest(code=code):
+        with self.assertRaisesRegex(Exception, 'OverflowException'):
+          run_source(code)
+
+  def test_divide_by_zero(self) -> None:
+    with self.assertRaisesRegex(Exception, 'DivideByZeroException'):
+      run_source('''
+        def _start():
+            Debug.Log(Object(1 / 0))
+        ''')
+
+class TestSingleAssignment(unittest.TestCase):
+  def test_propagated_constant(self) -> None:
+    logs = run_source('''
+      def _start():
+          n_w = 5
+          n_h = 5
+          i = 0
+          while i < 2:
+              Debug.Log(Object(n_w * n_h + i))
+              i = i + 1
+      ''')
+    self.assertEqual(logs, ['25', '26'])
+
+  def test_conditional_assignment(self) -> None:
+    # x = 5 does not run before the read, so it must not be propagated.
+    logs = run_source('''
+      def _start():
+          i = 0
+          if i > 0:
+              x = 5
+          Debug.Log(Object(x))
+      ''')
+    self.assertEqual(logs, ['0'])
+
+  def test_cross_event_assignment(self) -> None:
+    # n and ready are assigned in _start only; _interact can run before it.
+    code = '''
+      def _start():
+          ready = True
+          n = 3
+
+      def _interact():
+          Debug.Log(Object(n))
+          if ready:
+              Debug.Log(Object(1))
+          else:
+              Debug.Log(Object(2))
+      '''
+    self.assertEqual(run_source(code, ['_interact', '_start', '_interact']), ['0', '2', '3', '1'])
+
+class TestControlFlow(unittest.TestCase):
+  def test_return_call(self) -> None:
+    logs = run_source('''
+      def double(x: Int32) -> Int32:
+          return x * 2
+
+      def quad(x: Int32) -> Int32:
+          return double(double(x))
+
+      def _start():
+          Debug.Log(Object(quad(3)))
+      ''')
+    self.assertEqual(logs, ['12'])
+
+  def test_nested_loops(self) -> None:
+    # break / continue of the outer loop after an inner loop
+    logs = run_source('''
+      def _start():
+          i = 0
+          while i < 4:
+              i = i + 1
+              j = 0
+              while True:
+                  j = j + 1
+                  if j >= i:
+                      break
+              if i == 2:
+                  continue
+              if i == 4:
+                  break
+              Debug.Log(Object(i * 10 + j))
+      ''')
+    self.assertEqual(logs, ['11', '33'])
+
+class TestDeadCode(unittest.TestCase):
+  def test_unused_throwing_extern(self) -> None:
+    # The result is not used, but the division still throws.
+    with self.assertRaisesRegex(Exception, 'DivideByZeroException'):
+      run_source('''
+        def _start():
+            a = 0
+            5 / a
+            Debug.Log(Object(a))
+        ''')
+
+  def test_unreachable_code(self) -> None:
+    logs = run_source('''
+      def f(x: Int32) -> Int32:
+          return x + 1
+          Debug.Log(Object('unreachable'))
+
+      def unused() -> Void:
+          Debug.Log(Object('unused'))
+
+      def _start():
+          if False:
+              Debug.Log(Object('no'))
+          Debug.Log(Object(f(1)))
+      ''')
+    self.assertEqual(logs, ['2'])
+
+  def test_reserved_name(self) -> None:
+    with self.assertRaisesRegex(Exception, 'reserved for the compiler'):
+      run_source('''
+        def _start():
+            __last = 1
+        ''')
+
+class TestPeephole(unittest.TestCase):
+  code = '''
+    def _start():
+        x = 1
+        arr = Int32Array.ctor(3)
+        arr[2] = 7
+        x = 7
+        Debug.Log(Object(x))
+        Debug.Log(Object(arr[2]))
+    '''
+
+  def test_void_extern(self) -> None:
+    # The void Set extern has no result, so temp_copy must not retarget its last argument.
+    self.assertEqual(run_source(self.code), ['7', '7'])
+
+  def test_no_rules(self) -> None:
+    self.assertEqual(run_source(self.code, options=CompileOptions(peephole_rules=())), ['7', '7'])
+
+class TestAssignment(unittest.TestCase):
+  def test_target_in_expression(self) -> None:
+    # The target is also read by the expression assigned to it.
+    logs = run_source('''
+      def add(a: Int32, b: Int32) -> Int32:
+          return a + b
+
+      def _start():
+          a = 1
+          b = 2
+          a = b - a
+          b = add(b, a) * b
+          s = 'x'
+          s = s + s
+          f = 1.5
+          f = Convert.ToSingle(a) + f
+          Debug.Log(Object(a))
+          Debug.Log(Object(b))
+          Debug.Log(Object(s))
+          Debug.Log(Object(f))
+      ''')
+    self.assertEqual(logs, ['1', '6', 'xx', '2.5'])
+
+class TestCoalesceTemps(unittest.TestCase):
+  def test_variable_read_by_another_event(self) -> None:
+    # last is live across events, so it must not share a slot with the temporaries of _start.
+    code = '''
+      def _start():
+          i = 0
+          while i < 2:
+              last = i * 3
+              i = i + 1
+          Debug.Log(Object(i * 100))
+
+      def _interact():
+          Debug.Log(Object(last))
+      '''
+    self.assertEqual(run_source(code, ['_start', '_interact']), ['200', '3'])
+
+  def test_reserved_name(self) -> None:
+    # A user name must not look like a temporary.
+    with self.assertRaisesRegex(Exception, 'reserved for the compiler'):
+      run_source('''
+        def _start():
+            i = 0
+            while i < 2:
+                __last = i * 3
+                i = i + 1
+
+        def _interact():
+            Debug.Log(Object(__last))
+        ''')
+
+class TestBoolOps(unittest.TestCase):
+  def test_short_circuit_side_effects(self) -> None:
+    logs = run_source('''
+      def init() -> Void:
+          calls = 0
+
+      def side(v: Boolean) -> Boolean:
+          calls = calls + 1
+          return v
+
+      def _start():
+          init()
+          if side(False) and side(True):
+              Debug.Log(Object('no'))
+          if side(True) or side(False):
+              Debug.Log(Object('or ok'))
+          Debug.Log(Object(calls))
+          a = side(True) and side(False)
+          b = side(False) or side(True)
+          Debug.Log(Object(a))
+          Debug.Log(Object(b))
+          Debug.Log(Object(calls))
+      ''')
+    self.assertEqual(logs, ['or ok', '2', 'False', 'True', '6'])
+
+class TestCommonSubexprs(unittest.TestCase):
+  def test_killed_by_call_and_write(self) -> None:
+    logs = run_source('''
+      def init() -> Void:
+          n = 1
+
+      def bump() -> Void:
+          n = n + 1
+
+      def _start():
+          init()
+          arr = Int32Array.ctor(2)
+          a = n * 3
+          x = arr[0] + 1
+          bump()
+          arr[0] = 5
+          b = n * 3
+          y = arr[0] + 1
+          Debug.Log(Object(a))
+          Debug.Log(Object(b))
+          Debug.Log(Object(x))
+          Debug.Log(Object(y))
+      ''')
+    self.assertEqual(logs, ['3', '6', '1', '6'])
+
+class TestLoops(unittest.TestCase):
+  def test_call_writes_loop_read_var(self) -> None:
+    # bump() writes n, so n * 2 must not be hoisted out of the loop.
+    logs = run_source('''
+      def init() -> Void:
+          n = 0
+
+      def bump() -> Void:
+          n = n + 1
+
+      def _start():
+          init()
+          i = 0
+          while i < 3:
+              bump()
+              m = n * 2
+              Debug.Log(Object(m))
+              i = i + 1
+      ''')
+    self.assertEqual(logs, ['2', '4', '6'])
+
+class TestInline(unittest.TestCase):
+  def test_early_return(self) -> None:
+    logs = run_source('''
+      def init() -> Void:
+          total = 0
+
+      @inline
+      def accumulate(v: Int32) -> Void:
+          i = 0
+          while i < v:
+              total = total + i * i
+              if total > 50:
+                  return
+              i = i + 1
+
+      def _start():
+          init()
+          accumulate(4)
+          Debug.Log(Object(total))
+          accumulate(10)
+          Debug.Log(Object(total))
+      ''')
+    self.assertEqual(logs, ['14', '69'])
+
+  def test_recursive_inline(self) -> None:
+    with self.assertRaisesRegex(Exception, 'A recursive function cannot be @inline'):
+      run_source('''
+        @inline
+        def countdown(v: Int32) -> Void:
+            if v > 0:
+                countdown(v - 1)
+
+        def _start():
+            countdown(3)
+        ''')
+
+class TestStaticFrames(unittest.TestCase):
+  def test_nested_calls(self) -> None:
+    logs = run_source('''
+      @noinline
+      def add(a: Int32, b: Int32) -> Int32:
+          return a + b
+
+      @noinline
+      def twice(a: Int32) -> Int32:
+          return add(a, a) + add(a, 1)
+
+      def _start():
+          Debug.Log(Object(twice(3)))
+          Debug.Log(Object(add(twice(1), 10)))
+      ''')
+    self.assertEqual(logs, ['10', '14'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,32 @@
+import sys
+import os
+import argparse
+from typing import *
+from libs.compile_server import *
+
+# Thin client of the compile server (udon_compiler.py --server).
+# It takes the same arguments as udon_compiler.py and does not load the compiler itself,
+# unless the server is not running.
+# (The server compiles with its own options. The other arguments are used when compiling in this process.)
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(description='UdonPie compile server client', add_help=True)
+  arg_parser.add_argument('input', help='input UdonPie source code path (ex: .\example.py)')
+  arg_parser.add_argument('output', help='output Udon Assembly code path (ex: .\example.uasm)')
+  arg_parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT, help='port of the compile server')
+  args, compile_args = arg_parser.parse_known_args()
+
+  # The server has its own working directory.
+  request = {'command': 'compile', 'input': os.path.abspath(args.input), 'output': os.path.abspath(args.output)}
+  try:
+    response = send_request(request, args.port)
+  except OSError:
+    # No server: compile in this process
+    print(f'udon_client: compile server (port {args.port}) is not running. Compiling in this process.', file=sys.stderr)
+    from udon_compiler import compile_file, make_arg_parser, compile_options_from_args, update_cache_stats
+    options = compile_options_from_args(make_arg_parser().parse_args([args.input, args.output] + compile_args))
+    result = compile_file(args.input, args.output, options)
+    update_cache_stats([result], options)
+    response = {'ok': result.error is None, 'error': result.error}
+  if not response['ok']:
+    print(response['error'])
@@ -1,4 +1,5 @@
 import sys
+import os
 import ast
 # Commented out because Pyinstaller failed to run.
 # import astor # type: ignore
@@ -6,50 +7,106 @@ import re
 import pprint as pp
 import argparse
 import traceback
+import json
+import multiprocessing
+import io
+import time
 from typing import *
+from typing import TextIO # not included in "from typing import *"
 from typing_extensions import Literal # 3.8: typing.Literal
 from libs.my_type import *
 from libs.tables import *
 from libs.udon_assembly import *
 from libs.udon_types import *
 from libs.event_data import *
+from libs.dotnet_ops import *
+from libs.ir import *
+from libs.ir_passes import *
+from libs.peephole import *
+from libs.compile_cache import *
+from libs.compile_server import *
 
 # python 3.6.8
 
+# Part of the compile cache key. Change it when the generated code changes.
+COMPILER_VERSION = '0.1.15'
+
+def strip_ignore_lines(code: str) -> str:
+  """
+  IGNORE annotation
+  I want to give the editor a hint as Python code, but write lines that I don't want to parse.
+  Delete the line containing IGNORE_LINE for that purpose.
+  example:
+  from. Udon_classes import * # IGNORE_LINE
+  """
+  code_lines = code.splitlines()
+  replaced_lines = [code_line if 'IGNORE_LINE' not in code_line else '' for code_line in code_lines]
+  return ''.join(f'{code_line}\n' for code_line in replaced_lines)
+
 class UdonCompiler:
   var_table: VarTable
   uasm: UdonAssembly
+  ir: IRBuilder
   def_func_table: DefFuncTable
   udon_method_table: UdonMethodTable
   node: ast.AST
   current_func_ret_type: Optional[UdonTypeName]
-  current_break_label: Optional[LabelName]
-  current_continue_label: Optional[LabelName]
+  current_break_block: Optional[BlockId]
+  current_continue_block: Optional[BlockId]
+  evaluated: bool
+  # Variables assigned only once in the whole program (see pre_check_assignments)
+  single_assign_names: Set[VarName]
+  # Constant propagation: variable -> the constant variable that replaces it
+  propagated_vars: Dict[VarName, VarName]
+  peephole_rules: Tuple[str, ...]
+  peephole_report: Optional[PeepholeReport]
+  # Functions with @inline (function id -> definition)
+  inline_func_defs: Dict[LabelName, ast.FunctionDef]
 
-  def __init__(self, code: str) -> None:
+  def __init__(self, code: str, udon_method_table: Optional[UdonMethodTable] = None,
+               peephole_rules: Tuple[str, ...] = PEEPHOLE_RULES) -> None:
+    # All compilers share one signature table unless a table is given explicitly.
+    self.udon_method_table = udon_method_table if udon_method_table is not None else get_udon_method_table()
     self.var_table = VarTable()
     self.def_func_table = DefFuncTable()
-    self.uasm = UdonAssembly(self.var_table, self.def_func_table)
-    self.udon_method_table = UdonMethodTable()
+    self.uasm = UdonAssembly(self.var_table, self.def_func_table, self.udon_method_table)
+    self.ir = IRBuilder()
     self.current_func_ret_type = None
-    self.current_break_label = None
-    self.current_continue_label = None
-
-    # IGNORE annotation
-    # I want to give the editor a hint as Python code, but write lines that I don't want to parse.
-    # Delete the line containing IGNORE_LINE for that purpose.
-    # example:
-    # from. Udon_classes import * # IGNORE_LINE
-    code_lines = code.splitlines()
-    replaced_code = ''
-    for code_line in code_lines:
-      if 'IGNORE_LINE' not in code_line:
-        replaced_code += f'{code_line}\n'
-      else:
-        replaced_code += f'\n'
-    self.node = ast.parse(replaced_code)
+    self.current_break_block = None
+    self.current_continue_block = None
+    self.evaluated = False
+    self.single_assign_names = set()
+    self.propagated_vars = {}
+    self.peephole_rules = peephole_rules
+    self.peephole_report = None
+    self.inline_func_defs = {}
+
+    self.node = ast.parse(strip_ignore_lines(code))
 
   def make_uasm_code(self) -> str:
+    sink = io.StringIO()
+    self.write_uasm_code(sink)
+    return sink.getvalue()
+
+  def write_uasm_code(self, sink: TextIO) -> None:
+    """
+    Compile and stream the .data and .code segments to sink (ex: output file).
+    The program text is never built as a whole.
+    """
+    self.eval_module()
+    self.var_table.write_data_seg(sink)
+    self.uasm.write_code_seg(sink)
+
+  def make_ir_text(self) -> str:
+    """IR of the program (as lowered to Udon Assembly)"""
+    self.eval_module()
+    return format_ir(self.ir.module, self.var_table)
+
+  def eval_module(self) -> None:
+    """Compile into IR, and lower it into instruction records (only once)"""
+    if self.evaluated:
+      return
+    self.evaluated = True
     # return address
     self.var_table.add_var(VarName('ret_addr'), UdonTypeName('UInt32'), '0xFFFFFFFF')
     # this
@@ -62,13 +119,48 @@ class UdonCompiler:
     node_body = cast(ast.Module, self.node)
     body: List[ast.stmt] = node_body.body
     self.pre_check_func_defs(body)
+    self.pre_check_assignments(node_body)
     self.eval_body(body)
+    self.check_inline_recursion()
+
+    # Inlining, dead code elimination, loop-invariant code motion and common subexpression elimination
+    removed_functions = optimize_module(self.ir.module, self.uasm.const_values, self.var_table)
+    # (The parameters of an inlined function are still used.)
+    used_vars = self.ir.module.used_vars()
+    for function in removed_functions:
+      for param in function.params:
+        if param not in used_vars:
+          self.var_table.remove_var(param)
+    # Non-recursive functions pass the arguments and the return value in fixed variables
+    use_static_frames(self.ir.module, self.var_table)
+    # Save only the variables that a call can overwrite and that are used after it
+    elide_call_saves(self.ir.module)
+    # Temporary variables share heap slots
+    coalesce_temps(self.ir.module, self.var_table)
+    self.uasm.lower_module(self.ir.module)
+    self.peephole_report = peephole_optimize(self.uasm, self.peephole_rules)
+    self.uasm.remove_unused_vars()
+    self.uasm.add_bool_const_init()
+    self.uasm.resolve_labels()
+    self.var_table.check_global_vars()
+
+  def get_inline_hint(self, funcdef_stmt: ast.FunctionDef) -> Optional[bool]:
+    """@inline: True, @noinline: False, no decorator: None (decided by the inliner)"""
+    inline_hint: Optional[bool] = None
+    for decorator in funcdef_stmt.decorator_list:
+      if not (type(decorator) is ast.Name and cast(ast.Name, decorator).id in ('inline', 'noinline')):
+        raise Exception(f'{decorator.lineno}:{decorator.col_offset} {self.print_ast(decorator)}: Unknown decorator. (Only @inline and @noinline are supported.)')
+      if inline_hint is not None:
+        raise Exception(f'{decorator.lineno}:{decorator.col_offset} {self.print_ast(decorator)}: Only one @inline or @noinline decorator can be used.')
+      inline_hint = cast(ast.Name, decorator).id == 'inline'
+    return inline_hint
 
-    ret_code: str = ''
-    ret_code += self.var_table.make_data_seg()
-    ret_code += self.uasm.make_code_seg()
-    ret_code = self.uasm.replace_tmp_adrr(ret_code)
-    return ret_code
+  def check_inline_recursion(self) -> None:
+    """A recursive function cannot be expanded, so @inline on it is an error."""
+    recursive = find_recursive_functions(self.ir.module)
+    for func_id, funcdef_stmt in self.inline_func_defs.items():
+      if func_id in recursive:
+        raise Exception(f'{funcdef_stmt.lineno}:{funcdef_stmt.col_offset} {funcdef_stmt.name}: A recursive function cannot be @inline.')
 
   def print_ast(self, node: ast.AST) -> str:
     return node.__class__.__name__
@@ -106,6 +198,66 @@ class UdonCompiler:
           # Add to function table
           self.def_func_table.add_func(FuncName(func_name), tuple(arg_types), ret_type, tuple(arg_var_names))
 
+  def pre_check_assignments(self, node: ast.Module) -> None:
+    """
+    Find the variables that are assigned exactly once in the whole program
+    (all functions and events), where the assignment runs before every read.
+    If the value is a constant, the variable is replaced by the constant
+    (constant propagation, see eval_stmt).
+    Global variables (can be set from outside) and arguments are excluded.
+    """
+    assign_counts: Dict[VarName, int] = {}
+    excluded_names: Set[VarName] = set()
+    for sub_node in ast.walk(node):
+      # Names starting with '__' are the compiler's temporaries and constants (see is_temp_var).
+      if type(sub_node) is ast.Name or type(sub_node) is ast.arg:
+        name = cast(ast.Name, sub_node).id if type(sub_node) is ast.Name else cast(ast.arg, sub_node).arg
+        if name.startswith('__'):
+          raise Exception(f'{sub_node.lineno}:{sub_node.col_offset} {self.print_ast(sub_node)}: Names starting with "__" are reserved for the compiler.')
+      if type(sub_node) is ast.Assign:
+        for target in cast(ast.Assign, sub_node).targets:
+          if type(target) is ast.Name:
+            target_name = VarName(cast(ast.Name, target).id)
+            assign_counts[target_name] = assign_counts.get(target_name, 0) + 1
+      elif type(sub_node) is ast.AugAssign:
+        target = cast(ast.AugAssign, sub_node).target
+        if type(target) is ast.Name:
+          excluded_names.add(VarName(cast(ast.Name, target).id))
+      elif type(sub_node) is ast.Global:
+        excluded_names.update(VarName(name) for name in cast(ast.Global, sub_node).names)
+      elif type(sub_node) is ast.arg:
+        excluded_names.add(VarName(cast(ast.arg, sub_node).arg))
+
+    # The assignment runs before every read if it is a statement of a function body itself
+    # (not in an if / while), and every read is in a later statement of the same function.
+    # (Another event can run before the assignment, and a branch can skip it.)
+    # position: (index of the function, index of the statement in the function body)
+    assign_positions: Dict[VarName, Tuple[int, int]] = {}
+    read_positions: Dict[VarName, List[Tuple[int, int]]] = {}
+    for func_index, module_stmt in enumerate(node.body):
+      func_body = cast(ast.FunctionDef, module_stmt).body if type(module_stmt) is ast.FunctionDef else [module_stmt]
+      for stmt_index, stmt in enumerate(func_body):
+        position = (func_index, stmt_index) if type(module_stmt) is ast.FunctionDef else (-1, -1)
+        if type(stmt) is ast.Assign:
+          for target in cast(ast.Assign, stmt).targets:
+            if type(target) is ast.Name:
+              assign_positions[VarName(cast(ast.Name, target).id)] = position
+        for sub_node in ast.walk(stmt):
+          if type(sub_node) is ast.Name and type(cast(ast.Name, sub_node).ctx) is ast.Load:
+            read_positions.setdefault(VarName(cast(ast.Name, sub_node).id), []).append(position)
+
+    def runs_before_reads(var_name: VarName) -> bool:
+      if var_name not in assign_positions:
+        return False
+      assign_func_index, assign_stmt_index = assign_positions[var_name]
+      return assign_func_index != -1 and all(
+        func_index == assign_func_index and stmt_index > assign_stmt_index
+        for func_index, stmt_index in read_positions.get(var_name, []))
+
+    self.single_assign_names = set(
+      var_name for var_name, count in assign_counts.items()
+      if count == 1 and var_name not in excluded_names and runs_before_reads(var_name))
+
   def eval_body(self, body: List[ast.stmt]) -> None:
     stmt: ast.stmt
     for stmt in body:
@@ -123,16 +275,27 @@ class UdonCompiler:
     #  | Assign(expr* targets, expr value)
     elif type(stmt) is ast.Assign:
       assign: ast.Assign = cast(ast.Assign, stmt)
+      dist_var_name: Optional[VarName] = None
+      if type(assign.targets[0]) is ast.Name:
+        # FORCE CAST
+        dist_var_name = self.var_table.resolve_varname(
+          VarName(cast(ast.Name, assign.targets[0]).id))
       # right expression
-      src_var_name: Optional[VarName] = self.eval_expr(assign.value)
+      # (The result is written directly into the left variable if the types match.)
+      src_var_name: Optional[VarName] = self.eval_expr(assign.value, dist_var_name)
       if src_var_name is None:
         raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: There is no value on the right side of the assignment statement.')
       # left expression
-      if type(assign.targets[0]) is ast.Name:
-        # FORCE CAST
-        dist_var_name: VarName = self.var_table.resolve_varname(
-          VarName(cast(ast.Name, assign.targets[0]).id))
-        self.uasm.assign(dist_var_name, src_var_name)
+      if dist_var_name is not None:
+        if src_var_name == dist_var_name:
+          pass
+        # Constant propagation: a variable that only ever holds one constant is not stored,
+        # and its uses refer to the constant. (As if it were initialized with the constant.)
+        elif (dist_var_name in self.single_assign_names and src_var_name in self.uasm.const_values
+              and not self.var_table.exist_var(dist_var_name)):
+          self.propagated_vars[dist_var_name] = src_var_name
+        else:
+          self.assign(dist_var_name, src_var_name)
       elif type(assign.targets[0]) is ast.Subscript:
         # FORCE CAST
         subscript_expr: ast.Subscript = cast(ast.Subscript, assign.targets[0])
@@ -156,66 +319,60 @@ class UdonCompiler:
     # | If(expr test, stmt* body, stmt* orelse)
     elif type(stmt) is ast.If:
       if_stmt: ast.If = cast(ast.If, stmt) # FORCE CAST
-      else_label = LabelName(self.uasm.get_next_id('else_label'))
-      if_end_label = LabelName(self.uasm.get_next_id('if_end_label'))
-
-      test_result_var_name = self.eval_expr(if_stmt.test)
-      if test_result_var_name is None:
-        raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: There is no value for the conditional expression.')
-
-      if self.var_table.get_var_type(test_result_var_name) != UdonTypeName('Boolean'):
-        raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: There is no value for the conditional expression.')
-      self.uasm.push_var(test_result_var_name)
-      # if (!test) goto else
-      self.uasm.jump_if_false_label(else_label)
+      then_block = self.ir.new_block()
+      else_block = self.ir.new_block()
+      if_end_block = self.ir.new_block()
+      # if (test) goto then else goto else
+      self.eval_cond(if_stmt.test, then_block, else_block)
       # {}
+      self.ir.set_block(then_block)
       self.eval_body(if_stmt.body)
       # goto if_end
-      self.uasm.jump_label(if_end_label)
+      self.ir.jump(if_end_block)
       # else:
-      self.uasm.add_label_crrent_addr(else_label)
+      self.ir.set_block(else_block)
       self.eval_body(if_stmt.orelse)
+      self.ir.jump(if_end_block)
       # if_end:
-      self.uasm.add_label_crrent_addr(if_end_label)
+      self.ir.set_block(if_end_block)
 
     # While statment
     # | While(expr test, stmt* body, stmt* orelse)
     # orelse is not implemented
     elif type(stmt) is ast.While:
       while_stmt: ast.While = cast(ast.While, stmt) # FORCE CAST
-      while_label = LabelName(self.uasm.get_next_id('while_label'))
-      while_end_label = LabelName(self.uasm.get_next_id('while_end_label'))
-      self.current_break_label = while_end_label
-      self.current_continue_label = while_label
-      # while_label:
-      self.uasm.add_label_crrent_addr(while_label)
-      test_result_var_name = self.eval_expr(while_stmt.test)
-      if test_result_var_name is None:
-        raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: There is no value for the conditional expression.')
-
-      if self.var_table.get_var_type(test_result_var_name) != UdonTypeName('Boolean'):
-        raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: There is no value for the conditional expression.')
-      self.uasm.push_var(test_result_var_name)
-      # if (!test) goto else
-      self.uasm.jump_if_false_label(while_end_label)
+      while_block = self.ir.new_block()
+      while_body_block = self.ir.new_block()
+      while_end_block = self.ir.new_block()
+      # (restored after the loop for the break / continue of an outer loop)
+      outer_break_block = self.current_break_block
+      outer_continue_block = self.current_continue_block
+      self.current_break_block = while_end_block
+      self.current_continue_block = while_block
+      # while:
+      self.ir.jump(while_block)
+      self.ir.set_block(while_block)
+      # if (test) goto body else goto while_end
+      self.eval_cond(while_stmt.test, while_body_block, while_end_block)
       # {}
+      self.ir.set_block(while_body_block)
       self.eval_body(while_stmt.body)
       # goto while:
-      self.uasm.jump_label(while_label)
+      self.ir.jump(while_block)
       # while_end:
-      self.uasm.add_label_crrent_addr(while_end_label)
-      self.current_break_label = None
-      self.current_continue_label = None
+      self.ir.set_block(while_end_block)
+      self.current_break_block = outer_break_block
+      self.current_continue_block = outer_continue_block
     # | Break
     elif type(stmt) is ast.Break:
-      if self.current_break_label is None:
+      if self.current_break_block is None:
         raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: The "break" statement can only be used inside a loop.')
-      self.uasm.jump_label(self.current_break_label)
+      self.ir.jump(self.current_break_block)
     # | Continue
     elif type(stmt) is ast.Continue:
-      if self.current_continue_label is None:
+      if self.current_continue_block is None:
         raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: The "continue" statement can only be used inside a loop.')
-      self.uasm.jump_label(self.current_continue_label)
+      self.ir.jump(self.current_continue_block)
       
     # | Pass
     elif type(stmt) is ast.Pass:
@@ -230,12 +387,13 @@ class UdonCompiler:
       func_name:FuncName = FuncName(funcdef_stmt.name)
       # Functions starting with an underscore are events
       if func_name.startswith('_'):
+        if len(funcdef_stmt.decorator_list) > 0:
+          raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: Events cannot have decorators.')
         event_name: EventName = EventName(func_name)
         def_arg_var_names: List[VarName]  = [VarName(arg.arg) for arg in funcdef_stmt.args.args]
-        self.uasm.env_vars = def_arg_var_names 
         # FORCE CAST, NO CHECK
         def_arg_types: List[UdonTypeName] = [UdonTypeName(arg.annotation.id) for arg in funcdef_stmt.args.args]  # type: ignore
-        self.uasm.event_head(event_name) 
+        self.ir.begin_function(event_name, True, [], def_arg_var_names)
 
         # Copy event arguments to defined formal arguments.
         if event_name in event_table:
@@ -243,13 +401,11 @@ class UdonCompiler:
           pair_var_names_var_types =  zip(table_arg_type_and_names, def_arg_var_names, def_arg_types)
           for ((table_arg_type_name, table_arg_name), def_arg_var_name, def_arg_type) in pair_var_names_var_types:
             self.var_table.add_var(def_arg_var_name, def_arg_type, 'null')
-            self.uasm.assign(def_arg_var_name, VarName(table_arg_name))
+            self.assign(def_arg_var_name, VarName(table_arg_name))
 
-        # TODO: FIX
-        self.uasm.set_uint32(VarName('ret_addr'), 0xFFFFFF)
         self.eval_body(funcdef_stmt.body)
-        self.uasm.end()
-        self.uasm.env_vars = []
+        # event end
+        self.ir.end_function()
 
       # Otherwise, the defined function
       else:
@@ -257,9 +413,7 @@ class UdonCompiler:
         arg_types: List[UdonTypeName] = [UdonTypeName(arg.annotation.id) for arg in funcdef_stmt.args.args]  # type: ignore
         func_label_name = LabelName(self.def_func_table.get_function_id(func_name, arg_types))
         arg_var_names: List[VarName]  = [VarName(f'{func_label_name}_{arg.arg}') for arg in funcdef_stmt.args.args]
-        self.uasm.env_vars = arg_var_names
         self.var_table.current_func_id = func_label_name
-        self.uasm.add_label_crrent_addr(func_label_name)
         # FORCE CAST, NO CHECK
         arg_var_name_types: List[Tuple[VarName, UdonTypeName]] = zip(arg_var_names, arg_types) # type: ignore
         ret_type: UdonTypeName
@@ -273,15 +427,15 @@ class UdonCompiler:
         # Add argment tmp variables
         for arg_var_name, arg_type in arg_var_name_types:
           self.var_table.add_var(arg_var_name, arg_type, 'null')
-        # Pop Argument
-        self.uasm.pop_vars(arg_var_names)
+        inline_hint = self.get_inline_hint(funcdef_stmt)
+        if inline_hint is True:
+          self.inline_func_defs[func_label_name] = funcdef_stmt
+        # The arguments are popped at the function entry.
+        self.ir.begin_function(func_label_name, False, arg_var_names, arg_var_names, inline_hint)
         # Eval Function body
         self.eval_body(funcdef_stmt.body)
-        # Pop Return Address
-        self.uasm.pop_var(VarName('ret_addr'))
         # Return
-        self.uasm.jump_ret_addr()
-        self.uasm.env_vars = []
+        self.ir.end_function()
 
         self.var_table.current_func_id = None
         self.current_func_ret_type = None
@@ -302,16 +456,13 @@ class UdonCompiler:
     elif type(stmt) is ast.Return:
       # FORCE CAST
       return_stmt: ast.Return = cast(ast.Return, stmt)
-      # Pop Return Address
-      self.uasm.pop_var(VarName('ret_addr'))
+      ret_var_name: Optional[VarName] = None
       # If return statement with expression
       if return_stmt.value is not None:
         # Eval return expression
         ret_var_name = self.eval_expr(return_stmt.value)
         if ret_var_name is None:
           raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: Missing value for return expression.')
-        # Push Retern value
-        self.uasm.push_var(ret_var_name)
         ret_var_type = self.var_table.get_var_type(ret_var_name)
         if self.current_func_ret_type != None and ret_var_type != self.current_func_ret_type:
           raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: Return expression type "{ret_var_type}" does not match return type "{self.current_func_ret_type}" in the function definition.')
@@ -322,7 +473,7 @@ class UdonCompiler:
           raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: ReThis function returns a value of type "{self.current_func_ret_type}", but did not return a value in the return statement.')
 
       # Return
-      self.uasm.jump_ret_addr()
+      self.ir.ret(ret_var_name)
     # The compiler skips Import and ImportFrom statements to complete the editor using Python class files.
     # (The compiler does not raise an error when reading Import / ImportFrom statements.)
     elif type(stmt) is ast.Import:
@@ -339,9 +490,10 @@ class UdonCompiler:
       raise Exception(f'{stmt.lineno}:{stmt.col_offset} {self.print_ast(stmt)}: Unsupported statement {type(stmt)}.')
 
 
-  def eval_expr(self, expr: ast.expr) -> Optional[VarName]:
+  def eval_expr(self, expr: ast.expr, dst_var_name: Optional[VarName] = None) -> Optional[VarName]:
     """
     Eval expression
+    dst_var_name: the variable the value is assigned to (see get_result_var)
     """
     _call: ast.Call
     # number Expression
@@ -349,51 +501,49 @@ class UdonCompiler:
     if type(expr) is ast.Num:
       # FORCE CAST
       num: ast.Num = cast(ast.Num, expr)
-      const_var_name = VarName(self.uasm.get_next_id('const'))
+      const_var_name: Optional[VarName]
       if type(num.n) is int:
-        self.var_table.add_var(const_var_name, UdonTypeName('Int32'), f'{num.n}')
+        const_var_name = self.uasm.get_value_const_var(UdonTypeName('Int32'), num.n)
+        # Out of Int32 range: left to the Udon assembler as it is written
+        return const_var_name if const_var_name is not None else self.uasm.get_const_var(UdonTypeName('Int32'), f'{num.n}')
       elif type(num.n) is float:
-        self.var_table.add_var(const_var_name, UdonTypeName('Single'), f'{num.n}')
-      return const_var_name
+        const_var_name = self.uasm.get_value_const_var(UdonTypeName('Single'), single(cast(float, num.n)))
+        return const_var_name if const_var_name is not None else self.uasm.get_const_var(UdonTypeName('Single'), f'{num.n}')
+      else:
+        raise Exception(f'{expr.lineno}:{expr.col_offset} {self.print_ast(expr)}: Only Int32 and Single number literals are supported.')
 
     # string Expression
     # | Str(string s) -- need to specify raw, unicode, etc?
     elif type(expr) is ast.Str:
       # FORCE CAST
       _str: ast.Str = cast(ast.Str, expr)
-      const_var_name = VarName(self.uasm.get_next_id('const'))
-      self.var_table.add_var(const_var_name, UdonTypeName('String'), f'"{_str.s}"')
-      return const_var_name
+      const_var_name = self.uasm.get_value_const_var(UdonTypeName('String'), _str.s)
+      return const_var_name if const_var_name is not None else self.uasm.get_const_var(UdonTypeName('String'), f'"{_str.s}"')
 
     # Embedded Constant Expression
     # | NameConstant(singleton value)
     elif type(expr) is ast.NameConstant:
       # FORCE CAST
       _const: ast.NameConstant = cast(ast.NameConstant, expr)
-      const_var_name = VarName(self.uasm.get_next_id('const'))
-      if type(_const.value) is bool and _const.value == True:
-        self.var_table.add_var(const_var_name, UdonTypeName('Boolean'), f'null')
-        self.uasm.set_bool(const_var_name, True)
-      elif type(_const.value) is bool and _const.value == False:
-        self.var_table.add_var(const_var_name, UdonTypeName('Boolean'), f'null')
-        self.uasm.set_bool(const_var_name, False)
-      elif _const.value is None:
-        self.var_table.add_var(const_var_name, UdonTypeName('Object'), f'null')
-      return const_var_name
+      if type(_const.value) is bool:
+        return self.uasm.get_bool_const_var(_const.value)
+      else:
+        return self.uasm.get_const_var(UdonTypeName('Object'), 'null')
 
     # Variable Expression
     # | Name(identifier id, expr_context ctx)
     elif type(expr) is ast.Name:
       # FORCE CAST
       name: ast.Name = cast(ast.Name, expr)
-      return self.var_table.resolve_varname(VarName(name.id))
+      var_name = self.var_table.resolve_varname(VarName(name.id))
+      return self.propagated_vars.get(var_name, var_name)
 
     # Call Expression
     # | Call(expr func, expr* args, keyword* keywords)
     elif type(expr) is ast.Call:
       # FORCE CAST
       _call = cast(ast.Call, expr)
-      return self.eval_call(_call)
+      return self.eval_call(_call, dst_var_name)
 
     # Unary Expression
     #  | UnaryOp(unaryop op, expr operand)
@@ -423,9 +573,11 @@ class UdonCompiler:
       else:
         raise Exception(f'{unary_expr.lineno}:{unary_expr.col_offset} {self.print_ast(unary_expr)}: {func_name} of {operand_var_type} is undefined.')
       
-      unop_result_var_name = VarName(self.uasm.get_next_id('unop'))
-      self.var_table.add_var(unop_result_var_name, ret_type, 'null')
-      self.uasm.call_extern(extern_str, [operand_var_name, unop_result_var_name])
+      folded_var_name = self.fold_extern(extern_str, [operand_var_name], ret_type)
+      if folded_var_name is not None:
+        return folded_var_name
+      unop_result_var_name = self.get_result_var(dst_var_name, ret_type, 'unop')
+      self.ir.extern(extern_str, [operand_var_name], unop_result_var_name)
       return unop_result_var_name
 
     # Binary Expression
@@ -496,9 +648,11 @@ class UdonCompiler:
         ret_type, extern_str = ret_type_extern_str
       else:
         raise Exception(f'{bin_expr.lineno}:{bin_expr.col_offset} {self.print_ast(expr)}: {func_name} of {left_var_type} and {right_var_type} is undefined.')
-      binop_result_var_name = VarName(self.uasm.get_next_id('binop'))
-      self.var_table.add_var(binop_result_var_name, ret_type, 'null')
-      self.uasm.call_extern(extern_str, [binop_left_var_name, binop_right_var_name, binop_result_var_name])
+      folded_var_name = self.fold_extern(extern_str, [binop_left_var_name, binop_right_var_name], ret_type)
+      if folded_var_name is not None:
+        return folded_var_name
+      binop_result_var_name = self.get_result_var(dst_var_name, ret_type, 'binop')
+      self.ir.extern(extern_str, [binop_left_var_name, binop_right_var_name], binop_result_var_name)
       return binop_result_var_name
 
   
@@ -510,8 +664,6 @@ class UdonCompiler:
       if not (len(compare.ops) == 1 and len(compare.comparators) == 1):
         raise Exception(f'{compare.lineno}:{compare.col_offset} {self.print_ast(compare)}: Comparison of comparison operators is limited to one by one. (0 <= a <100 cannot be written)')
 
-      compare_result_var_name = VarName(self.uasm.get_next_id('compare'))
-      self.var_table.add_var(compare_result_var_name, UdonTypeName('Boolean'), 'null')
       op = compare.ops[0]
       comparator = compare.comparators[0]
       compare_left_var_name = self.eval_expr(compare.left)
@@ -554,7 +706,11 @@ class UdonCompiler:
       else:
         raise Exception(f'{compare.lineno}:{compare.col_offset} {self.print_ast(expr)}: {func_name} of {left_var_type} and {right_var_type} is undefined.')
 
-      self.uasm.call_extern(extern_str, [compare_left_var_name, compare_right_var_name, compare_result_var_name])
+      folded_var_name = self.fold_extern(extern_str, [compare_left_var_name, compare_right_var_name], ret_type)
+      if folded_var_name is not None:
+        return folded_var_name
+      compare_result_var_name = self.get_result_var(dst_var_name, UdonTypeName('Boolean'), 'compare')
+      self.ir.extern(extern_str, [compare_left_var_name, compare_right_var_name], compare_result_var_name)
       return compare_result_var_name
 
     # Logical operator expression
@@ -566,9 +722,12 @@ class UdonCompiler:
       if len(bool_expr.values) != 2 :
         raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: Logical operators ("and" and "or") cannot be written consecutively ("A and B and C" must be written as "(A and B) and C").')
       binop_left_var_name = self.eval_expr(bool_expr.values[0])
-      binop_right_var_name = self.eval_expr(bool_expr.values[1])
       if binop_left_var_name is None:
         raise Exception(f'{expr.lineno}:{expr.col_offset} {self.print_ast(expr)}: There is no value on the left side of Logical Binary Expression.')
+      # Boolean: the right side is evaluated only if it is needed
+      if self.var_table.get_var_type(binop_left_var_name) == UdonTypeName('Boolean'):
+        return self.eval_short_circuit(bool_expr, binop_left_var_name, dst_var_name)
+      binop_right_var_name = self.eval_expr(bool_expr.values[1])
       if binop_right_var_name is None:
         raise Exception(f'{expr.lineno}:{expr.col_offset} {self.print_ast(expr)}: There is no value on the right side of Logical Binary Expression.')
       left_var_type = self.var_table.get_var_type(binop_left_var_name)
@@ -592,10 +751,12 @@ class UdonCompiler:
       else:
         raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(expr)}: {func_name} of {left_var_type} and {right_var_type} is undefined.')
 
-      binop_result_var_name = VarName(self.uasm.get_next_id('boolop'))
-      self.var_table.add_var(binop_result_var_name, ret_type, 'null')
+      folded_var_name = self.fold_extern(extern_str, [binop_left_var_name, binop_right_var_name], ret_type)
+      if folded_var_name is not None:
+        return folded_var_name
+      binop_result_var_name = self.get_result_var(dst_var_name, ret_type, 'boolop')
 
-      self.uasm.call_extern(extern_str, [binop_left_var_name, binop_right_var_name, binop_result_var_name])
+      self.ir.extern(extern_str, [binop_left_var_name, binop_right_var_name], binop_result_var_name)
       return binop_result_var_name
     
     # Subscript Expression
@@ -609,13 +770,128 @@ class UdonCompiler:
 
       index_value:ast.expr  = subscript_expr.slice.value # type: ignore
       _call = ast.Call(func=ast.Attribute(value=subscript_expr.value, attr="Get"), args=[index_value])
-      return self.eval_call(_call)
+      return self.eval_call(_call, dst_var_name)
     else:
       raise Exception(f'{expr.lineno}:{expr.col_offset} {self.print_ast(expr)}: Unsupported expression {type(expr)}.')
 
+  def eval_cond(self, test: ast.expr, true_block: BlockId, false_block: BlockId) -> None:
+    """
+    Branch to true_block or false_block by a condition.
+    "and" / "or" / "not" are lowered to branches (short-circuit evaluation).
+    """
+    if type(test) is ast.BoolOp:
+      # FORCE CAST
+      bool_expr: ast.BoolOp = cast(ast.BoolOp, test)
+      if len(bool_expr.values) != 2 :
+        raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: Logical operators ("and" and "or") cannot be written consecutively ("A and B and C" must be written as "(A and B) and C").')
+      right_block = self.ir.new_block()
+      # and: if (!left) goto false
+      if type(bool_expr.op) is ast.And:
+        self.eval_cond(bool_expr.values[0], right_block, false_block)
+      # or: if (left) goto true
+      elif type(bool_expr.op) is ast.Or:
+        self.eval_cond(bool_expr.values[0], true_block, right_block)
+      else:
+        raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: Unsupported binary compare operator')
+      self.ir.set_block(right_block)
+      self.eval_cond(bool_expr.values[1], true_block, false_block)
+    # not
+    elif type(test) is ast.UnaryOp and type(cast(ast.UnaryOp, test).op) is ast.Not:
+      self.eval_cond(cast(ast.UnaryOp, test).operand, false_block, true_block)
+    else:
+      test_result_var_name = self.eval_expr(test)
+      if test_result_var_name is None or self.var_table.get_var_type(test_result_var_name) != UdonTypeName('Boolean'):
+        raise Exception(f'{test.lineno}:{test.col_offset} {self.print_ast(test)}: There is no value for the conditional expression.')
+      self.ir.branch(test_result_var_name, true_block, false_block)
+
+  def eval_short_circuit(self, bool_expr: ast.BoolOp, left_var_name: VarName,
+                         dst_var_name: Optional[VarName]) -> VarName:
+    """
+    Value of "left and right" / "left or right" (Boolean)
+    The right side is evaluated only if the left side does not decide the value.
+    """
+    if type(bool_expr.op) is ast.And:
+      is_and = True
+    elif type(bool_expr.op) is ast.Or:
+      is_and = False
+    else:
+      raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: Unsupported binary compare operator')
+    right_expr = bool_expr.values[1]
+    # Constant left side (True and x -> x, False and x -> False)
+    if left_var_name in self.uasm.const_values:
+      if self.uasm.const_values[left_var_name] != is_and:
+        return left_var_name
+      right_var_name = self.eval_expr(right_expr, dst_var_name)
+      self.check_short_circuit_right(bool_expr, right_var_name)
+      return cast(VarName, right_var_name)
+
+    result_var_name = self.get_result_var(dst_var_name, UdonTypeName('Boolean'), 'boolop')
+    right_block = self.ir.new_block()
+    # the left side decides the value
+    short_block = self.ir.new_block()
+    end_block = self.ir.new_block()
+    if is_and:
+      self.ir.branch(left_var_name, right_block, short_block)
+    else:
+      self.ir.branch(left_var_name, short_block, right_block)
+    # The taken side of the branch is placed next.
+    for block in ([right_block, short_block] if is_and else [short_block, right_block]):
+      self.ir.set_block(block)
+      if block == right_block:
+        right_var_name = self.eval_expr(right_expr, result_var_name)
+        self.check_short_circuit_right(bool_expr, right_var_name)
+        if right_var_name != result_var_name:
+          self.assign(result_var_name, cast(VarName, right_var_name))
+      elif left_var_name != result_var_name:
+        self.assign(result_var_name, left_var_name)
+      self.ir.jump(end_block)
+    self.ir.set_block(end_block)
+    return result_var_name
+
+  def check_short_circuit_right(self, bool_expr: ast.BoolOp, right_var_name: Optional[VarName]) -> None:
+    if right_var_name is None:
+      raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: There is no value on the right side of Logical Binary Expression.')
+    right_var_type = self.var_table.get_var_type(right_var_name)
+    if right_var_type != UdonTypeName('Boolean'):
+      func_name = 'op_LogicalAnd' if type(bool_expr.op) is ast.And else 'op_LogicalOr'
+      raise Exception(f'{bool_expr.lineno}:{bool_expr.col_offset} {self.print_ast(bool_expr)}: {func_name} of Boolean and {right_var_type} is undefined.')
+
+  def fold_extern(self, extern_str: ExternStr, arg_var_names: List[VarName], ret_type: UdonTypeName) -> Optional[VarName]:
+    """
+    Constant folding: evaluate an extern without side effects at compile time
+    if all the arguments are constants. Returns the variable of the result constant.
+    """
+    if extern_str not in pure_extern_dict:
+      return None
+    if not all(arg_var_name in self.uasm.const_values for arg_var_name in arg_var_names):
+      return None
+    _, func = pure_extern_dict[extern_str]
+    try:
+      value = func(*[self.uasm.const_values[arg_var_name] for arg_var_name in arg_var_names])
+    except DotNetException:
+      # e.g. 1 / 0 is left to throw at runtime.
+      return None
+    return self.uasm.get_value_const_var(ret_type, value)
+
+  def get_result_var(self, dst_var_name: Optional[VarName], ret_type: UdonTypeName, id_name: str) -> VarName:
+    """
+    Variable for the result of an expression.
+    The variable assigned to (dst_var_name) is used if it has the same type (or is not declared yet),
+    so that the result does not go through a temporary variable.
+    """
+    if dst_var_name is not None:
+      if not self.var_table.exist_var(dst_var_name):
+        self.var_table.add_var(dst_var_name, ret_type, 'null')
+        return dst_var_name
+      if self.var_table.get_var_type(dst_var_name) == ret_type:
+        return dst_var_name
+    result_var_name = VarName(self.uasm.get_next_id(id_name))
+    self.var_table.add_var(result_var_name, ret_type, 'null')
+    return result_var_name
+
   # Call Expression
   # | Call(expr func, expr* args, keyword* keywords)
-  def eval_call(self, call: ast.Call) -> Optional[VarName]:
+  def eval_call(self, call: ast.Call, dst_var_name: Optional[VarName] = None) -> Optional[VarName]:
     arg_var_names: List[Optional[VarName]] = [self.eval_expr(arg_var_name) for arg_var_name in call.args]
     for i, arg_var_name in enumerate(arg_var_names):
       if arg_var_name is None:
@@ -627,21 +903,23 @@ class UdonCompiler:
     # AAA.BBBB(arg, ...)
     if type(call.func) is ast.Attribute:
       # FORCE CAST
-      return self.eval_call_with_dot(call, arg_var_names, arg_var_types) # type: ignore
+      return self.eval_call_with_dot(call, arg_var_names, arg_var_types, dst_var_name) # type: ignore
     # AAA(arg, ...)
     elif type(call.func) is ast.Name:
       # FORCE CAST
-      return self.eval_call_without_dot(call, arg_var_names, arg_var_types) # type: ignore
+      return self.eval_call_without_dot(call, arg_var_names, arg_var_types, dst_var_name) # type: ignore
     else:
       raise Exception(f'{self.print_ast(call)}: Unsupported function type operator {type(call.func)}')
 
-  def eval_call_with_dot(self, call: ast.Call, arg_var_names: List[VarName], arg_var_types: List[UdonTypeName]) -> Optional[VarName]:
+  def eval_call_with_dot(self, call: ast.Call, arg_var_names: List[VarName], arg_var_types: List[UdonTypeName],
+                         dst_var_name: Optional[VarName] = None) -> Optional[VarName]:
     func_expr: ast.expr = cast(ast.expr, call.func)
-    call_result_var_name = VarName(self.uasm.get_next_id('call'))
+    call_result_var_name: VarName
     # StaticFunc, Constructor
     # FORCE CAST, NO CHECK
     # BAD CODE
-    if type(func_expr.value) is ast.Name and not self.var_table.exist_var(func_expr.value.id):  # type: ignore
+    if (type(func_expr.value) is ast.Name and not self.var_table.exist_var(func_expr.value.id)  # type: ignore
+        and func_expr.value.id not in self.propagated_vars):  # type: ignore
       # FORCE CAST, NO CHECK
       module_type: UdonTypeName = UdonTypeName(f'{call.func.value.id}')  # type: ignore
       # FORCE CAST, NO CHECK
@@ -657,21 +935,21 @@ class UdonCompiler:
       if static_func_type_extern_str is not None:
         ret_type, extern_str = static_func_type_extern_str
         if ret_type != UdonTypeName('None'):
-          self.var_table.add_var(call_result_var_name, ret_type, 'null')
-          self.uasm.call_extern(extern_str, arg_var_names + [call_result_var_name])
+          call_result_var_name = self.get_result_var(dst_var_name, ret_type, 'call')
+          self.ir.extern(extern_str, arg_var_names, call_result_var_name)
           return call_result_var_name
         else:
-          self.uasm.call_extern(extern_str, arg_var_names)
+          self.ir.extern(extern_str, arg_var_names)
           return None
       # Constructor
       elif constructor_func_type_extern_str is not None:
         ret_type, extern_str = constructor_func_type_extern_str 
         if ret_type != UdonTypeName('None'):
-          self.var_table.add_var(call_result_var_name, ret_type, 'null')
-          self.uasm.call_extern(extern_str, arg_var_names + [call_result_var_name])
+          call_result_var_name = self.get_result_var(dst_var_name, ret_type, 'call')
+          self.ir.extern(extern_str, arg_var_names, call_result_var_name)
           return call_result_var_name
         else:
-          self.uasm.call_extern(extern_str, arg_var_names) 
+          self.ir.extern(extern_str, arg_var_names) 
           return None
       else:
         raise Exception(f'{call.func.value.lineno}:{call.func.value.col_offset} {self.print_ast(call)}: Udon method "{module_type}.{udon_method_name}" not found. Is the variable "{module_type}" spelled correctly?') 
@@ -693,17 +971,17 @@ class UdonCompiler:
       if instance_func_type_extern_str is not None:
         ret_type, extern_str = instance_func_type_extern_str
         if ret_type != UdonTypeName('None'):
-          self.var_table.add_var(call_result_var_name, ret_type, 'null')
-          self.uasm.call_extern(extern_str, [inst_var_name] + arg_var_names + [call_result_var_name])
+          call_result_var_name = self.get_result_var(dst_var_name, ret_type, 'call')
+          self.ir.extern(extern_str, [inst_var_name] + arg_var_names, call_result_var_name)
           return call_result_var_name
         else:
-          self.uasm.call_extern(extern_str, [inst_var_name] + arg_var_names)
+          self.ir.extern(extern_str, [inst_var_name] + arg_var_names)
           return None
       else:
         raise Exception(f'{call.func.value.lineno}:{call.func.value.col_offset} {self.print_ast(call)}: Not Found {inst_var_type}.{udon_method_name}{tuple(arg_var_types)} instance function. ')
-    return call_result_var_name
 
-  def eval_call_without_dot(self, call: ast.Call, arg_var_names: List[VarName], arg_var_types: List[UdonTypeName]) -> Optional[VarName]:
+  def eval_call_without_dot(self, call: ast.Call, arg_var_names: List[VarName], arg_var_types: List[UdonTypeName],
+                            dst_var_name: Optional[VarName] = None) -> Optional[VarName]:
     # FORCE CAST, NO CHECK
     func_name: FuncName = f'{call.func.id}'  # type: ignore
     # Embedded functions
@@ -711,47 +989,343 @@ class UdonCompiler:
       if len(arg_var_names) != 1:
         raise Exception(f'{call.func.lineno}:{call.func.col_offset} {self.print_ast(call)}: instantiate must have exactly one argument.')
       arg_var_name: VarName = arg_var_names[0]
-      instantiate_var_name = VarName(self.uasm.get_next_id('instantiate'))
-      self.var_table.add_var(
-        instantiate_var_name, UdonTypeName('GameObject'), 'null')
-      self.uasm.call_extern(
+      instantiate_var_name = self.get_result_var(dst_var_name, UdonTypeName('GameObject'), 'instantiate')
+      self.ir.extern(
         ExternStr('VRCInstantiate.__Instantiate__UnityEngineGameObject__UnityEngineGameObject'),
-        [arg_var_name, instantiate_var_name])
+        [arg_var_name], instantiate_var_name)
       return instantiate_var_name
     # Force Cast
     elif func_name in udon_types:
       cast_type = UdonTypeName(func_name)
-      cast_var_name = VarName(self.uasm.get_next_id('cast'))
       if len(arg_var_names) != 1:
         raise Exception(f'{call.func.lineno}:{call.func.col_offset} {self.print_ast(call)}: A cast argument must be exactly one.')
       arg_var_name = arg_var_names[0]
-      self.var_table.add_var(cast_var_name, cast_type, 'null')
-      self.uasm.assign(cast_var_name, arg_var_name)
+      cast_var_name = self.get_result_var(dst_var_name, cast_type, 'cast')
+      self.assign(cast_var_name, arg_var_name)
       return cast_var_name
     
     # Call defined function
     else:
-      return self.uasm.call_def_func(func_name, arg_var_names)
+      return self.call_def_func(func_name, arg_var_names, dst_var_name)
 
-if __name__ == '__main__':
-  arg_parser = argparse.ArgumentParser(description='UdonPie language Udon Assembly compiler', add_help=True)
-  arg_parser.add_argument('input', help='input UdonPie source code path (ex: .\example.py)')
-  arg_parser.add_argument('output', help='output Udon Assembly code path (ex: .\example.uasm)')
-  arg_parser.add_argument('--cdbg',  help='for compiler debugging', action='store_true')
-  args = arg_parser.parse_args()
+  def assign(self, dist_var_name: VarName, src_var_name: VarName) -> None:
+    "Add variable, "
+    # If the variable name on the right side is UdonTypeName, 
+    # just set the type of the variable on the left.
+    src_var_type: UdonTypeName
+    if src_var_name in udon_types:
+        src_var_type = UdonTypeName(src_var_name)
+        self.var_table.add_var(dist_var_name, src_var_type, 'null')
+    else:
+      src_var_type = self.var_table.get_var_type(src_var_name)
+      # If the left variable is undefined, define the variable.
+      if not self.var_table.exist_var(dist_var_name):
+        self.var_table.add_var(dist_var_name, src_var_type, 'null')
+      self.ir.copy(dist_var_name, src_var_name)
+
+  def call_def_func(self, func_name: FuncName, arg_var_names: List[VarName],
+                    dst_var_name: Optional[VarName] = None) -> Optional[VarName]:
+    arg_var_types: List[UdonTypeName] = [
+      self.var_table.get_var_type(arg_var_name) for arg_var_name in arg_var_names]
+    ret_type_name: UdonTypeName = self.def_func_table.get_ret_type(func_name, tuple(arg_var_types))
+    func_id = LabelName(self.def_func_table.get_function_id(func_name, arg_var_types))
+    if ret_type_name == UdonTypeName('Void'):
+      self.ir.call(func_id, arg_var_names, None)
+      return None
+    ret_value = self.get_result_var(dst_var_name, ret_type_name, 'ret_value')
+    self.ir.call(func_id, arg_var_names, ret_value)
+    return ret_value
+
+class CompileOptions(NamedTuple):
+  cdbg: bool = False
+  # None: the compile cache is not used
+  cache_dir: Optional[str] = None
+  cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES
+  # Write the IR next to the output ({output}.ir)
+  dump_ir: bool = False
+  # Enabled peephole rules (see libs/peephole.py)
+  peephole_rules: Tuple[str, ...] = PEEPHOLE_RULES
+  # Return the peephole report in CompileResult.report
+  peephole_report: bool = False
+
+class CompileResult(NamedTuple):
+  input_path: str
+  output_path: str
+  # None if the compilation succeeded
+  error: Optional[str]
+  # True if the output was taken from the compile cache
+  cached: bool = False
+  # Optimization report (CompileOptions.peephole_report)
+  report: Optional[str] = None
+
+def compile_cache_key(code: str, options: CompileOptions) -> str:
+  """code: source code after strip_ignore_lines"""
+  return CompileCache.make_key(
+    code, COMPILER_VERSION, ','.join(options.peephole_rules), get_udon_method_table().fingerprint)
 
+def compile_file(input_path: str, output_path: str, options: CompileOptions = CompileOptions()) -> CompileResult:
+  """Compile one UdonPie file. Errors are returned, not raised."""
+  cached = False
+  report: Optional[str] = None
   try:
-    f = open(args.input, encoding="utf-8")
-    pycode = f.read()
-    f.close()
-    comp = UdonCompiler(pycode)
-    asm = comp.make_uasm_code()
-    f = open(args.output, 'w')
-    f.write(asm)
+    f = open(input_path, encoding="utf-8")
+    pycode = strip_ignore_lines(f.read())
     f.close()
+    cache: Optional[CompileCache] = None
+    cache_key = ''
+    if options.cache_dir is not None:
+      cache = CompileCache(options.cache_dir, options.cache_max_bytes)
+      cache_key = compile_cache_key(pycode, options)
+      # The IR and the report are not cached.
+      cached = not (options.dump_ir or options.peephole_report) and cache.get_file(cache_key, output_path)
+    if not cached:
+      comp = UdonCompiler(pycode, peephole_rules=options.peephole_rules)
+      # Compile into memory first, so that a failed compilation leaves no output file.
+      comp.eval_module()
+      f = open(output_path, 'w')
+      comp.write_uasm_code(f)
+      f.close()
+      if options.dump_ir:
+        f = open(f'{output_path}.ir', 'w')
+        f.write(comp.make_ir_text())
+        f.close()
+      if options.peephole_report:
+        report = str(comp.peephole_report)
+      if cache is not None:
+        cache.put_file(cache_key, output_path)
   except Exception as e:
-    if args.cdbg:
-      t, v, tb = sys.exc_info()
-      print(traceback.format_exc())
+    if options.cdbg:
+      return CompileResult(input_path, output_path, traceback.format_exc())
+    return CompileResult(input_path, output_path, str(e))
+  return CompileResult(input_path, output_path, None, cached, report)
+
+def compile_source(code: str, options: CompileOptions = CompileOptions()) -> Tuple[str, bool]:
+  """Compile source code to Udon Assembly text. Returns (asm, cached). Errors are raised."""
+  code = strip_ignore_lines(code)
+  cache: Optional[CompileCache] = None
+  cache_key = ''
+  if options.cache_dir is not None:
+    cache = CompileCache(options.cache_dir, options.cache_max_bytes)
+    cache_key = compile_cache_key(code, options)
+    cached_asm = cache.get(cache_key)
+    if cached_asm is not None:
+      return (cached_asm, True)
+  asm = UdonCompiler(code, peephole_rules=options.peephole_rules).make_uasm_code()
+  if cache is not None:
+    cache.put(cache_key, asm)
+  return (asm, False)
+
+def uasm_path(input_path: str, out_dir: Optional[str], rel_path: Optional[str] = None) -> str:
+  """ex) ./src/example.py -> ./src/example.uasm (or {out_dir}/example.uasm)"""
+  if out_dir is None:
+    return os.path.splitext(input_path)[0] + '.uasm'
+  if rel_path is None:
+    rel_path = os.path.basename(input_path)
+  return os.path.join(out_dir, os.path.splitext(rel_path)[0] + '.uasm')
+
+def collect_batch_jobs(paths: List[str], out_dir: Optional[str]) -> List[Tuple[str, str]]:
+  """
+  Make (input, output) pairs from files and directories.
+  A directory means every *.py file directly under it (except __init__.py).
+  """
+  jobs: List[Tuple[str, str]] = []
+  for path in paths:
+    if os.path.isdir(path):
+      for file_name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, file_name)
+        if file_name.endswith('.py') and file_name != '__init__.py' and os.path.isfile(file_path):
+          jobs.append((file_path, uasm_path(file_path, out_dir, file_name)))
+    else:
+      jobs.append((path, uasm_path(path, out_dir)))
+  return jobs
+
+def read_manifest(manifest_path: str, out_dir: Optional[str]) -> List[Tuple[str, str]]:
+  """
+  Read a JSON manifest. Relative paths are relative to the manifest.
+  ex) ["example.py", {"input": "other.py", "output": "out/other.uasm"}]
+  An entry without "output" is written next to its input (or to out_dir).
+  """
+  base_dir = os.path.dirname(manifest_path)
+  f = open(manifest_path, encoding="utf-8")
+  entries = json.load(f)
+  f.close()
+  jobs: List[Tuple[str, str]] = []
+  for entry in entries:
+    if type(entry) is str:
+      input_path = os.path.join(base_dir, entry)
+      jobs.append((input_path, uasm_path(input_path, out_dir)))
+    elif type(entry) is dict and 'input' in entry:
+      input_path = os.path.join(base_dir, entry['input'])
+      if 'output' in entry:
+        jobs.append((input_path, os.path.join(base_dir, entry['output'])))
+      else:
+        jobs.append((input_path, uasm_path(input_path, out_dir)))
+    else:
+      raise Exception(f'{manifest_path}: Unknown manifest entry {entry}.')
+  return jobs
+
+def compile_job(job: Tuple[str, str, CompileOptions]) -> CompileResult:
+  """Worker entry point for compile_batch (must be picklable)"""
+  input_path, output_path, options = job
+  return compile_file(input_path, output_path, options)
+
+def compile_batch(jobs: List[Tuple[str, str]], options: CompileOptions = CompileOptions(), n_jobs: int = 1) -> List[CompileResult]:
+  """
+  Compile every job. The extern table is loaded once and shared.
+  With n_jobs > 1 the jobs are spread over worker processes.
+  Results are always in the order of jobs.
+  """
+  for _, output_path in jobs:
+    output_dir = os.path.dirname(output_path)
+    if output_dir != '':
+      os.makedirs(output_dir, exist_ok=True)
+  worker_jobs = [(input_path, output_path, options) for input_path, output_path in jobs]
+  if n_jobs <= 1 or len(jobs) <= 1:
+    return [compile_job(worker_job) for worker_job in worker_jobs]
+
+  # Load the table before starting the workers.
+  # With fork the workers inherit it (and its memory-mapped index) from this process.
+  # Otherwise (spawn on Windows) each worker maps the same index file, which the OS shares.
+  get_udon_method_table()
+  if 'fork' in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context('fork')
+  else:
+    context = multiprocessing.get_context()
+  with context.Pool(min(n_jobs, len(jobs))) as pool:
+    return pool.map(compile_job, worker_jobs, chunksize=1)
+
+def update_cache_stats(results: List[CompileResult], options: CompileOptions) -> None:
+  """Record the hit/miss statistics of a run and evict old entries"""
+  if options.cache_dir is None:
+    return
+  cache = CompileCache(options.cache_dir, options.cache_max_bytes)
+  hits = len([result for result in results if result.error is None and result.cached])
+  misses = len([result for result in results if result.error is None and not result.cached])
+  cache.record_stats(hits, misses)
+  cache.evict()
+
+def print_batch_results(results: List[CompileResult]) -> int:
+  """Print per-file results and a summary. Returns the exit code."""
+  n_failed = 0
+  for result in results:
+    if result.error is None:
+      print(f'OK    {result.input_path} -> {result.output_path}{" (cached)" if result.cached else ""}')
+      if result.report is not None:
+        print(result.report)
+    else:
+      n_failed += 1
+      print(f'ERROR {result.input_path}: {result.error}')
+  print(f'{len(results) - n_failed} succeeded, {n_failed} failed.')
+  return 0 if n_failed == 0 else 1
+
+def handle_server_request(request: Dict[str, Any], options: CompileOptions) -> Dict[str, Any]:
+  """
+  Compile server request (see libs/compile_server.py)
+  "source": compile the code and return the assembly
+  "input", "output": compile the file like the command line
+  """
+  command = request.get('command', 'compile')
+  if command == 'ping':
+    return {'ok': True, 'version': COMPILER_VERSION}
+  if command != 'compile':
+    return {'ok': False, 'error': f'Unknown command {command}.'}
+  start_time = time.perf_counter()
+  response: Dict[str, Any]
+  if 'source' in request:
+    try:
+      asm, cached = compile_source(request['source'], options)
+      response = {'ok': True, 'asm': asm, 'cached': cached}
+      update_cache_stats([CompileResult('', '', None, cached)], options)
+    except Exception as e:
+      response = {'ok': False, 'error': traceback.format_exc() if options.cdbg else str(e)}
+  elif 'input' in request and 'output' in request:
+    result = compile_file(request['input'], request['output'], options)
+    update_cache_stats([result], options)
+    response = {'ok': result.error is None, 'error': result.error, 'cached': result.cached}
+  else:
+    return {'ok': False, 'error': 'A compile request needs "source" or "input" and "output".'}
+  response['elapsed_ms'] = (time.perf_counter() - start_time) * 1000.0
+  return response
+
+def parse_peephole_rules(rules_str: str) -> Tuple[str, ...]:
+  """--peephole: comma separated rules, or 'none'"""
+  peephole_rules = tuple(rule for rule in rules_str.split(',') if rule not in ('', 'none'))
+  for rule in peephole_rules:
+    if rule not in PEEPHOLE_RULES:
+      raise argparse.ArgumentTypeError(f'Unknown rule {rule}. (rules: {",".join(PEEPHOLE_RULES)})')
+  return peephole_rules
+
+def make_arg_parser() -> argparse.ArgumentParser:
+  arg_parser = argparse.ArgumentParser(description='UdonPie language Udon Assembly compiler', add_help=True)
+  arg_parser.add_argument('input', nargs='?', help='input UdonPie source code path (ex: .\example.py)')
+  arg_parser.add_argument('output', nargs='?', help='output Udon Assembly code path (ex: .\example.uasm)')
+  arg_parser.add_argument('--batch', nargs='+', metavar='PATH', help='compile many source files / directories in one process')
+  arg_parser.add_argument('--manifest', help='compile the files listed in a JSON manifest in one process')
+  arg_parser.add_argument('--out-dir', help='output directory for --batch / --manifest (default: next to each input)')
+  arg_parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N', help='number of worker processes for --batch / --manifest')
+  arg_parser.add_argument('--cache-dir', help='reuse the output of unchanged sources from this compile cache directory')
+  arg_parser.add_argument('--cache-max-size', type=int, default=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024), metavar='MB', help='size limit of the compile cache (least recently used entries are evicted)')
+  arg_parser.add_argument('--cache-stats', help='print the compile cache statistics', action='store_true')
+  arg_parser.add_argument('--cache-clear', help='remove all entries of the compile cache', action='store_true')
+  arg_parser.add_argument('--server', help='run as a compile server with the tables loaded (see udon_client.py)', action='store_true')
+  arg_parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT, help='port of the compile server (127.0.0.1)')
+  arg_parser.add_argument('--stdio', help='the compile server reads requests from stdin (JSON lines) instead of the port', action='store_true')
+  arg_parser.add_argument('--dump-ir', help='write the intermediate representation to {output}.ir', action='store_true')
+  arg_parser.add_argument('--peephole', type=parse_peephole_rules, default=','.join(PEEPHOLE_RULES), metavar='RULES', help=f'comma separated peephole rules, or "none" (default: {",".join(PEEPHOLE_RULES)})')
+  arg_parser.add_argument('--peephole-report', help='print the instructions and bytes removed by the peephole optimization', action='store_true')
+  arg_parser.add_argument('--cdbg',  help='for compiler debugging', action='store_true')
+  return arg_parser
+
+def compile_options_from_args(args: argparse.Namespace) -> CompileOptions:
+  return CompileOptions(args.cdbg, args.cache_dir, args.cache_max_size * 1024 * 1024, args.dump_ir,
+                        args.peephole, args.peephole_report)
+
+if __name__ == '__main__':
+  # for the worker processes of the exe file (PyInstaller)
+  multiprocessing.freeze_support()
+  arg_parser = make_arg_parser()
+  args = arg_parser.parse_args()
+  options = compile_options_from_args(args)
+
+  # Compile server
+  if args.server:
+    # Load the tables before the first request
+    get_udon_method_table()
+    if args.stdio:
+      serve_stdio(lambda request: handle_server_request(request, options))
     else:
-      print(e)
+      print(f'UdonPie compile server: 127.0.0.1:{args.port}', file=sys.stderr)
+      serve_tcp(lambda request: handle_server_request(request, options), args.port)
+    sys.exit(0)
+
+  # Compile cache maintenance
+  if args.cache_stats or args.cache_clear:
+    if args.cache_dir is None:
+      arg_parser.error('--cache-stats / --cache-clear require --cache-dir')
+    cache = CompileCache(args.cache_dir, options.cache_max_bytes)
+    if args.cache_clear:
+      print(f'{cache.clear()} entries removed.')
+    if args.cache_stats:
+      print(cache.stats_str())
+    if args.input is None and args.batch is None and args.manifest is None:
+      sys.exit(0)
+
+  # Batch mode
+  if args.batch is not None or args.manifest is not None:
+    jobs: List[Tuple[str, str]] = []
+    if args.batch is not None:
+      jobs += collect_batch_jobs(args.batch, args.out_dir)
+    if args.manifest is not None:
+      jobs += read_manifest(args.manifest, args.out_dir)
+    results = compile_batch(jobs, options, args.jobs)
+    update_cache_stats(results, options)
+    sys.exit(print_batch_results(results))
+
+  if args.input is None or args.output is None:
+    arg_parser.error('input and output are required (or use --batch / --manifest)')
+  result = compile_file(args.input, args.output, options)
+  update_cache_stats([result], options)
+  if result.error is not None:
+    print(result.error)
+  elif result.report is not None:
+    print(result.report)
@@ -19,6 +19,7 @@ a = Analysis(['udon_compiler.py'],
              cipher=block_cipher,
              noarchive=False)
 a.datas += [('udon_funcs_data.py', '.\\udon_funcs_data.py', 'DATA')]
+a.datas += [('udon_funcs_data.idx', '.\\udon_funcs_data.idx', 'DATA')]
 pyz = PYZ(a.pure, a.zipped_data,
              cipher=block_cipher)
 exe = EXE(pyz,